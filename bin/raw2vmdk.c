@@ -21,6 +21,9 @@
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <alloca.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <unistd.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -35,7 +38,7 @@
 #endif
 
 /* Program version */
-#define VER                 "0.2"
+#define VER                 "0.3"
 
 #define CID_NOPARENT        0x0
 #define SPARSE_MAGICNUMBER  0x564d444b /* 'V' 'M' 'D' 'K' */
@@ -157,6 +160,17 @@ typedef struct SparseExtentHeader {
 
 int verbose = 0;
 int vmdkType = MONOLITHIC_SPARSE;
+int compressLevel = 1;
+int numThreads = 1;
+
+/*
+ * Machine readable progress, written to the descriptor given with -P as
+ * lines of: progress <bytes read> <total bytes> <grains written> <grains skipped>
+ */
+int progressFd = -1;
+off_t progressTotal = 0;
+u_int64_t grainsWritten = 0;
+u_int64_t grainsSkipped = 0;
 
 #define VPRINT  if(verbose) printf
 
@@ -306,56 +320,17 @@ int writeCompressedGrainTable(u_int32_t * gt, FILE * of) {
     return bytesWritten;
 }
 
-int writeCompressedGrain(FILE * infile, SectorType lba, FILE * of) {
-    z_stream strm;
-    int ret;
-    int compressedBytes = 0;
+int writeCompressedGrain(const u_int8_t * data, size_t size, SectorType lba,
+        FILE * of) {
     off_t bytesWritten = 0;
-    size_t bytesRead = 0;
-    u_int8_t buf[GRAINSIZE];
-    u_int8_t outbuf[2*GRAINSIZE];
-    memset(buf, 0, GRAINSIZE*sizeof(u_int8_t));
-    memset(outbuf, 0, GRAINSIZE*sizeof(u_int8_t));
-
-    bytesRead = fread(buf, 1, GRAINSIZE*sizeof(u_int8_t), infile);
-    if (bytesRead == 0) {
-        VPRINT("End of file reached.\n");
-        return 0;
-    }
-
-    if (! memcmp(buf, zerograin, GRAINSIZE*sizeof(u_int8_t))) {
-        VPRINT("grain at LBA %lld is zero. skipping.\n", (long long)lba);
-        return 0;
-    }
-
-    /* allocate deflate state */
-    strm.zalloc = Z_NULL;
-    strm.zfree = Z_NULL;
-    strm.opaque = Z_NULL;
-    ret = deflateInit(&strm, 1);
-    if (ret != Z_OK)
-        exit(2);
-
-    strm.avail_in = bytesRead;
-    strm.next_in = buf;
-    strm.next_out = outbuf;
-    strm.avail_out = 2*GRAINSIZE;
-    ret = deflate(&strm, Z_FINISH);    /* no bad return value */
-    assert(ret != Z_STREAM_ERROR);  /* state not clobbered */
-    compressedBytes = 2*GRAINSIZE - strm.avail_out;
-    assert(strm.avail_in == 0);     /* all input will be used */
-    assert(ret == Z_STREAM_END);        /* stream will be complete */
-
-    /* clean up and return */
-    (void)deflateEnd(&strm);
 
     /* write grain marker */
     GrainMarker gm;
     memset(&gm, 0, sizeof(GrainMarker));
     gm.lba = lba;
-    gm.size = compressedBytes;
+    gm.size = size;
     bytesWritten = _fwrite((void *)&gm, sizeof(GrainMarker), 1, of);
-    bytesWritten += _fwrite((void *)&outbuf, sizeof(u_int8_t), compressedBytes, of);
+    bytesWritten += _fwrite((void *)data, sizeof(u_int8_t), size, of);
     VPRINT("Wrote a compressed grain of %lld bytes\n", (long long)bytesWritten);
     off_t padding = bytesWritten % SECTORSIZE;
     if (padding) {
@@ -434,7 +409,169 @@ Bool isZeroBlock(const u_int8_t buf[], size_t count)
     return 1;
 }
 
-off_t copyData(FILE *in, const off_t outsize,
+/*
+ * Sequential reader for the input image. When the input is a regular file,
+ * holes are found with SEEK_DATA/SEEK_HOLE and grains lying entirely
+ * within them are reported without being read.
+ */
+typedef struct GrainReader {
+    FILE *      file;
+    int         fd;         /* -1 when reading a stream */
+    off_t       size;
+    off_t       pos;
+    off_t       dataStart;  /* current or next data extent */
+    off_t       dataEnd;
+    off_t       processed;  /* bytes read or skipped so far */
+} GrainReader;
+
+void reportProgress(const GrainReader * r) {
+    if (progressFd < 0) {
+        return;
+    }
+    dprintf(progressFd, "progress %lld %lld %llu %llu\n",
+            (long long)r->processed, (long long)progressTotal,
+            (unsigned long long)grainsWritten,
+            (unsigned long long)grainsSkipped);
+}
+
+void GrainReader_init(GrainReader * r, FILE * file) {
+    struct stat st;
+    memset(r, 0, sizeof(GrainReader));
+    r->file = file;
+    r->fd = -1;
+    if (!fstat(fileno(file), &st) && S_ISREG(st.st_mode)) {
+        r->fd = fileno(file);
+        r->size = st.st_size;
+    }
+}
+
+void GrainReader_findData(GrainReader * r) {
+    off_t start = lseek(r->fd, r->pos, SEEK_DATA);
+    if (start < 0) {
+        if (errno == ENXIO) {
+            /* Only a hole remains */
+            r->dataStart = r->dataEnd = r->size;
+        } else {
+            /* Hole detection not supported; everything is data */
+            r->dataStart = r->pos;
+            r->dataEnd = r->size;
+        }
+        return;
+    }
+    r->dataStart = start;
+    r->dataEnd = lseek(r->fd, start, SEEK_HOLE);
+    if (r->dataEnd < 0) {
+        r->dataEnd = r->size;
+    }
+}
+
+/*
+ * Read the next grain into buf. Returns the number of bytes covered, or 0 at
+ * the end of the input. *hole is set if the grain was not read because it
+ * lies in a hole; buf is left untouched in that case.
+ */
+size_t readGrain(GrainReader * r, u_int8_t * buf, Bool * hole) {
+    size_t want, got = 0;
+    ssize_t rc;
+    *hole = 0;
+    if (r->fd < 0) {
+        got = fread(buf, sizeof(u_int8_t), GRAINSIZE, r->file);
+        r->processed += got;
+        return got;
+    }
+    if (r->pos >= r->size) {
+        return 0;
+    }
+    want = r->size - r->pos < GRAINSIZE ? r->size - r->pos : GRAINSIZE;
+    if (r->pos >= r->dataEnd) {
+        GrainReader_findData(r);
+    }
+    if (r->pos + (off_t)want <= r->dataStart) {
+        *hole = 1;
+        r->pos += want;
+        r->processed += want;
+        return want;
+    }
+    while (got < want) {
+        rc = pread(r->fd, buf + got, want - got, r->pos + got);
+        if (rc < 0 && errno == EINTR) {
+            continue;
+        }
+        if (rc <= 0) {
+            break;
+        }
+        got += rc;
+    }
+    r->pos += got;
+    r->processed += got;
+    return got;
+}
+
+/*
+ * A batch of up to one grain table's worth of grains, compressed in
+ * parallel by a pool of workers. Each worker owns a z_stream that is reset
+ * rather than reallocated between grains. Results are written out in order
+ * by the caller.
+ */
+typedef struct GrainBatch {
+    u_int8_t *  in;
+    u_int8_t *  out;
+    size_t      inSize[GTEPERGT];   /* 0 for grains that are not written */
+    size_t      outSize[GTEPERGT];
+    size_t      outBound;
+    int         count;
+    int         next;               /* next grain to claim */
+} GrainBatch;
+
+typedef struct GrainWorker {
+    GrainBatch *    batch;
+    z_stream        strm;
+} GrainWorker;
+
+void compressGrain(GrainWorker * w, int i) {
+    GrainBatch * b = w->batch;
+    int ret = deflateReset(&w->strm);
+    assert(ret == Z_OK);
+    w->strm.next_in = b->in + (size_t)i * GRAINSIZE;
+    w->strm.avail_in = b->inSize[i];
+    w->strm.next_out = b->out + (size_t)i * b->outBound;
+    w->strm.avail_out = b->outBound;
+    ret = deflate(&w->strm, Z_FINISH);
+    assert(ret == Z_STREAM_END);        /* stream will be complete */
+    assert(w->strm.avail_in == 0);      /* all input will be used */
+    b->outSize[i] = b->outBound - w->strm.avail_out;
+}
+
+void * compressWorker(void * arg) {
+    GrainWorker * w = (GrainWorker *)arg;
+    GrainBatch * b = w->batch;
+    int i;
+    while ((i = __sync_fetch_and_add(&b->next, 1)) < b->count) {
+        if (b->inSize[i]) {
+            compressGrain(w, i);
+        }
+    }
+    return NULL;
+}
+
+void compressBatch(GrainBatch * b, GrainWorker * workers) {
+    pthread_t * threads = (pthread_t *)alloca(numThreads * sizeof(pthread_t));
+    int t;
+    b->next = 0;
+    /* The calling thread is worker 0 */
+    for (t = 1; t < numThreads; t++) {
+        if (pthread_create(&threads[t], NULL, compressWorker, &workers[t])) {
+            fprintf(stderr, "Unable to start compression thread\n");
+            exit(2);
+        }
+    }
+    compressWorker(&workers[0]);
+    for (t = 1; t < numThreads; t++) {
+        pthread_join(threads[t], NULL);
+    }
+}
+
+off_t copyData(GrainReader *in, const off_t outsize,
              const SparseExtentHeader * header, FILE * of) {
     /* Always have 512 entries per grain table */
     u_int32_t limit = numGTs(outsize) * 512;
@@ -449,12 +586,13 @@ off_t copyData(FILE *in, const off_t outsize,
     u_int32_t curGrain;
     for (curGrain = 0; curGrain < numGrains; curGrain++) {
         VPRINT("Copying grain %d of %d", curGrain + 1, numGrains);
-        read = fread(buf, sizeof(u_int8_t), GRAINSIZE, in);
+        Bool hole;
+        read = readGrain(in, buf, &hole);
         if (!read) {
             fprintf(stderr, "\nShort read on grain %u\n", curGrain);
             break;
         }
-        Bool blank = isZeroBlock(buf, read);
+        Bool blank = hole || isZeroBlock(buf, read);
         /* Pad the file to be grain aligned (RBL-3487) */
         if (read < GRAINSIZE) {
             VPRINT("\nPadding end of file to align to grain by %lld bytes.",
@@ -467,12 +605,17 @@ off_t copyData(FILE *in, const off_t outsize,
             grainTable[pos] = currentSector;
             currentSector += GRAINSECTORS;
             returner += fwrite((void*)&buf, sizeof(u_int8_t), read, of);
+            grainsWritten++;
             VPRINT(" written\n");
         }
         else {
+            grainsSkipped++;
             VPRINT(" skipped\n");
         }
         pos++;
+        if (pos % GTEPERGT == 0) {
+            reportProgress(in);
+        }
     }
     /* Write the grainTable to the two offsets */
     writeGrainTableData(header, grainTable, limit, of);
@@ -486,7 +629,7 @@ static void usage(char * name)
 {
     printf("%s - Version %s\n", name, VER);
     printf("%s -C cylinders [-H heads] [-S sectors] [-A adapter] [-l size] [ -s ] "
-	    "infile.img outfile.vmdk\n\n"
+	    "[-j threads] [-z level] [-P fd] infile.img outfile.vmdk\n\n"
             "-C  Number of cylinders in infile.img\n"
             "-H  Number of heads in infile.img\n"
             "-S  Number of sectors in infile.img\n"
@@ -494,6 +637,10 @@ static void usage(char * name)
             "-l  Size of the input image (optional if input is a file)\n"
             "-s  Use streamOptimized format rather than monolithicSparse\n"
             "-V  Virtual hardware version: 7, 8, 9 or 10 (default: %d)\n"
+            "-j  Compression threads for streamOptimized, 0 for one per CPU "
+            "(default: 1)\n"
+            "-z  Compression level for streamOptimized, 0-9 (default: 1)\n"
+            "-P  Write progress lines to this file descriptor\n"
             "infile.img    RAW disk image, or - for standard input\n"
             "outfile.vmdk  VMware virtual disk\n\n",
             name,
@@ -548,7 +695,7 @@ int main(int argc, char ** argv) {
 
     // Parse command line options
     do {
-        c = getopt(argc, argv, "C:H:S:A:l:vsV:");
+        c = getopt(argc, argv, "C:H:S:A:l:vsV:j:z:P:");
         switch (c) {
             case 'C': cylinders = atoi(optarg); break;
             case 'H': heads = atoi(optarg); break;
@@ -558,6 +705,9 @@ int main(int argc, char ** argv) {
             case 'l': fileSize = atoll(optarg); break;
             case 's': vmdkType = STREAM_OPTIMIZED; break;
             case 'V': hwVersion = atoi(optarg); break;
+            case 'j': numThreads = atoi(optarg); break;
+            case 'z': compressLevel = atoi(optarg); break;
+            case 'P': progressFd = atoi(optarg); break;
         }
     } while (c >= 0);
 
@@ -575,6 +725,14 @@ int main(int argc, char ** argv) {
         usage(argv[0]);
         return -1;
     }
+    if (compressLevel < 0 || compressLevel > 9 || numThreads < 0) {
+        usage(argv[0]);
+        return -1;
+    }
+    if (numThreads == 0) {
+        long cpus = sysconf(_SC_NPROCESSORS_ONLN);
+        numThreads = cpus > 0 ? cpus : 1;
+    }
     char * infile = argv[optind];
     VPRINT("Reading from %s\n", infile);
     char * outfile = argv[optind+1];
@@ -608,6 +766,9 @@ int main(int argc, char ** argv) {
             return 4;
         }
     }
+    GrainReader reader;
+    GrainReader_init(&reader, inf);
+    progressTotal = fileSize;
 
     char ** outfiles;
     off_t * outsizes;
@@ -710,7 +871,7 @@ int main(int argc, char ** argv) {
 
             // Write the grains. This also writes the grain tables
             VPRINT("Copying the data\n");
-            if (copyData(inf, outsizes[fileNo], &header, of) < 0) {
+            if (copyData(&reader, outsizes[fileNo], &header, of) < 0) {
                 return 1;
             }
         } else {
@@ -725,25 +886,74 @@ int main(int argc, char ** argv) {
             memset(gd, 0, gdsize * sizeof(u_int32_t));
             u_int32_t gt[GTEPERGT];
             pos = GRAINSIZE;
+
+            GrainBatch batch;
+            GrainWorker * workers = (GrainWorker *)alloca(
+                    numThreads * sizeof(GrainWorker));
+            int t;
+            memset(&batch, 0, sizeof(GrainBatch));
+            for (t = 0; t < numThreads; t++) {
+                memset(&workers[t], 0, sizeof(GrainWorker));
+                workers[t].batch = &batch;
+                if (deflateInit(&workers[t].strm, compressLevel) != Z_OK)
+                    exit(2);
+            }
+            batch.outBound = deflateBound(&workers[0].strm, GRAINSIZE);
+            batch.in = (u_int8_t *)malloc((size_t)GTEPERGT * GRAINSIZE);
+            batch.out = (u_int8_t *)malloc((size_t)GTEPERGT * batch.outBound);
+            if (!batch.in || !batch.out) {
+                fprintf(stderr, "Out of memory\n");
+                return 2;
+            }
+
             int gtNum;
             for (gtNum=0; lba <= SECTORS(outsize); gtNum++) {
                 int grain;
-                int cgsize;
-                memset(gt, 0, GTEPERGT*sizeof(u_int32_t));
+                SectorType firstLba = lba;
+                /* Read one grain table's worth of grains */
                 for (grain=0; (grain < GTEPERGT) && (lba <= SECTORS(outsize)); grain++) {
-                    /* writeCompressedGrain reads GRAINSIZE bytes */
-                    cgsize = writeCompressedGrain(inf, lba, of);
-                    if (cgsize) {
-                        gt[grain] = SECTORS(pos);
-                        pos += cgsize;
+                    u_int8_t * buf = batch.in + (size_t)grain * GRAINSIZE;
+                    Bool hole;
+                    size_t bytesRead = readGrain(&reader, buf, &hole);
+                    if (bytesRead == 0 || hole || isZeroBlock(buf, bytesRead)) {
+                        VPRINT("grain at LBA %lld is zero. skipping.\n",
+                                (long long)lba);
+                        if (bytesRead) {
+                            grainsSkipped++;
+                        }
+                        bytesRead = 0;
+                    } else {
+                        grainsWritten++;
                     }
+                    batch.inSize[grain] = bytesRead;
                     lba += GRAINSECTORS;
                 }
+                batch.count = grain;
+                compressBatch(&batch, workers);
+
+                /* Write them out in order */
+                memset(gt, 0, GTEPERGT*sizeof(u_int32_t));
+                for (grain=0; grain < batch.count; grain++) {
+                    if (!batch.inSize[grain]) {
+                        continue;
+                    }
+                    gt[grain] = SECTORS(pos);
+                    pos += writeCompressedGrain(
+                            batch.out + (size_t)grain * batch.outBound,
+                            batch.outSize[grain],
+                            firstLba + (SectorType)grain * GRAINSECTORS, of);
+                }
                 if (grain != 0 && memcmp(gt, zerogt, GTEPERGT*sizeof(u_int32_t))) {
                     gd[gtNum] = SECTORS(pos+sizeof(MetaDataMarker));
                     pos += writeCompressedGrainTable(gt, of);
                 }
+                reportProgress(&reader);
+            }
+            for (t = 0; t < numThreads; t++) {
+                (void)deflateEnd(&workers[t].strm);
             }
+            free(batch.in);
+            free(batch.out);
             pos = ftello(of);
             header.gdOffset = SECTORS(pos) + 1;
             writeCompressedGrainDirectory(gd, gdsize, of);
@@ -753,6 +963,7 @@ int main(int argc, char ** argv) {
         VPRINT("Closing %s\n", outfiles[fileNo]);
         fclose(of);
     }
+    reportProgress(&reader);
     fclose(devnull);
     fclose(inf);
     VPRINT("Finished\n");
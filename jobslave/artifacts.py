@@ -0,0 +1,177 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Sizes and digests of output files, recorded while the files are written so
+that manifests and uploads do not have to read them back.
+
+Writers open their output with L{ArtifactFile}, which hashes the data as it
+goes past. Only files written front to back can be hashed that way: seeking
+elsewhere, or handing the descriptor to another process, drops the digests
+and the file is recorded with its size only. Entries are keyed by device and
+inode, so hardlinks share one, and are ignored once the file's size or
+modification time no longer match.
+"""
+
+import hashlib
+import os
+import threading
+
+# Digests computed for every artifact
+DIGESTS = ('sha1',)
+
+
+class Artifact(object):
+    """
+    Size and hex digests of a file as of modification time C{mtime}.
+    """
+
+    def __init__(self, size, mtime, digests):
+        self.size = size
+        self.mtime = mtime
+        self.digests = digests
+
+    @property
+    def sha1(self):
+        return self.digests.get('sha1')
+
+    def __repr__(self):
+        return '<Artifact %s>' % ' '.join(['size=%d' % self.size] +
+                ['%s=%s' % x for x in sorted(self.digests.items())])
+
+
+class Registry(object):
+    """
+    Thread-safe map from files to their L{Artifact}s.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._artifacts = {}
+
+    def record(self, path, digests=None):
+        """
+        Record that the file at C{path}, as it is now, has C{digests} (a
+        dict mapping algorithm names to hex digests). Returns the
+        L{Artifact}.
+        """
+        st = os.stat(path)
+        artifact = Artifact(st.st_size, st.st_mtime, dict(digests or {}))
+        with self._lock:
+            self._artifacts[st.st_dev, st.st_ino] = artifact
+        return artifact
+
+    def forget(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            self._artifacts.pop((st.st_dev, st.st_ino), None)
+
+    def lookup(self, path):
+        """
+        Return the L{Artifact} for C{path}, or C{None} if nothing current is
+        recorded.
+        """
+        st = os.stat(path)
+        key = st.st_dev, st.st_ino
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is None:
+                return None
+            if (artifact.size, artifact.mtime) != (st.st_size, st.st_mtime):
+                # Changed since it was recorded
+                del self._artifacts[key]
+                return None
+            return artifact
+
+
+registry = Registry()
+
+
+class ArtifactFile(object):
+    """
+    File object that writes to C{path} and records it in C{registry} when
+    closed, with C{algorithms} digests if everything was written in order.
+    """
+
+    def __init__(self, path, mode='wb', bufsize=-1, algorithms=DIGESTS,
+            registry=registry):
+        self.name = path
+        self.fobj = open(path, mode, bufsize)
+        self.registry = registry
+        self.hashes = [(x, hashlib.new(x)) for x in algorithms]
+        if not mode.startswith('w'):
+            # Existing contents were not hashed
+            self.hashes = None
+
+    def write(self, data):
+        if self.hashes:
+            for _, h in self.hashes:
+                h.update(data)
+        self.fobj.write(data)
+
+    def tell(self):
+        return self.fobj.tell()
+
+    def seek(self, offset, whence=0):
+        if self.hashes and not (whence == 0 and offset == self.fobj.tell()):
+            self.hashes = None
+        self.fobj.seek(offset, whence)
+
+    def truncate(self, *args):
+        self.hashes = None
+        self.fobj.truncate(*args)
+
+    def flush(self):
+        self.fobj.flush()
+
+    def fileno(self):
+        # Whatever is written through the descriptor is not seen here
+        self.hashes = None
+        return self.fobj.fileno()
+
+    def close(self):
+        """
+        Close the file and record it, returning its L{Artifact}.
+        """
+        if self.fobj.closed:
+            return None
+        self.fobj.close()
+        return self.registry.record(self.name, self.hashes and
+                dict((x, h.hexdigest()) for x, h in self.hashes))
+
+    def abort(self):
+        """
+        Close the file without recording it.
+        """
+        self.fobj.close()
+        self.registry.forget(self.name)
+
+    @property
+    def closed(self):
+        return self.fobj.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,401 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Multi-threaded compression of files and directory trees.
+
+gzip output is produced in-process the same way as C{pigz --independent}:
+the input is cut into fixed size blocks, each block is deflated on its own by
+a pool of worker threads and ended with a sync flush so that it finishes on a
+byte boundary, and the results are written in order between a single gzip
+header and trailer. The output is one ordinary gzip member that any gzip
+implementation can read.
+
+zstd and xz are delegated to their command line tools with threading enabled.
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+import stat
+import struct
+import subprocess
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from jobslave import artifacts
+from jobslave import sparsefile
+from jobslave.util import CommandError
+
+log = logging.getLogger(__name__)
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+XZ = 'xz'
+
+# codec -> (file suffix, default level)
+CODECS = {
+        GZIP: ('.gz', 6),
+        ZSTD: ('.zst', 3),
+        XZ: ('.xz', 6),
+        }
+
+BLOCK_SIZE = 128 * 1024
+
+# Empty final block with fixed Huffman codes, ending the deflate stream
+_DEFLATE_END = '\x03\x00'
+
+
+def getSuffix(codec):
+    return CODECS[codec][0]
+
+
+def _checkCodec(codec, level):
+    if codec not in CODECS:
+        raise ValueError("Unsupported compression codec '%s'" % (codec,))
+    if level is None:
+        level = CODECS[codec][1]
+    return int(level)
+
+
+def _deflateBlock(data, level):
+    # zlib releases the GIL while deflating, so threads scale
+    comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _gf2Times(mat, vec):
+    total = 0
+    n = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[n]
+        vec >>= 1
+        n += 1
+    return total
+
+
+def _gf2Square(mat):
+    return [_gf2Times(mat, x) for x in mat]
+
+
+def _zeroOperators():
+    # Port of the operator construction in zlib's crc32_combine(). ops[k]
+    # advances a raw CRC register over 2**k zero bytes.
+    op = [0xedb88320] + [1 << n for n in range(31)]
+    for x in range(3):
+        op = _gf2Square(op)
+    ops = [op]
+    for x in range(63):
+        ops.append(_gf2Square(ops[-1]))
+    return ops
+
+_ZERO_OPS = []
+
+
+def crc32Zeros(crc, length):
+    """
+    Return C{zlib.crc32('\\0' * length, crc)} without building the string.
+    """
+    if not _ZERO_OPS:
+        _ZERO_OPS.extend(_zeroOperators())
+    reg = ~crc & 0xffffffff
+    k = 0
+    while length:
+        if length & 1:
+            reg = _gf2Times(_ZERO_OPS[k], reg)
+        length >>= 1
+        k += 1
+    return ~reg & 0xffffffff
+
+
+class _Done(object):
+    """Stand-in for an async result that is already available."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class CompressStats(object):
+    """
+    Byte counts from a compression run: data that was read and deflated,
+    zero blocks that were read but not deflated, and holes that were
+    neither read nor deflated.
+    """
+
+    def __init__(self):
+        self.dataBytes = 0
+        self.zeroBytes = 0
+        self.holeBytes = 0
+        self.compressedBytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def totalBytes(self):
+        return self.dataBytes + self.zeroBytes + self.holeBytes
+
+    def __str__(self):
+        return ("%d bytes in %.1f seconds (%d data, %d zero, %d hole) "
+                "-> %d bytes" % (self.totalBytes, self.elapsed,
+                    self.dataBytes, self.zeroBytes, self.holeBytes,
+                    self.compressedBytes))
+
+
+class GzipWriter(object):
+    """
+    Write a single gzip member to C{outFile}, deflating blocks of input on a
+    pool of C{workers} threads.
+
+    Runs of zeroes passed to L{writeZeros}, or whole blocks of zeroes passed
+    to L{write}, are not deflated: the compressed form of one zero block is
+    computed once and repeated, and the checksum is advanced arithmetically.
+    """
+
+    def __init__(self, outFile, level=6, workers=None, blockSize=BLOCK_SIZE):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.outFile = outFile
+        self.level = level
+        self.workers = max(workers, 1)
+        self.blockSize = blockSize
+        self.stats = CompressStats()
+        self.crc = zlib.crc32('')
+        self.size = 0
+        self.zeroRun = 0
+        self.zeroBlock = '\0' * blockSize
+        self.zeroDeflated = None
+        self.pending = collections.deque()
+        self.pool = ThreadPool(self.workers)
+        self._write('\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time()))
+                + '\x00\xff')
+
+    def _write(self, data):
+        self.outFile.write(data)
+        self.stats.compressedBytes += len(data)
+
+    def _queue(self, result):
+        self.pending.append(result)
+        # Bound the number of blocks in flight so memory use stays flat
+        while len(self.pending) >= 2 * self.workers:
+            self._write(self.pending.popleft().get())
+
+    def _flushZeros(self):
+        if self.zeroRun:
+            self.crc = crc32Zeros(self.crc, self.zeroRun)
+            self.zeroRun = 0
+
+    def write(self, data):
+        """
+        Compress C{data}, which should be a multiple of the block size except
+        at the end of the input.
+        """
+        for n in range(0, len(data), self.blockSize):
+            block = data[n:n + self.blockSize]
+            if block == self.zeroBlock:
+                self.stats.zeroBytes += len(block)
+                self._zeros(1)
+                continue
+            self._flushZeros()
+            self.crc = zlib.crc32(block, self.crc)
+            self.size += len(block)
+            self.stats.dataBytes += len(block)
+            self._queue(self.pool.apply_async(_deflateBlock,
+                (block, self.level)))
+
+    def writeZeros(self, length):
+        """
+        Compress C{length} bytes of zeroes that were never read, e.g. a hole
+        in a sparse file.
+        """
+        self.stats.holeBytes += length
+        blocks, remainder = divmod(length, self.blockSize)
+        self._zeros(blocks)
+        if remainder:
+            self.zeroRun += remainder
+            self.size += remainder
+            self._queue(_Done(_deflateBlock('\0' * remainder, self.level)))
+
+    def _zeros(self, blocks):
+        if not blocks:
+            return
+        if self.zeroDeflated is None:
+            self.zeroDeflated = _deflateBlock(self.zeroBlock, self.level)
+        length = blocks * self.blockSize
+        self.zeroRun += length
+        self.size += length
+        # Emit in bounded chunks so huge holes do not build huge strings
+        step = max(1, 1048576 / len(self.zeroDeflated))
+        while blocks:
+            count = min(blocks, step)
+            self._queue(_Done(self.zeroDeflated * count))
+            blocks -= count
+
+    def close(self):
+        try:
+            self._flushZeros()
+            while self.pending:
+                self._write(self.pending.popleft().get())
+            self.pool.close()
+        except:
+            self.abort()
+            raise
+        self.pool.join()
+        self._write(_DEFLATE_END)
+        self._write(struct.pack('<II', self.crc & 0xffffffff,
+            self.size & 0xffffffff))
+        return self.stats
+
+    def abort(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def gzipStream(inFile, outFile, level=6, workers=None,
+        blockSize=BLOCK_SIZE):
+    """
+    Compress everything read from C{inFile} into C{outFile} as a single gzip
+    member, using C{workers} threads (default one per CPU). Returns a
+    L{CompressStats}.
+    """
+    start = time.time()
+    writer = GzipWriter(outFile, level, workers, blockSize)
+    try:
+        while True:
+            data = inFile.read(blockSize * 8)
+            if not data:
+                break
+            writer.write(data)
+    except:
+        writer.abort()
+        raise
+    stats = writer.close()
+    stats.elapsed = time.time() - start
+    return stats
+
+
+def gzipSparseFile(inFile, outFile, level=6, workers=None,
+        blockSize=BLOCK_SIZE, start=0, end=None):
+    """
+    Like L{gzipStream}, but C{inFile} must be a regular file. Holes found
+    with SEEK_DATA/SEEK_HOLE are compressed without being read. Only the
+    range from C{start} to C{end} (default the end of the file) is
+    compressed.
+    """
+    startTime = time.time()
+    writer = GzipWriter(outFile, level, workers, blockSize)
+    try:
+        for offset, length, isData in sparsefile.iterExtents(inFile, start,
+                end):
+            if not isData:
+                writer.writeZeros(length)
+                continue
+            inFile.seek(offset)
+            while length:
+                data = inFile.read(min(length, blockSize * 8))
+                if not data:
+                    raise IOError("File %s shrank while compressing" %
+                            (inFile.name,))
+                writer.write(data)
+                length -= len(data)
+    except:
+        writer.abort()
+        raise
+    stats = writer.close()
+    stats.elapsed = time.time() - startTime
+    return stats
+
+
+def _externalCommand(codec, level, workers):
+    if codec == ZSTD:
+        return ['zstd', '-q', '-%d' % level, '-T%d' % workers, '-c']
+    return ['xz', '-%d' % level, '-T%d' % workers, '-c']
+
+
+def compressStream(inFile, outFile, codec=GZIP, level=None, workers=None,
+        sparse=False):
+    """
+    Compress everything read from C{inFile} into C{outFile} with C{codec}
+    and return a L{CompressStats}. If C{sparse} is set, C{inFile} is a
+    regular file whose holes can be skipped.
+    """
+    level = _checkCodec(codec, level)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if codec == GZIP:
+        if sparse:
+            return gzipSparseFile(inFile, outFile, level=level,
+                    workers=workers)
+        return gzipStream(inFile, outFile, level=level, workers=workers)
+    start = time.time()
+    cmd = _externalCommand(codec, level, workers)
+    outFile.flush()
+    proc = subprocess.Popen(cmd, stdin=inFile, stdout=outFile,
+            close_fds=True)
+    rv = proc.wait()
+    if rv:
+        raise CommandError(cmd, rv, '', '')
+    stats = CompressStats()
+    st = os.fstat(inFile.fileno())
+    if stat.S_ISREG(st.st_mode):
+        stats.dataBytes = st.st_size
+    stats.compressedBytes = os.fstat(outFile.fileno()).st_size
+    stats.elapsed = time.time() - start
+    return stats
+
+
+def compressFile(source, dest, codec=GZIP, level=None, workers=None):
+    """
+    Compress the file C{source} into C{dest} and return a L{CompressStats}.
+    Holes in C{source} are skipped rather than read.
+    """
+    with open(source, 'rb') as inFile:
+        with artifacts.ArtifactFile(dest) as outFile:
+            stats = compressStream(inFile, outFile, codec, level, workers,
+                    sparse=True)
+    log.info("Compressed %s with %s: %s", source, codec, stats)
+    return stats
+
+
+def compressTree(parDir, targetDir, dest, codec=GZIP, level=None,
+        workers=None, tarArgs=()):
+    """
+    Archive C{targetDir} (relative to C{parDir}) with tar and compress the
+    archive into C{dest}. C{tarArgs} are passed to tar in addition to C{-c}.
+    """
+    start = time.time()
+    cmd = ['tar', '-C', parDir, '-c'] + list(tarArgs) + ['--', targetDir]
+    log.debug("+ %s", ' '.join(cmd))
+    tar = subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=True)
+    try:
+        with artifacts.ArtifactFile(dest) as outFile:
+            stats = compressStream(tar.stdout, outFile, codec, level,
+                    workers)
+    except:
+        tar.kill()
+        tar.wait()
+        raise
+    tar.stdout.close()
+    rv = tar.wait()
+    if rv:
+        raise CommandError(cmd, rv, '', '')
+    log.info("Compressed %s with %s: %s", targetDir, codec, stats)
+    return stats
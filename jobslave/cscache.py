@@ -0,0 +1,167 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Cache of changeset files shared by every job on a build node.
+
+Each file is stored under the SHA-1 of a key describing what it holds, such
+as the troves of an update job. Jobs get hardlinks to the stored files, so
+deleting their copies leaves the cache intact. Callers run L{evict} once they
+are done fetching, which removes the least recently used files once the
+cache has grown past its size limit.
+
+Several jobs may share the cache at once. Fetching a key holds a lock on the
+bucket of keys whose hashes share its first two digits, so only one job
+downloads it and the others wait for the result, and a shared lock on the
+whole cache. Bucket locks keep the number of lock files bounded. Eviction takes the cache lock exclusively so
+nothing it removes is in the middle of being linked out.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+
+from conary.lib import util
+
+from jobslave.gencslist import _linkOrCopyFile
+from jobslave.util import lockFile
+
+log = logging.getLogger(__name__)
+
+
+def jobKey(job):
+    """
+    Return the cache key for the changeset of C{job}, a list of trove jobs.
+    """
+    lines = []
+    for name, (oldVersion, oldFlavor), (newVersion, newFlavor), absolute \
+            in sorted(job):
+        lines.append(' '.join([name,
+            oldVersion and oldVersion.asString() or '-',
+            oldFlavor is not None and oldFlavor.freeze() or '-',
+            newVersion and newVersion.asString() or '-',
+            newFlavor is not None and newFlavor.freeze() or '-',
+            str(int(bool(absolute)))]))
+    return '\n'.join(lines)
+
+
+class ChangesetCache(object):
+    """
+    Node-wide store of changeset files under C{path}, holding at most
+    C{maxSize} bytes (no limit if C{None}).
+    """
+
+    def __init__(self, path, maxSize=None):
+        self.path = path
+        self.maxSize = maxSize
+        self.objectDir = os.path.join(path, 'objects')
+        self.lockDir = os.path.join(path, 'locks')
+        self.tmpDir = os.path.join(path, 'tmp')
+        self.lockPath = os.path.join(path, 'lock')
+        self.hits = self.misses = 0
+        self._ready = False
+
+    def _setup(self):
+        if self._ready:
+            return
+        for path in (self.objectDir, self.lockDir, self.tmpDir):
+            util.mkdirChain(path)
+        self._ready = True
+
+    def _hashKey(self, key):
+        return hashlib.sha1(key).hexdigest()
+
+    def _objectPath(self, keyHash):
+        return os.path.join(self.objectDir, keyHash[:2], keyHash)
+
+    def _keyLockPath(self, keyHash):
+        return os.path.join(self.lockDir, keyHash[:2])
+
+    def fetch(self, key, dest, download):
+        """
+        Put the file cached under C{key} at C{dest}. If it is not cached yet,
+        C{download} is called with a path to create it at first. Returns
+        C{True} if the file was already cached.
+        """
+        self._setup()
+        keyHash = self._hashKey(key)
+        path = self._objectPath(keyHash)
+        with lockFile(self._keyLockPath(keyHash), fcntl.LOCK_EX):
+            with lockFile(self.lockPath, fcntl.LOCK_SH):
+                if os.path.exists(path):
+                    # Mark as recently used
+                    os.utime(path, None)
+                    _linkOrCopyFile(path, dest)
+                    self.hits += 1
+                    return True
+
+            fd, tmpPath = tempfile.mkstemp(dir=self.tmpDir)
+            os.close(fd)
+            try:
+                download(tmpPath)
+                os.chmod(tmpPath, 0644)
+                with lockFile(self.lockPath, fcntl.LOCK_SH):
+                    util.mkdirChain(os.path.dirname(path))
+                    os.rename(tmpPath, path)
+                    _linkOrCopyFile(path, dest)
+            finally:
+                if os.path.exists(tmpPath):
+                    os.unlink(tmpPath)
+            self.misses += 1
+        return False
+
+    def forget(self, key):
+        """
+        Remove the file stored for C{key}, for instance because it turned
+        out to be stale. Links to it already handed out are unaffected.
+        """
+        self._setup()
+        keyHash = self._hashKey(key)
+        with lockFile(self.lockPath, fcntl.LOCK_SH):
+            util.removeIfExists(self._objectPath(keyHash))
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits in
+        C{maxSize}.
+        """
+        if self.maxSize is None:
+            return
+        self._setup()
+        with lockFile(self.lockPath, fcntl.LOCK_EX):
+            objects = []
+            total = 0
+            for dirPath, dirNames, fileNames in os.walk(self.objectDir):
+                for fileName in fileNames:
+                    path = os.path.join(dirPath, fileName)
+                    st = os.stat(path)
+                    objects.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+            if total <= self.maxSize:
+                return
+            objects.sort()
+            removed = 0
+            for mtime, size, path in objects:
+                if total <= self.maxSize:
+                    break
+                os.unlink(path)
+                total -= size
+                removed += 1
+            log.info("Evicted %d files from changeset cache %s",
+                    removed, self.path)
@@ -19,6 +19,7 @@ from conary import files
 from conary.lib import util
 from conary.repository.changeset import ChangeSetFromFile
 
+import multiprocessing
 import os
 
 
@@ -37,32 +38,250 @@ def sortMountPoints(mounts):
     return mounts
 
 
-def calculatePartitionSizes(uJob, mounts):
+class MountIndex(object):
+    """
+    Map paths to the most specific mount point containing them by walking up
+    the path's parent directories, instead of scanning every mount.
+    """
+
+    def __init__(self, mounts):
+        self.mounts = set(util.normpath(x) for x in mounts)
+        self._cache = {}
+
+    def find(self, path):
+        try:
+            return self._cache[path]
+        except KeyError:
+            pass
+        found = None
+        current = path
+        while True:
+            if current in self.mounts:
+                found = current
+                break
+            parent = os.path.dirname(current)
+            if parent == current:
+                break
+            current = parent
+        self._cache[path] = found
+        return found
+
+
+def calculatePartitionSizes(uJob, mounts, workers=1):
     """
     Iterate over every file in a C{changeSet} and return a sum of the
     sizes for each mount in C{mounts}.
+
+    Each changeset is reduced to a table of space used per directory, which
+    is cached in memory so it can be reused by later calls with different
+    mount points. Changesets not found in the cache are read in this process
+    unless C{workers} is more than one, in which case a pool of that many
+    processes is forked. Forking while other threads hold locks can leave a
+    worker deadlocked, so only use a pool from a process that has no
+    background threads running.
+    """
+    usage = calculatePartitionUsage(uJob, mounts, workers=workers)
+    sizes = dict((x.mount, x.legacySize) for x in usage.itervalues())
+    return sizes, sum(sizes.values())
+
+
+class MountUsage(object):
+    """
+    Space and inodes needed by the contents of one mount point. Block counts
+    are in units of L{BLOCK_SIZE}.
+    """
+
+    def __init__(self, mount, legacySize=0):
+        self.mount = mount
+        # Regular file sizes rounded up to the next block, plus one block
+        # for files that are already aligned. Used by the legacy model.
+        self.legacySize = legacySize
+        # Blocks of file data and of symlink targets too long to be stored
+        # in the inode
+        self.dataBlocks = 0
+        # Indirect blocks needed to map file data without extents
+        self.mapBlocks = 0
+        # Non-directory inodes
+        self.files = 0
+        self.directories = 0
+        # Blocks of directory entries
+        self.dirBlocks = 0
+
+    def __repr__(self):
+        return ('<MountUsage %s: %d data + %d map + %d dir blocks, '
+                '%d files, %d directories>' % (self.mount, self.dataBlocks,
+                    self.mapBlocks, self.dirBlocks, self.files,
+                    self.directories))
+
+
+def calculatePartitionUsage(uJob, mounts, workers=1):
+    """
+    Return a L{MountUsage} for each mount in C{mounts} describing the files,
+    directories and blocks that the update job will install there.
     """
     mounts = sortMountPoints(mounts)
-    sizes = dict.fromkeys(mounts, 0)
+    tables = _getDirectorySizes(uJob.getJobsChangesetList(), workers=workers)
 
-    for csPath in uJob.getJobsChangesetList():
-        cs = ChangeSetFromFile(csPath)
-        for trvCs in cs.iterNewTroveList():
-            _processTrove(cs, trvCs, mounts, sizes)
-    return sizes, sum(sizes.values())
+    # Merge the per-changeset tables
+    merged = {}
+    for table in tables:
+        for dirName, rec in table.iteritems():
+            cur = merged.get(dirName)
+            if cur is None:
+                merged[dirName] = list(rec)
+            else:
+                for n, value in enumerate(rec):
+                    cur[n] += value
+
+    # Directories that only exist implicitly as parents of other paths still
+    # need an inode and an entry in their own parent.
+    allDirs = set()
+    for dirName in merged.keys():
+        while dirName and dirName not in allDirs:
+            allDirs.add(dirName)
+            parent = os.path.dirname(dirName)
+            if parent == dirName:
+                break
+            dirName = parent
+    for dirName in allDirs:
+        parent = os.path.dirname(dirName)
+        if parent == dirName:
+            continue
+        rec = merged.setdefault(parent, [0] * REC_SIZE)
+        rec[REC_NAMEBYTES] += _direntSize(os.path.basename(dirName))
+
+    index = MountIndex(mounts)
+    usage = dict((x, MountUsage(x)) for x in mounts)
+    for dirName, rec in merged.iteritems():
+        mount = index.find(dirName)
+        if mount is None:
+            continue
+        u = usage[mount]
+        u.legacySize += rec[REC_LEGACY]
+        u.dataBlocks += rec[REC_DATA]
+        u.mapBlocks += rec[REC_MAP]
+        u.files += rec[REC_FILES]
+        u.directories += 1
+        # "." and ".." take 24 bytes
+        u.dirBlocks += max(1, (rec[REC_NAMEBYTES] + 24 + BLOCK_SIZE - 1)
+                / BLOCK_SIZE)
+    return usage
 
 
-def _processTrove(changeSet, trvCs, mounts, sizes):
+BLOCK_SIZE = 4096
+# Block pointers per indirect block
+ADDR_PER_BLOCK = BLOCK_SIZE / 4
+# Symlink targets shorter than this are stored in the inode itself
+FAST_SYMLINK_MAX = 60
+
+# Layout of the per-directory records in the changeset tables
+REC_LEGACY, REC_DATA, REC_MAP, REC_FILES, REC_NAMEBYTES = range(5)
+REC_SIZE = 5
+
+_sizeCache = {}
+
+
+def _cacheKey(csPath):
+    # Changesets are written once and never modified in place, so the file's
+    # identity stands in for its contents without reading it again
+    st = os.stat(csPath)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+def _getDirectorySizes(csList, workers=1):
+    keys = [_cacheKey(x) for x in csList]
+    results = [_sizeCache.get(x) for x in keys]
+    missing = [n for n, x in enumerate(results) if x is None]
+    workers = min(workers, len(missing))
+    paths = [csList[n] for n in missing]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            computed = pool.map(_sizeChangeSet, paths, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        computed = [_sizeChangeSet(x) for x in paths]
+
+    for n, dirSizes in zip(missing, computed):
+        results[n] = dirSizes
+    for key, dirSizes in zip(keys, results):
+        _sizeCache[key] = dirSizes
+    return results
+
+
+def _sizeChangeSet(csPath):
+    """
+    Return a dictionary mapping each directory in changeset C{csPath} to a
+    record of the blocks, inodes and directory entries used by the files
+    directly inside it.
+    """
+    dirSizes = {}
+    cs = ChangeSetFromFile(csPath)
+    for trvCs in cs.iterNewTroveList():
+        _processTrove(cs, trvCs, dirSizes)
+    return dirSizes
+
+
+def _processTrove(changeSet, trvCs, dirSizes):
 
     for pathId, path, fileId, fVer in trvCs.getNewFileList():
         fStr = changeSet.getFileChange(None, fileId)
         fObj = files.frozenFileContentInfo(fStr)
 
+        legacy = blocks = mapBlocks = 0
         if type(fObj) == files.RegularFileStream:
-            for mount in mounts:
-                if path.startswith(mount):
-                    blockSize = 4096
-                    realSize = fObj.size()
-                    nearestBlock = (realSize / blockSize + 1) * blockSize
-                    sizes[mount] += nearestBlock
-                    break
+            realSize = fObj.size()
+            legacy = (realSize / BLOCK_SIZE + 1) * BLOCK_SIZE
+            blocks = (realSize + BLOCK_SIZE - 1) / BLOCK_SIZE
+            mapBlocks = _indirectBlocks(blocks)
+        else:
+            fObj = files.ThawFile(fStr, pathId)
+            if isinstance(fObj, files.Directory):
+                dirSizes.setdefault(path, [0] * REC_SIZE)
+                continue
+            if (isinstance(fObj, files.SymbolicLink)
+                    and len(fObj.target()) >= FAST_SYMLINK_MAX):
+                blocks = 1
+
+        dirName, baseName = os.path.split(path)
+        rec = dirSizes.setdefault(dirName, [0] * REC_SIZE)
+        rec[REC_LEGACY] += legacy
+        rec[REC_DATA] += blocks
+        rec[REC_MAP] += mapBlocks
+        rec[REC_FILES] += 1
+        rec[REC_NAMEBYTES] += _direntSize(baseName)
+
+
+def _direntSize(name):
+    # ext2 directory entry: 8 byte header plus the name, padded to 4 bytes
+    return (8 + len(name) + 3) & ~3
+
+
+def _indirectBlocks(blocks):
+    """
+    Return the number of indirect blocks an ext2/ext3 inode needs to map
+    C{blocks} data blocks.
+    """
+    # 12 direct pointers in the inode
+    blocks -= 12
+    if blocks <= 0:
+        return 0
+    # single indirect
+    count = 1
+    blocks -= ADDR_PER_BLOCK
+    if blocks <= 0:
+        return count
+    # double indirect
+    n = min(blocks, ADDR_PER_BLOCK ** 2)
+    count += 1 + (n + ADDR_PER_BLOCK - 1) / ADDR_PER_BLOCK
+    blocks -= ADDR_PER_BLOCK ** 2
+    if blocks <= 0:
+        return count
+    # triple indirect
+    l2 = (blocks + ADDR_PER_BLOCK - 1) / ADDR_PER_BLOCK
+    return count + 1 + (l2 + ADDR_PER_BLOCK - 1) / ADDR_PER_BLOCK + l2
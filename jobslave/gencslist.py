@@ -36,9 +36,9 @@ def _linkOrCopyFile(src, dest):
                 # if the file already exists, unlink and try again
                 os.unlink(dest)
                 continue
-            # if we're attempting to make a cross-device link,
-            # fall back to copy.
-            if msg.errno != errno.EXDEV:
+            # if we're attempting to make a cross-device link, or
+            # hardlinks are not allowed here, fall back to copy.
+            if msg.errno not in (errno.EXDEV, errno.EPERM):
                 # otherwise re-raise the unhandled exception, something
                 # else went wrong.
                 raise
@@ -54,13 +54,16 @@ def _linkOrCopyFile(src, dest):
 
 
 class CsCache(TroveBucket):
-    __slots__ = ('client', 'cacheDir', 'changesetVersion')
+    __slots__ = ('client', 'cacheDir', 'changesetVersion', 'store')
 
-    def __init__(self, client, groupcs, cacheDir=None, changesetVersion=None):
+    def __init__(self, client, groupcs, cacheDir=None, changesetVersion=None,
+            store=None):
         self.client = client
         self.cacheDir = cacheDir or ''
         self.groupcs = groupcs
         self.changesetVersion = changesetVersion
+        # Node-wide cscache.ChangesetCache, used instead of cacheDir if set
+        self.store = store
 
     def _getCacheFilename(self, name, version, flavor, compNames):
         # hash the version and flavor to give a unique filename
@@ -114,14 +117,15 @@ class CsCache(TroveBucket):
         return True
 
     def _downloadChangeSet(self, name, version, flavor, compNames,
-                           callback=None, num=0, total=0):
+                           callback=None, num=0, total=0, fn=None):
         csRequest = [(name, (None, None), (version, flavor), True)]
         csRequest += ((x, (None, None), (version, flavor), True)
                       for x in compNames)
 
-        # create the cs to a temp file
-        fd, fn = tempfile.mkstemp(dir=self.cacheDir)
-        os.close(fd)
+        if fn is None:
+            # create the cs to a temp file
+            fd, fn = tempfile.mkstemp(dir=self.cacheDir)
+            os.close(fd)
 
         if callback:
             callback.setChangeSet(name)
@@ -137,12 +141,35 @@ class CsCache(TroveBucket):
 
         return fn
 
-    def getCs(self, trv, callback=None, num=0, total=0):
+    def _getStoredCs(self, trv, dest, compNames, callback, num, total):
+        key = '\n'.join([trv.name, trv.version.asString(), trv.flavor.freeze(),
+            ' '.join(compNames), str(self.changesetVersion)])
+
+        def download(path):
+            self._downloadChangeSet(trv.name, trv.version, trv.flavor,
+                    compNames, callback=callback, num=num, total=total,
+                    fn=path)
+
+        if (self.store.fetch(key, dest, download) and
+                not self._validateChangeSet(dest, trv.name, trv.version,
+                    trv.flavor, compNames)):
+            # Invalidate changeset
+            self.store.forget(key)
+            self.store.fetch(key, dest, download)
+
+    def getCs(self, trv, dest, callback=None, num=0, total=0):
+        """
+        Write the changeset for C{trv} to C{dest}, from the cache if possible.
+        """
         if not trv.isGroup() and not trv.isComponent():
             compNames = [ x.name for x in trv.getChildren() ]
         else:
             compNames = []
 
+        if self.store:
+            return self._getStoredCs(trv, dest, compNames, callback, num,
+                    total)
+
         cacheName = self._getCacheFilename(trv.name, trv.version,
                                             trv.flavor, compNames)
         cachePath = os.path.join(self.cacheDir, cacheName)
@@ -150,7 +177,8 @@ class CsCache(TroveBucket):
         if (os.path.exists(cachePath) and 
             self._validateChangeSet(cachePath, trv.name, trv.version,
                                     trv.flavor, compNames)):
-            return cachePath
+            _linkOrCopyFile(cachePath, dest)
+            return
 
         # Invalidate changeset
         if os.path.exists(cachePath):
@@ -162,24 +190,26 @@ class CsCache(TroveBucket):
                                      total=total)
 
         if not self.cacheDir:
-            return fn
+            _linkOrCopyFile(fn, dest)
+            os.unlink(fn)
+            return
 
         os.rename(fn, cachePath)
         os.chmod(cachePath, 0644)
-
-        return cachePath
+        _linkOrCopyFile(cachePath, dest)
 
 
 class TreeGenerator(TroveBucket):
     __slots__ = ('client', 'cacheDir', 'cscache', 'cslist', 'pkgorder',
-                 'changesetVersion', '_cslist')
+                 'changesetVersion', '_cslist', 'store')
 
     def __init__(self, cfg, client, topGroup, cacheDir=None, 
-                 clientVersion=None):
+                 clientVersion=None, store=None):
         TroveBucket.__init__(self, cfg)
         self.client = client
         self.topGroup = topGroup
         self.cacheDir = cacheDir
+        self.store = store
 
         self.cscache = None
         self.pkgorder = None
@@ -204,7 +234,8 @@ class TreeGenerator(TroveBucket):
         # Get a cscache as soon as possible.
         self.cscache = CsCache(self.client, self.groupcs,
                                cacheDir=self.cacheDir,
-                               changesetVersion=self.changesetVersion)
+                               changesetVersion=self.changesetVersion,
+                               store=self.store)
 
     def _orderValidTroves(self, jobs):
         trvList = []
@@ -319,13 +350,8 @@ class TreeGenerator(TroveBucket):
 
             csPath = os.path.join(csdir, csfile)
 
-            cachefn = self.cscache.getCs(trv, callback=callback, num=num,
-                                         total=total)
-
-            _linkOrCopyFile(cachefn, csPath)
-
-            if not self.cacheDir:
-                os.unlink(cachefn)
+            self.cscache.getCs(trv, csPath, callback=callback, num=num,
+                               total=total)
 
     def writeCsList(self, path):
         csListFile = os.path.join(path, 'cslist')
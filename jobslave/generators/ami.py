@@ -39,7 +39,10 @@ class AMIImage(raw_hd_image.RawHdImage):
         vmdkImage = os.path.join(self.workDir, self.basefilename + '.vmdk')
         vmware_image.createVMDK(image, vmdkImage, disk.totalSize,
                 geometry=self.geometry, adapter='lsilogic', hwVersion=10,
-                streaming=True)
+                streaming=True, threads=0,
+                level=self.getBuildData('vmdkCompressionLevel'),
+                writer=self.getBuildData('vmdkWriter'),
+                verify=self.getBuildData('vmdkVerify'))
 
         self.outputFileList.append((vmdkImage, 'VMDK Disk Image'),)
         self.postOutput(self.outputFileList, attributes={
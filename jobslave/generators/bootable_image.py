@@ -18,22 +18,27 @@
 # python standard library imports
 import itertools
 import logging
-from math import ceil
 import os
 import sys
 import re
 import signal
 import stat
 import subprocess
+import tempfile
+import threading
 import time
 from collections import namedtuple
+from contextlib import contextmanager
 
 # mint imports
 from jobslave import filesystems
 from jobslave import generators
 from jobslave import helperfuncs
 from jobslave import loophelpers
+from jobslave import sizemodels
 from jobslave import buildtypes
+from jobslave import compress
+from jobslave import cscache
 from jobslave.distro_detect import is_RH, is_SUSE, is_UBUNTU
 from jobslave.filesystems import sortMountPoints
 from jobslave.geometry import GEOMETRY_REGULAR
@@ -43,6 +48,7 @@ from jobslave.util import logCall, parseSize
 
 # conary imports
 from conary import conaryclient
+from conary import constants as conaryConstants
 from conary import dbstore
 from conary import display
 from conary.conaryclient import modelupdate
@@ -56,6 +62,14 @@ log = logging.getLogger(__name__)
 RPM_ALTERNATES = '/opt'
 RPM_DOTS = re.compile('^(.*)[._]')
 
+DB_PAGE_SIZE = 4096
+# Per-session pragmas for every conary database the jobslave opens; an
+# install adds the configured conarydbPragmas on top
+DB_PRAGMAS = {
+        'cache_size': '200000',
+        'journal_mode': 'MEMORY',
+        }
+
 FsRequest = namedtuple('FsRequest', 'name mount fstype minSize freeSpace')
 
 
@@ -69,6 +83,18 @@ def timeMe(func):
         return returner
     return wrapper
 
+@contextmanager
+def timePhase(timings, name):
+    """
+    Accumulate the wall-clock time spent in the enclosed block under
+    C{name} in the dict C{timings}.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.time() - start
+
 def copyfile(source, target):
     if not os.path.exists(target):
         return util.copyfile(source, target)
@@ -94,25 +120,32 @@ def copytree(source, dest, exceptions=None):
 
 class InstallCallback(UpdateCallback):
     def restoreFiles(self, size, totalSize):
+        self.setPhase('restore')
         if totalSize != 0:
             self.restored += size
+            self.restoredTotal += size
             self.update('Writing files')
 
     def requestingChangeSet(self):
+        self.setPhase('download')
         self.update('Requesting changeset')
 
     def downloadingChangeSet(self, got, need):
+        self.setPhase('download')
         if need != 0:
             self.update('Downloading changeset')
 
     def requestingFileContents(self):
+        self.setPhase('download')
         self.update('Requesting file contents')
 
     def downloadingFileContents(self, got, need):
+        self.setPhase('download')
         if need != 0:
             self.update('Downloading files')
 
     def preparingChangeSet(self):
+        self.setPhase('prepare')
         self.update('Preparing changeset')
 
     def resolvingDependencies(self):
@@ -122,15 +155,59 @@ class InstallCallback(UpdateCallback):
         self.update('Creating rollback')
 
     def creatingDatabaseTransaction(self, troveNum, troveCount):
+        self.setPhase('db transaction')
         self.update('Creating database transaction')
 
     def committingTransaction(self):
+        self.setPhase('db commit')
         self.update('Committing transaction')
 
+    def setPhase(self, phase):
+        """
+        Charge the time since the last call to the phase named then, and
+        start timing C{phase}.
+        """
+        now = time.time()
+        if self.phase is not None:
+            self.timings[self.phase] = (self.timings.get(self.phase, 0)
+                    + now - self.phaseStart)
+        self.phase = phase
+        self.phaseStart = now
+
+    def phaseTimings(self):
+        """
+        Return the seconds spent in each phase of the install so far.
+        """
+        self.setPhase(None)
+        return dict(self.timings)
+
     def setUpdateHunk(self, num, total):
+        self.setPhase(None)
+        if self.pipeline:
+            # Hunks are applied as soon as their changeset is downloaded
+            self.pipeline.waitFor(num)
+        if self.applyStart is None:
+            self.applyStart = time.time()
         self.updateHunk = (num, total)
         self.restored = 0
 
+    def rates(self):
+        """
+        Return the rates in bytes per second at which changesets were
+        downloaded by the pipeline and files restored from them.
+        """
+        download = restore = 0
+        waitTime = 0
+        if self.pipeline:
+            if self.pipeline.downloadTime:
+                download = self.pipeline.downloaded / self.pipeline.downloadTime
+            waitTime = self.pipeline.waitTime
+        if self.applyStart is not None:
+            busy = time.time() - self.applyStart - waitTime
+            if busy > 0:
+                restore = self.restoredTotal / busy
+        return download, restore
+
     def setUpdateJob(self, jobs):
         log.info("Applying update job %d of %d:" % self.updateHunk)
         self.formatter.prepareJobs(jobs)
@@ -141,6 +218,9 @@ class InstallCallback(UpdateCallback):
         curTime = time.time()
         # only push an update into the database if it differs from the
         # current message
+        if self.pipeline:
+            msg += ", download %.1f MB/s, restore %.1f MB/s" % tuple(
+                    x / 1048576 for x in self.rates())
         if self.updateHunk[1] != 0:
             percent = (self.updateHunk[0] * 100) / self.updateHunk[1]
             msg = "Installing image contents: %d%% (%s)" % (percent, msg)
@@ -155,6 +235,12 @@ class InstallCallback(UpdateCallback):
         self.abortEvent = None
         self.status = status
         self.restored = 0
+        self.restoredTotal = 0
+        self.applyStart = None
+        self.pipeline = None
+        self.phase = None
+        self.phaseStart = None
+        self.timings = {}
         self.updateHunk = (0, 0)
         self.msg = ''
         self.changeset = ''
@@ -172,11 +258,103 @@ class InstallCallback(UpdateCallback):
         self.status = lambda x: None
 
 
+class ChangesetPipeline(object):
+    """
+    Download the C{count} changesets of an update job on a thread of its own
+    while they are applied, staying at most C{window} hunks ahead of the one
+    being applied. C{fetch} is called with each hunk's index to download it
+    and returns the path it was written to.
+    """
+
+    def __init__(self, fetch, count, window):
+        self.fetch = fetch
+        self.count = count
+        self.window = max(window, 1)
+        self.cond = threading.Condition()
+        self.ready = 0
+        self.applying = 0
+        self.stopped = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+        # Bytes downloaded and the time spent downloading them, and the time
+        # the install spent waiting on downloads
+        self.downloaded = 0
+        self.downloadTime = 0.0
+        self.waitTime = 0.0
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for num in range(self.count):
+                self.cond.acquire()
+                try:
+                    while (num >= self.applying + self.window
+                            and not self.stopped):
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                finally:
+                    self.cond.release()
+
+                start = time.time()
+                path = self.fetch(num)
+                elapsed = time.time() - start
+                size = os.stat(path).st_size
+
+                self.cond.acquire()
+                self.ready = num + 1
+                self.downloaded += size
+                self.downloadTime += elapsed
+                self.cond.notifyAll()
+                self.cond.release()
+        except:
+            self.cond.acquire()
+            self.error = sys.exc_info()
+            self.cond.notifyAll()
+            self.cond.release()
+
+    def waitFor(self, num):
+        """
+        Block until hunk C{num} (counting from 1) has been downloaded, and
+        let the download move on past the hunks before it. Re-raises the
+        error if the download failed.
+        """
+        self.cond.acquire()
+        try:
+            self.applying = num - 1
+            self.cond.notifyAll()
+            start = time.time()
+            while self.ready < num and self.error is None:
+                self.cond.wait()
+            self.waitTime += time.time() - start
+            if self.ready < num:
+                raise self.error[0], self.error[1], self.error[2]
+        finally:
+            self.cond.release()
+
+    def finish(self):
+        """
+        Stop downloading and re-raise any error the download ran into.
+        """
+        self.cond.acquire()
+        self.stopped = True
+        self.cond.notifyAll()
+        self.cond.release()
+        self.thread.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+
 class Filesystem(object):
     devPath = None
     offset = None
     mounted = False
     fsType = None
+    attached = 0
 
     def __init__(self, fsDev, fsType, size, offset=0, fsLabel=None,
             useLoop=True):
@@ -196,17 +374,45 @@ class Filesystem(object):
         self.fsType = fsType
         self.mountPoint = None
         self.uuid = None
+        self.timings = {}
+        self._mountTime = None
+
+    def phase(self, name):
+        """
+        Accumulate the wall-clock time spent in the enclosed block under
+        C{name} in C{self.timings}.
+        """
+        return timePhase(self.timings, name)
+
+    @contextmanager
+    def session(self):
+        """
+        Hold a single device attachment across format, mount, install and
+        unmount. Nested attach/detach calls inside the session reuse it.
+        """
+        self.attach()
+        try:
+            yield self
+        finally:
+            self.detach()
 
     def attach(self):
-        if self.useLoop:
-            self.devPath = loophelpers.loopAttach(self.fsDev,
-                    offset=self.offset, size=self.size)
-        else:
-            self.devPath = self.fsDev
+        if not self.attached:
+            with self.phase('attach'):
+                if self.useLoop:
+                    self.devPath = loophelpers.loopAttach(self.fsDev,
+                            offset=self.offset, size=self.size)
+                else:
+                    self.devPath = self.fsDev
+        self.attached += 1
 
     def detach(self):
+        self.attached = max(self.attached - 1, 0)
+        if self.attached:
+            return
         if self.useLoop:
-            loophelpers.loopDetach(self.devPath)
+            with self.phase('detach'):
+                loophelpers.loopDetach(self.devPath)
 
     def mount(self, mountPoint):
         if self.fsType in ('swap', 'none', 'unallocated'):
@@ -219,10 +425,12 @@ class Filesystem(object):
             # Turn off data integrity during install
             options.append('data=writeback,barrier=0')
         options = '-o %s' % (','.join(options)) if options else ''
-        logCall("mount -n -t %s %s %s %s" %
-                (fsType, self.devPath, mountPoint, options))
+        with self.phase('mount'):
+            logCall("mount -n -t %s %s %s %s" %
+                    (fsType, self.devPath, mountPoint, options))
         self.mounted = True
         self.mountPoint = mountPoint
+        self._mountTime = time.time()
 
     def umount(self):
         if self.fsType in ('swap', 'none', 'unallocated'):
@@ -231,6 +439,18 @@ class Filesystem(object):
         if not self.devPath or not self.mounted:
             return
 
+        if self._mountTime is not None:
+            self.timings['mounted'] = (self.timings.get('mounted', 0)
+                    + time.time() - self._mountTime)
+            self._mountTime = None
+
+        with self.phase('umount'):
+            self._umount()
+
+        self.detach()
+        self.mounted = False
+
+    def _umount(self):
         try:
             logCall("umount -n %s" % self.mountPoint)
         except RuntimeError:
@@ -258,37 +478,39 @@ class Filesystem(object):
 
                 raise RuntimeError('Failed to unmount %s' % self.devPath)
 
-        self.detach()
-        self.mounted = False
-
     def format(self):
         self.attach()
         try:
-            if self.fsType in ('ext3', 'ext4'):
-                cmd = ['mkfs.' + self.fsType,
-                        '-F',
-                        '-b', '4096',
-                        '-L', self.fsLabel,
-                        self.devPath]
-                if self.size:
-                    cmd.append(str(self.size / 4096))
-                logCall(cmd)
-                logCall(['tune2fs',
-                    '-i', '0',
-                    '-c', '0',
-                    self.devPath])
-            elif self.fsType == 'xfs':
-                logCall(['mkfs.xfs', '-L', self.fsLabel, self.devPath])
-            elif self.fsType == 'swap':
-                logCall(['mkswap', '-L', self.fsLabel, self.devPath])
-            elif self.fsType in ('none', 'unallocated'):
-                pass
-            else:
-                raise RuntimeError, "Invalid filesystem type: %s" % self.fsType
-            self._get_uuid()
+            with self.phase('format'):
+                self._format()
+            with self.phase('probe'):
+                self._get_uuid()
         finally:
             self.detach()
 
+    def _format(self):
+        if self.fsType in ('ext3', 'ext4'):
+            cmd = ['mkfs.' + self.fsType,
+                    '-F',
+                    '-b', '4096',
+                    '-L', self.fsLabel,
+                    self.devPath]
+            if self.size:
+                cmd.append(str(self.size / 4096))
+            logCall(cmd)
+            logCall(['tune2fs',
+                '-i', '0',
+                '-c', '0',
+                self.devPath])
+        elif self.fsType == 'xfs':
+            logCall(['mkfs.xfs', '-L', self.fsLabel, self.devPath])
+        elif self.fsType == 'swap':
+            logCall(['mkswap', '-L', self.fsLabel, self.devPath])
+        elif self.fsType in ('none', 'unallocated'):
+            pass
+        else:
+            raise RuntimeError, "Invalid filesystem type: %s" % self.fsType
+
     def _get_uuid(self):
         proc = subprocess.Popen(['/sbin/blkid', '-p',
                 '-s', 'UUID', '-o', 'value', self.devPath],
@@ -305,6 +527,13 @@ class StubFilesystem(object):
     def __init__(self):
         self.fsLabel = 'root'
         self.fsType = 'ext4'
+        self.timings = {}
+
+    def attach(self):
+        pass
+
+    def detach(self):
+        pass
 
     def mount(self, *args):
         pass
@@ -341,6 +570,7 @@ class BootableImage(ImageGenerator):
         self.bootloader = None
         self.outputFileList = []
         self.uJob = None
+        self.dbTimings = {}
         self.mountDict = self.getFilesystems() or self.getDefaultFilesystems()
 
         # List of devicePath (realative to the rootPath's /dev), device
@@ -387,6 +617,14 @@ class BootableImage(ImageGenerator):
         for mountPoint in mounts:
             self.filesystems[mountPoint].umount()
 
+    def logFilesystemTimings(self):
+        for mountPoint in reversed(sortMountPoints(self.filesystems.keys())):
+            timings = getattr(self.filesystems[mountPoint], 'timings', None)
+            if not timings:
+                continue
+            log.info("Filesystem %s: %s", mountPoint, ' '.join(
+                '%s=%.2fs' % x for x in sorted(timings.items())))
+
     def findFile(self, baseDir, fileName):
         for base, dirs, files in os.walk(baseDir):
             matches = sorted(x for x in files if re.match(fileName, x))
@@ -676,9 +914,11 @@ class BootableImage(ImageGenerator):
             os.symlink('.', self.filePath('boot/boot'))
         self.bootloader.install()
 
-    def downloadChangesets(self):
-        if self.uJob is not None:
-            return
+    def _prepareUpdateJob(self):
+        """
+        Return a client and the update job that installs the image contents
+        into an empty root.
+        """
         self.conarycfg.flavor = [self.baseFlavor]
         self.conarycfg.initializeFlavors()
         cclient = self._openClient(self.tempRoot)
@@ -689,13 +929,91 @@ class BootableImage(ImageGenerator):
         ts = cclient.cmlGraph(self.cml)
         cclient._updateFromTroveSetGraph(uJob, ts, tc)
         util.mkdirChain(self.changesetDir)
-        cclient.downloadUpdate(uJob, self.changesetDir)
+        return cclient, uJob
+
+    def downloadChangesets(self):
+        if self.uJob is not None:
+            return
+        cclient, uJob = self._prepareUpdateJob()
+        csCache = self.getChangesetCache()
+        if csCache:
+            self._fetchChangesets(cclient, uJob, csCache)
+        else:
+            cclient.downloadUpdate(uJob, self.changesetDir)
         self.uJob = uJob
 
+    def _changesetPaths(self, uJob):
+        return [os.path.join(self.changesetDir, '%d.ccs' % num)
+                for num in range(len(uJob.getJobs()))]
+
+    def _fetchChangeset(self, cclient, job, path, csCache, callback=None):
+        """
+        Download the changeset for C{job} to C{path}, through the changeset
+        cache if there is one.
+        """
+        def download(tmpPath):
+            cclient.repos.createChangeSetFile(job, tmpPath, recurse=False,
+                    callback=callback)
+        if csCache:
+            csCache.fetch(cscache.jobKey(job), path, download)
+        else:
+            download(path)
+
+    def _fetchChangesets(self, cclient, uJob, csCache):
+        """
+        Download the changesets of C{uJob} into C{changesetDir} like
+        C{downloadUpdate} does, taking those already fetched by an earlier
+        job on this node from the changeset cache.
+        """
+        callback = cclient.getUpdateCallback()
+        allJobs = uJob.getJobs()
+        csFiles = self._changesetPaths(uJob)
+        for num, (job, path) in enumerate(zip(allJobs, csFiles)):
+            callback.setUpdateHunk(num + 1, len(allJobs))
+            self._fetchChangeset(cclient, job, path, csCache, callback)
+        uJob.setJobsChangesetList(csFiles)
+        uJob.setChangesetsDownloaded(True)
+        log.info("Took %d of %d changesets from the cache", csCache.hits,
+                len(allJobs))
+        csCache.evict()
+
+    def _startPipeline(self):
+        """
+        Prepare the update job and start downloading its changesets in the
+        background, to be applied while later ones are still downloading.
+        """
+        cclient, uJob = self._prepareUpdateJob()
+        csCache = self.getChangesetCache()
+        allJobs = uJob.getJobs()
+        csFiles = self._changesetPaths(uJob)
+
+        def fetch(num):
+            self._fetchChangeset(cclient, allJobs[num], csFiles[num], csCache)
+            if csCache and num == len(allJobs) - 1:
+                # Changesets are fetched in order, so this was the last
+                csCache.evict()
+            return csFiles[num]
+
+        # The files are there by the time each hunk is applied
+        uJob.setJobsChangesetList(csFiles)
+        uJob.setChangesetsDownloaded(True)
+        pipeline = ChangesetPipeline(fetch, len(allJobs),
+                self.cfg.installPrefetch)
+        pipeline.start()
+        self.uJob = uJob
+        return pipeline
+
     @timeMe
     def getTroveSize(self, mounts):
         self.downloadChangesets()
-        return filesystems.calculatePartitionSizes(self.uJob, mounts)
+        return filesystems.calculatePartitionSizes(self.uJob, mounts,
+                workers=self.cfg.sizingWorkers)
+
+    @timeMe
+    def getTroveUsage(self, mounts):
+        self.downloadChangesets()
+        return filesystems.calculatePartitionUsage(self.uJob, mounts,
+                workers=self.cfg.sizingWorkers)
 
     def getDefaultFilesystems(self):
         freeSpace = (self.getBuildData("freespace") or 0) * 1048576
@@ -757,7 +1075,13 @@ class BootableImage(ImageGenerator):
 
     def getImageSize(self, realign=512):
         self.status("Calculating filesystem sizes...")
-        sizes, totalSize = self.getTroveSize(self.mountDict.keys())
+        legacy = self.getBuildData('filesystemSizing') == 'legacy'
+        if legacy:
+            sizes, totalSize = self.getTroveSize(self.mountDict.keys())
+            usages = dict((mount, filesystems.MountUsage(mount, size))
+                    for (mount, size) in sizes.iteritems())
+        else:
+            usages = self.getTroveUsage(self.mountDict.keys())
 
         swapMount = self.find_mount(self.swapPath)
         if any(x.fstype == 'swap' for x in self.mountDict.values()):
@@ -767,13 +1091,19 @@ class BootableImage(ImageGenerator):
         totalSize = 0
         realSizes = {}
         for req in self.mountDict.values():
-            neededSize = sizes.get(req.mount, 0) + req.freeSpace
+            usage = usages.get(req.mount) or filesystems.MountUsage(req.mount)
+            freeSpace = req.freeSpace
             # Add swap file to requested size
             if self.swapSize and req.mount == swapMount:
-                neededSize += self.swapSize
-            # pad size for real filesystems
-            if req.fstype not in ('swap', 'none', 'unallocated'):
-                neededSize = int(ceil((neededSize + 20 * 1024 * 1024) / 0.87))
+                freeSpace += self.swapSize
+            if req.fstype in ('swap', 'none', 'unallocated'):
+                neededSize = usage.legacySize + freeSpace
+            else:
+                # pad size for filesystem metadata
+                model = sizemodels.getModel(req.fstype, legacy=legacy)
+                neededSize = model.getSize(usage, freeSpace)
+                log.debug("Sized %s filesystem %s at %d bytes for %r",
+                        req.fstype, req.mount, neededSize, usage)
             size = max(req.minSize, neededSize)
             # realign to sector if requested
             if realign:
@@ -993,6 +1323,74 @@ class BootableImage(ImageGenerator):
                 raise RuntimeError(
                     'unable to kill chroot pids: %s' %(', '.join(pids)))
 
+    def mountChrootFilesystems(self):
+        self.createDirectory('proc')
+        self.createDirectory('sys')
+        logCall('mount -n -t proc none %s' % self.filePath('proc'))
+        logCall('mount -n -t sysfs none %s' % self.filePath('sys'))
+
+    def _getStagingRoot(self):
+        """
+        Return a directory to install troves into before copying them into
+        the image, or C{None} to install straight into it.
+        """
+        if not self.cfg.installStaging:
+            return None
+        mounted = [x for x in self.filesystems.values()
+                if getattr(x, 'mounted', False)]
+        if not mounted:
+            # Not installing onto image filesystems, so nothing to gain
+            return None
+
+        if self.cfg.stagingDir:
+            util.mkdirChain(self.cfg.stagingDir)
+            stage = tempfile.mkdtemp(dir=self.cfg.stagingDir, prefix='stage-')
+            # Scripts in the chroot see this as /, which mkdtemp made 0700
+            os.chmod(stage, 0755)
+            return stage
+
+        stage = os.path.join(self.workDir, 'stage')
+        util.mkdirChain(stage)
+        options = 'mode=0755'
+        size = sum(x.size or 0 for x in mounted)
+        if size:
+            options += ',size=%d' % size
+        try:
+            logCall('mount -n -t tmpfs -o %s none %s' % (options, stage))
+        except RuntimeError:
+            log.warning("Could not mount a tmpfs to stage the install in, "
+                    "installing into the image directly")
+            os.rmdir(stage)
+            return None
+        return stage
+
+    def _releaseStagingRoot(self, stage):
+        if not self.cfg.stagingDir:
+            logCall('umount -n %s' % stage)
+        util.rmtree(stage, ignore_errors=True)
+
+    @timeMe
+    def copyStagedRoot(self, stage, dest):
+        """
+        Copy the root installed in C{stage} into the image filesystems
+        mounted at C{dest}, and carry on with the install there.
+        """
+        self.status('Copying installed files into image')
+        # Nothing may be left running or mounted in the staging root
+        self.killChrootProcesses(stage)
+        self.umountChrootMounts(stage)
+
+        start = time.time()
+        entries = [os.path.join(stage, x) for x in sorted(os.listdir(stage))]
+        if entries:
+            # A single copy keeps hardlinks between entries intact
+            logCall(['cp', '-a'] + entries + [dest])
+        log.info("Copied staged install into image in %.1fs",
+                time.time() - start)
+
+        self.root = self.conarycfg.root = dest
+        self.mountChrootFilesystems()
+
     @timeMe
     def umountChrootMounts(self, dest):
         # umount all mounts inside the chroot.
@@ -1014,34 +1412,104 @@ class BootableImage(ImageGenerator):
         for mntpoint in reversed(sorted(mntlist)):
             logCall('umount -n %s' % mntpoint)
 
-    def _openClient(self, root):
-        self.conarycfg.root = root
+    def _createDb(self, path):
         # page_size has to be set before the first table is created
-        path = util.joinPaths(root, self.conarycfg.dbPath + '/conarydb')
-        util.mkdirChain(os.path.dirname(path))
         db = dbstore.connect(path, driver='sqlite')
         cu = db.cursor()
-        cu.execute("PRAGMA page_size = 4096")
+        cu.execute("PRAGMA page_size = %d" % DB_PAGE_SIZE)
         db.commit()
         cu.execute("VACUUM")
         db.commit()
         db.close()
 
-        # The rest are per-session and apply only to this install job
-        cclient = conaryclient.ConaryClient(self.conarycfg)
+    def _getDbTemplate(self):
+        """
+        Return the path to an empty conary database with the schema already
+        created, building it first if this node does not have one for the
+        running conary.
+        """
+        template = os.path.join(constants.dbTemplatePath, 'conarydb-%s-%d'
+                % (conaryConstants.version, DB_PAGE_SIZE))
+        if os.path.exists(template):
+            return template
+
+        util.mkdirChain(constants.dbTemplatePath)
+        tmpRoot = tempfile.mkdtemp(dir=constants.dbTemplatePath)
+        oldRoot = self.conarycfg.root
+        try:
+            path = util.joinPaths(tmpRoot, self.conarycfg.dbPath + '/conarydb')
+            util.mkdirChain(os.path.dirname(path))
+            self._createDb(path)
+            # Opening the database creates the schema
+            self.conarycfg.root = tmpRoot
+            conaryclient.ConaryClient(self.conarycfg).close()
+            os.rename(path, template)
+        finally:
+            self.conarycfg.root = oldRoot
+            util.rmtree(tmpRoot, ignore_errors=True)
+        return template
+
+    def _openClient(self, root, installPragmas=False):
+        """
+        Return a client for the conary database in C{root}, creating it if
+        needed. With C{installPragmas} the database is further tuned for a
+        bulk install and must be put back by L{_finishDb} before it ships.
+        """
+        self.conarycfg.root = root
+        path = util.joinPaths(root, self.conarycfg.dbPath + '/conarydb')
+        if not os.path.exists(path):
+            util.mkdirChain(os.path.dirname(path))
+            with timePhase(self.dbTimings, 'create'):
+                try:
+                    util.copyfile(self._getDbTemplate(), path)
+                except (IOError, OSError):
+                    log.exception("Failed to use conary database template, "
+                            "creating the database in place:")
+                    self._createDb(path)
+
+        with timePhase(self.dbTimings, 'open'):
+            cclient = conaryclient.ConaryClient(self.conarycfg)
         cclient.db.opJournalPath = None
-        db = cclient.db.db.db
-        cu = db.cursor()
-        cu.execute("PRAGMA cache_size = 200000")
-        cu.execute("PRAGMA journal_mode = MEMORY")
-        db.commit()
+
+        # The rest are per-session and apply only to this job
+        pragmas = dict(DB_PRAGMAS)
+        if installPragmas:
+            pragmas.update(self.cfg.conarydbPragmas)
+        with timePhase(self.dbTimings, 'pragmas'):
+            db = cclient.db.db.db
+            cu = db.cursor()
+            for name, value in sorted(pragmas.items()):
+                cu.execute("PRAGMA %s = %s" % (name, value))
+            db.commit()
         return cclient
 
+    def _finishDb(self, cclient):
+        """
+        Move everything written to the database in C{cclient}'s root into the
+        main file and put it back in rollback journal mode, so the image
+        carries a plain database.
+        """
+        with timePhase(self.dbTimings, 'checkpoint'):
+            db = cclient.db.db.db
+            cu = db.cursor()
+            cu.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            cu.execute("PRAGMA journal_mode = DELETE")
+            db.commit()
+
     @timeMe
     def installFileTree(self, dest, bootloader_override=None,
             no_mbr=False):
-        self.downloadChangesets()
-        self.root = dest
+        stage = self._getStagingRoot()
+        # Troves are installed here, then copied to dest if staging
+        installRoot = stage or dest
+        pipeline = None
+        if self.uJob is None and self.cfg.installPrefetch:
+            # Nothing needed the whole update job up front, so install each
+            # hunk as soon as it has downloaded
+            pipeline = self._startPipeline()
+        else:
+            self.downloadChangesets()
+        self.root = installRoot
         self.status('Installing image contents')
         self.loadRPM()
 
@@ -1051,21 +1519,18 @@ class BootableImage(ImageGenerator):
         else:
             log.warning("Using system temporary directory")
 
-        self.conarycfg.root = dest
+        self.conarycfg.root = installRoot
         self.conarycfg.installLabelPath = [self.baseVersion.trailingLabel()]
         self.conarycfg.configLine("pinTroves " + self.getPins())
         try:
-            self.createDirectory('proc')
-            self.createDirectory('sys')
-            logCall('mount -n -t proc none %s' % os.path.join(dest, 'proc'))
-            logCall('mount -n -t sysfs none %s' % os.path.join(dest, 'sys'))
-
+            self.mountChrootFilesystems()
             self.preInstallScripts()
 
             callback = None
-            cclient = self._openClient(dest)
+            cclient = self._openClient(installRoot, installPragmas=True)
             try:
                 callback = InstallCallback(self.status)
+                callback.pipeline = pipeline
                 cclient.setUpdateCallback(callback)
 
                 # Tell SLES RPM scripts that we're building a fresh system
@@ -1076,11 +1541,30 @@ class BootableImage(ImageGenerator):
 
                 del os.environ['YAST_IS_RUNNING']
 
+                self._finishDb(cclient)
+                timings = callback.phaseTimings()
+                timings.update(('db %s' % x, y)
+                        for x, y in self.dbTimings.items())
+                log.info("Install phases: %s", ', '.join('%s %.1fs' % x
+                    for x in sorted(timings.items())))
+
+                if pipeline:
+                    log.info("Downloaded changesets at %.1f MB/s, "
+                            "restored files at %.1f MB/s" % tuple(
+                                x / 1048576 for x in callback.rates()))
+
             finally:
-                cclient.close()
-                if callback:
-                    callback.closeCB()
-                cclient = callback = None
+                try:
+                    cclient.close()
+                    if callback:
+                        callback.closeCB()
+                    cclient = callback = None
+                finally:
+                    if pipeline:
+                        pipeline.finish()
+
+            if stage:
+                self.copyStagedRoot(stage, dest)
 
             self.status('Finalizing install')
             util.rmtree(self.changesetDir)
@@ -1101,14 +1585,22 @@ class BootableImage(ImageGenerator):
             return self.bootloader
 
         finally:
-            try:
-                self.killChrootProcesses(dest)
-            except:
-                log.exception("Error during cleanup:")
-            try:
-                self.umountChrootMounts(dest)
-            except:
-                log.exception("Error during cleanup:")
+            for root in (stage, dest):
+                if not root:
+                    continue
+                try:
+                    self.killChrootProcesses(root)
+                except:
+                    log.exception("Error during cleanup:")
+                try:
+                    self.umountChrootMounts(root)
+                except:
+                    log.exception("Error during cleanup:")
+            if stage:
+                try:
+                    self._releaseStagingRoot(stage)
+                except:
+                    log.exception("Error during cleanup:")
 
     def loadRPM(self):
         """Insert the necessary RPM (if any) into sys.path."""
@@ -1203,17 +1695,44 @@ class BootableImage(ImageGenerator):
         sys.path.insert(0, path)
         __import__('rpm')
 
+    def getCompression(self, codec=None):
+        """
+        Return the codec, level and worker count to compress outputs with.
+        The configured level only applies to the configured codec.
+        """
+        configured = self.getBuildData('compressionCodec') or compress.GZIP
+        level = None
+        if codec is None or codec == configured:
+            codec = configured
+            level = self.getBuildData('compressionLevel')
+        workers = self.getBuildData('compressionWorkers') or None
+        return codec, level, workers
+
     @timeMe
-    def gzip(self, source, dest = None):
+    def gzip(self, source, dest = None, tarArgs = (), codec = None):
+        """
+        Compress file or directory C{source} into C{dest} and return the path
+        written. If a codec other than gzip is configured, a C{.gz} suffix on
+        C{dest} is replaced with that codec's suffix. Pass C{codec} to
+        override the configured codec, e.g. where a format requires gzip.
+        """
+        codec, level, workers = self.getCompression(codec)
+        suffix = compress.getSuffix(codec)
         if os.path.isdir(source):
             if not dest:
-                dest = source + '.tar.gz'
+                dest = source + '.tar' + suffix
+            elif dest.endswith('.gz'):
+                dest = dest[:-3] + suffix
             parDir, targetDir = os.path.split(source)
-            logCall('tar -C %s -cv %s | gzip > %s' % (parDir, targetDir, dest))
+            compress.compressTree(parDir, targetDir, dest, codec=codec,
+                    level=level, workers=workers, tarArgs=tarArgs)
         else:
             if not dest:
-                dest = source + '.gz'
-            logCall('gzip -c %s > %s' % (source, dest))
+                dest = source + suffix
+            elif dest.endswith('.gz'):
+                dest = dest[:-3] + suffix
+            compress.compressFile(source, dest, codec=codec, level=level,
+                    workers=workers)
         return dest
 
     @timeMe
@@ -28,6 +28,7 @@ templateDir         = dataDir + '/templates'
 tmpDir              = '/tmp'
 anacondaTemplatesPath = tmpDir + '/anaconda-templates'
 cachePath           = tmpDir + '/changesets'
+dbTemplatePath      = tmpDir + '/conarydb-templates'
 finishedDir         = tmpDir + '/finished-images'
 
 implantIsoMd5 = '/usr/bin/implantisomd5'
@@ -351,6 +351,29 @@ class InstallableIso(ImageGenerator):
         util.rmtree(tmpRoot, ignore_errors = True)
         util.rmtree(autoGenPath, ignore_errors = True)
 
+    def finishIso(self, iso, name):
+        """
+        Rename an ISO larger than a CD as a DVD and implant its checksum.
+        Returns the final path and name.
+        """
+        szPipe = os.popen('isosize %s' % iso, 'r')
+        isoSize = int(szPipe.read())
+        szPipe.close()
+        if isoSize > 734003200: # 700 MB in bytes
+            newIso = iso.replace('disc', 'dvd')
+            name = name.replace('Disc', 'DVD')
+            os.rename(iso, newIso)
+            iso = newIso
+
+        if not os.access(iso, os.R_OK):
+            raise RuntimeError, "ISO generation failed"
+        cmd = [constants.implantIsoMd5]
+        if not self.showMediaCheck:
+            cmd.append('--supported-iso')
+        cmd.append(iso)
+        call(*cmd)
+        return iso, name
+
     def buildIsos(self, topdir):
         outputDir = os.path.join(constants.finishedDir, self.UUID)
         self.outputDir = outputDir
@@ -401,29 +424,11 @@ class InstallableIso(ImageGenerator):
                 raise RuntimeError(
                         "Not enough scratch space while running mkisofs")
 
-            isoList.append((outputIsoName, "%s Disc %s" % (self.jobData['project']['name'], discNum)))
-
-        isoList = [ (os.path.join(outputDir, iso[0]), iso[1]) for iso in isoList ]
-        # this for loop re-identifies any iso greater than 700MB as a DVD
-        for index, (iso, name) in zip(range(len(isoList)), isoList[:]):
-            szPipe = os.popen('isosize %s' % iso, 'r')
-            isoSize = int(szPipe.read())
-            szPipe.close()
-            if isoSize > 734003200: # 700 MB in bytes
-                newIso = iso.replace('disc', 'dvd')
-                newName = name.replace('Disc', 'DVD')
-                os.rename(iso, newIso)
-                isoList[index] = (newIso, newName)
-
-        for iso, name in isoList:
-            if not os.access(iso, os.R_OK):
-                raise RuntimeError, "ISO generation failed"
-            else:
-                cmd = [constants.implantIsoMd5]
-                if not self.showMediaCheck:
-                    cmd.append('--supported-iso')
-                cmd.append(iso)
-                call(*cmd)
+            iso, name = self.finishIso(os.path.join(outputDir, outputIsoName),
+                    "%s Disc %s" % (self.jobData['project']['name'], discNum))
+            isoList.append((iso, name))
+            # Send each disc while the next one is mastered
+            self.startUpload(iso)
 
         # add the netboot images
         for f in ('boot.iso', 'diskboot.img'):
@@ -431,6 +436,7 @@ class InstallableIso(ImageGenerator):
             outF = os.path.join(outputDir, f)
             if os.path.exists(inF):
                 gencslist._linkOrCopyFile(inF, outF)
+                self.startUpload(outF)
                 isoList += ( (outF, f), )
         return isoList
 
@@ -647,11 +653,15 @@ class InstallableIso(ImageGenerator):
         util.mkdirChain(constants.cachePath)
         client = self.getConaryClient(tmpRoot,
                                       getArchFlavor(self.baseFlavor).freeze())
+        store = self.getChangesetCache()
         tg = gencslist.TreeGenerator(client.cfg, client,
             (self.baseTrove, self.baseVersion, self.baseFlavor),
-            cacheDir=constants.cachePath, clientVersion=clientVersion)
+            cacheDir=constants.cachePath, clientVersion=clientVersion,
+            store=store)
         tg.parsePackageData()
         tg.extractChangeSets(csdir, callback=self.callback)
+        if store:
+            store.evict()
 
         log.info("done extracting changesets")
         return tg
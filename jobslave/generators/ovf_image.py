@@ -15,15 +15,19 @@
 #
 
 
+import hashlib
 import os
 
 from conary.lib import sha1helper
 
+from jobslave import artifacts
+from jobslave import tarwriter
 from jobslave.generators import constants
-from jobslave.util import logCall
 
 from pyovf import helper, ovf
 
+BUFFER_SIZE = 4 * 1024 * 1024
+
 class Cpu(ovf.Item):
     rasd_Caption = 'Virtual CPU'
     rasd_Description = 'Number of virtual CPUs'
@@ -199,38 +203,53 @@ class OvfImage(object):
         return self.ovfXml
 
     def createManifest(self):
-        sha1Line = 'SHA1(%s)= %s\n'
+        """
+        Name the manifest. Its contents are written by L{createOva}, which
+        hashes the disk while adding it to the archive rather than reading
+        the disk separately.
+        """
         self.manifestFileName = self.sanitizedImageName + '.' + constants.MF_EXTENSION
-        self.manifestPath = os.path.join(self.workingDir, self.manifestFileName)
 
-        mfFile = open(self.manifestPath, 'w')
-
-        ovfSha1 = sha1helper.sha1FileBin(self.ovfPath).encode('hex')
-        diskSha1 = sha1helper.sha1FileBin(self.diskFilePath).encode('hex')
-
-        mfFile.write(sha1Line % (self.ovfFileName, ovfSha1))
-        mfFile.write(sha1Line % (self.diskFileName, diskSha1))
-
-        mfFile.close()
+    def getManifest(self, diskSha1):
+        sha1Line = 'SHA1(%s)= %s\n'
+        ovfSha1 = sha1helper.sha1String(self.ovfXml).encode('hex')
+        return (sha1Line % (self.ovfFileName, ovfSha1) +
+                sha1Line % (self.diskFileName, diskSha1))
 
     def createOva(self):
         """
         Create a new tar archive @ self.ovaPath.
 
-        The ova is a tar consisting of the ovf and the disk file(s).
+        The ova is a tar consisting of the ovf, the manifest and the disk
+        file(s), written in one pass. The manifest has to come before the
+        disk, so unless the disk's digest was recorded when it was written,
+        the manifest is written with a placeholder digest of the same length
+        and filled in once the disk has been copied.
         """
         self.ovaFileName = self.sanitizedImageName + '.' + constants.OVA_EXTENSION
         self.ovaPath = os.path.join(self.outputDir, self.ovaFileName)
 
-        # Add the ovf as the first file to the ova tar.
-        logCall('tar -C %s -cv %s -f %s' % \
-            (self.workingDir, self.ovfFileName, self.ovaPath))
-        # Add the manifest as the 2nd file.
-        logCall('tar -C %s -rv %s -f %s' % \
-            (self.workingDir, self.manifestFileName, self.ovaPath))
-        # Add the disk as the 3rd file.
-        logCall('tar -C %s -rv %s -f %s' % \
-            (self.outputDir, self.diskFileName, self.ovaPath))
+        disk = artifacts.registry.lookup(self.diskFilePath)
+        if disk and disk.sha1:
+            diskSha1 = None
+            manifest = self.getManifest(disk.sha1)
+        else:
+            diskSha1 = hashlib.sha1()
+            manifest = self.getManifest('0' * diskSha1.digest_size * 2)
+        diskSize = os.stat(self.diskFilePath).st_size
+        with artifacts.ArtifactFile(self.ovaPath) as ova:
+            archive = tarwriter.TarWriter(ova)
+            archive.addData(self.ovfFileName, self.ovfXml)
+            mfOffset = archive.addData(self.manifestFileName, manifest)
+            with open(self.diskFilePath, 'rb') as fobj:
+                archive.addFile(self.diskFileName, fobj, diskSize,
+                        bufSize=BUFFER_SIZE, digest=diskSha1)
+            if diskSha1 is not None:
+                archive.rewrite(mfOffset,
+                        self.getManifest(diskSha1.hexdigest()))
+                artifacts.registry.record(self.diskFilePath,
+                        {'sha1': diskSha1.hexdigest()})
+            archive.close()
 
         return self.ovaPath
 
@@ -17,8 +17,9 @@
 
 import os
 
+from jobslave import compress
+from jobslave import sparsefile
 from jobslave.generators import bootable_image, constants
-from jobslave.util import logCall
 
 from conary.lib import util, log
 
@@ -27,10 +28,12 @@ class RawFsImage(bootable_image.BootableImage):
         if os.path.exists(image):
             util.rmtree(image)
         util.mkdirChain(os.path.split(image)[0])
-        logCall('dd if=/dev/zero of=%s count=1 seek=%d bs=4096' % \
-                      (image, (size / 4096) - 1))
+        sparsefile.allocate(image, (size / 4096) * 4096,
+                mode=self.getBuildData('diskAllocation'))
 
+        # The caller is responsible for detaching once it has unmounted.
         fs = bootable_image.Filesystem(image, fsType, size, fsLabel = fsLabel)
+        fs.attach()
         fs.format()
         return fs
 
@@ -65,9 +68,12 @@ class RawFsImage(bootable_image.BootableImage):
         finally:
             try:
                 self.umountAll()
+                for fs in self.filesystems.values():
+                    fs.detach()
                 util.rmtree(root, ignore_errors = True)
             except:
                 log.logger.exception("Error unmounting partitions:")
+            self.logFilesystemTimings()
 
         return imgFiles
 
@@ -77,15 +83,17 @@ class RawFsImage(bootable_image.BootableImage):
 
         images = self.makeFSImage(sizes)
         self.status('Compressing filesystem images')
-        self.gzip(self.workingDir, finalImage)
+        finalImage = self.gzip(self.workingDir, finalImage)
+        self.startUpload(finalImage)
 
         if self.buildOVF10:
             self.diskFilePath = images['/']
             self.diskFileName = os.path.split(self.diskFilePath)[1]
 
             self.status('Building OVF 1.0 package')
-            diskFileGzipPath = self.gzip(self.diskFilePath, 
-                os.path.join(self.outputDir, self.diskFileName + '.gz'))
+            diskFileGzipPath = self.gzip(self.diskFilePath,
+                os.path.join(self.outputDir, self.diskFileName + '.gz'),
+                codec=compress.GZIP)
             util.rmtree(self.workingDir)
 
             self.ovaPath = self.createOvf(
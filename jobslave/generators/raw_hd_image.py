@@ -18,7 +18,9 @@
 import logging
 import os
 
+from jobslave import compress
 from jobslave import lvm
+from jobslave import sparsefile
 from jobslave.generators import bootable_image, constants
 from jobslave.geometry import FSTYPE_LINUX, FSTYPE_LINUX_LVM
 from jobslave.util import logCall, divCeil
@@ -30,21 +32,24 @@ log = logging.getLogger(__name__)
 
 class HDDContainer(object):
 
-    def __init__(self, image, geometry, totalSize=None):
+    def __init__(self, image, geometry, totalSize=None,
+            allocation=sparsefile.ALLOC_SPARSE):
         self.image = image
         self.geometry = geometry
         if totalSize is None:
             totalSize = os.stat(image).st_size
         self.totalSize = totalSize
+        self.allocation = allocation or sparsefile.ALLOC_SPARSE
 
     def create(self):
         # create the raw file
-        # NB: blocksize is unrelated to the one in constants.py, and is
-        # completely arbitrary.
-        blocksize = 512
-        seek = (self.totalSize - 1) / blocksize
-        logCall('dd if=/dev/zero of=%s count=1 seek=%d bs=%d' % (
-            self.image, max(seek, 0), blocksize))
+        allocated = sparsefile.allocate(self.image, self.totalSize,
+                mode=self.allocation)
+        log.info("Created %s disk container %s: %d bytes, %d allocated",
+                self.allocation, self.image, self.totalSize, allocated)
+
+    def getAllocatedSize(self):
+        return sparsefile.allocatedSize(self.image)
 
     def destroy(self):
         if self.image:
@@ -116,7 +121,8 @@ class RawHdImage(bootable_image.BootableImage):
         # and/or a misunderstanding by this developer of how partition table
         # sizes are calculated, see RBL-8292.
         totalSize = alignPart(rootEnd + lvmSize + 1)
-        container = HDDContainer(image, self.geometry, totalSize)
+        container = HDDContainer(image, self.geometry, totalSize,
+                allocation=self.getBuildData('diskAllocation'))
         container.create()
 
         # Calculate the offsets and sizes of the root and LVM partitions.
@@ -139,21 +145,26 @@ class RawHdImage(bootable_image.BootableImage):
 
         container.partition(partitions)
 
+        # Each filesystem stays attached from format through unmount.
         root = self.mountDict[rootPart]
         rootFs = bootable_image.Filesystem(image, root.fstype, rootSize,
                 offset=rootStart, fsLabel=root.name)
-        rootFs.format()
-        self.addFilesystem(rootPart, rootFs)
-
-        for mountPoint, req in self.mountDict.items():
-            if mountPoint == rootPart or req.fstype == 'unallocated':
-                continue
-            fs = lvmContainer.addFilesystem(req.name, mountPoint, req.fstype,
-                    realSizes[mountPoint])
-            fs.format()
-            self.addFilesystem(mountPoint, fs)
+        rootFs.attach()
+        if lvmContainer:
+            lvmContainer.open()
 
         try:
+            rootFs.format()
+            self.addFilesystem(rootPart, rootFs)
+
+            for mountPoint, req in self.mountDict.items():
+                if mountPoint == rootPart or req.fstype == 'unallocated':
+                    continue
+                fs = lvmContainer.addFilesystem(req.name, mountPoint,
+                        req.fstype, realSizes[mountPoint])
+                fs.format()
+                self.addFilesystem(mountPoint, fs)
+
             self.mountAll()
 
             # Install contents into image
@@ -181,8 +192,10 @@ class RawHdImage(bootable_image.BootableImage):
                 self.umountAll()
                 if lvmContainer:
                     lvmContainer.unmount()
+                rootFs.detach()
             except Exception, e:
                 log.warning("Error tearing down filesystems:", exc_info=True)
+            self.logFilesystemTimings()
 
         return container
 
@@ -194,9 +207,15 @@ class RawHdImage(bootable_image.BootableImage):
 
         finalImage = os.path.join(self.outputDir, self.basefilename + '.hdd.gz')
         imageSize = os.stat(image).st_size
+        allocatedSize = disk.getAllocatedSize()
+        log.info("Disk image occupies %d of %d bytes on scratch storage",
+                allocatedSize, imageSize)
 
         self.status('Compressing hard disk image')
-        outFile = self.gzip(image, finalImage)
+        # OVF only allows gzip compressed disks
+        finalImage = self.gzip(image, finalImage,
+                codec=(self.buildOVF10 and compress.GZIP or None))
+        self.startUpload(finalImage)
 
         if self.buildOVF10:
             self.ovaPath = self.createOvf(
@@ -209,7 +228,8 @@ class RawHdImage(bootable_image.BootableImage):
 
         self.outputFileList.append((finalImage, 'Raw Hard Disk Image'),)
         self.postOutput(self.outputFileList,
-                attributes={'uncompressed_size': imageSize})
+                attributes={'uncompressed_size': imageSize,
+                    'allocated_size': allocatedSize})
 
     def preTagScripts(self):
         super(RawHdImage, self).preTagScripts()
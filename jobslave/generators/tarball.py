@@ -21,10 +21,10 @@ import os
 
 # jobslave imports
 from jobslave.generators import bootable_image, constants
-from jobslave.util import logCall
 
 from conary.lib import util
 from jobslave import buildtypes
+from jobslave import compress
 
 log = logging.getLogger(__name__)
 
@@ -38,7 +38,9 @@ class Tarball(bootable_image.BootableImage):
         util.mkdirChain(basePath)
         outputDir = os.path.join(constants.finishedDir, self.UUID)
         util.mkdirChain(outputDir)
-        tarball = os.path.join(outputDir, self.basefilename + '.tar.gz')
+        codec, level, workers = self.getCompression()
+        tarball = os.path.join(outputDir, self.basefilename + '.tar'
+                + compress.getSuffix(codec))
         self.installFileTree(basePath, no_mbr=True)
 
         sizes = os.statvfs(basePath)
@@ -46,7 +48,7 @@ class Tarball(bootable_image.BootableImage):
         log.info("Installed size: %.1f MB", installedSize / 1e6)
 
         self.status('Creating tarball')
-        logCall('tar -C %s -cpPsS --to-stdout ./ | gzip > %s' % \
-                         (basePath, tarball))
+        compress.compressTree(basePath, './', tarball, codec=codec,
+                level=level, workers=workers, tarArgs=['-pPsS'])
         self.postOutput(((tarball, 'Tar File'),),
                 attributes={'installed_size': installedSize})
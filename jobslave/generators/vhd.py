@@ -15,11 +15,13 @@
 #
 
 
+import binascii
 import struct
 import stat
 import os
 import time
 
+from jobslave import sparsefile
 from jobslave.geometry import GEOMETRY_VHD
 from jobslave.generators.raw_hd_image import divCeil
 
@@ -29,6 +31,9 @@ SEEK_END = 2
 
 Y2K_UTC = 946684800
 
+# Write buffer for dynamic disks; large enough to hold several data blocks
+OUTPUT_BUFFER = 8 * 1024 * 1024
+
 class VHDDiskType:
     NoneType = 0
     Reserved = 1
@@ -167,16 +172,35 @@ class BlockAllocationTable(object):
 
 
 class SectorBitmap(object):
+    # '0'/'1' indexed by a bool
+    _bitChars = ('0', '1')
+
     def __init__(self, numSectors):
-        # split the bit field into 64 bit chunks for ease of integrating with
-        # struct.pack()
-        self.sectors = (int(bool(numSectors % 64)) + numSectors / 64) * [0]
+        self.numSectors = numSectors
+        self.bitmap = bytearray(divCeil(numSectors, 8))
 
     def touch(self, sector):
-        self.sectors[sector / 64] |= 1 << (63 - (sector % 64))
+        self.bitmap[sector / 8] |= 0x80 >> (sector % 8)
+
+    def setFromData(self, data, sectorSize):
+        """
+        Mark every sector of C{data} that is not all zeroes. The sectors are
+        split and compared by C code rather than a Python loop.
+        """
+        count = divCeil(len(data), sectorSize)
+        data += chr(0) * (count * sectorSize - len(data))
+        sectors = struct.unpack(('%ds' % sectorSize) * count, data)
+        flags = map((sectorSize * chr(0)).__ne__, sectors)
+        bits = ''.join(map(self._bitChars.__getitem__, flags))
+        bits += '0' * (len(self.bitmap) * 8 - len(bits))
+        self.bitmap = bytearray(binascii.unhexlify(
+            '%0*x' % (len(self.bitmap) * 2, int(bits, 2))))
+
+    def isEmpty(self):
+        return not str(self.bitmap).strip(chr(0))
 
     def pack(self):
-        res = struct.pack('>%dQ' % len(self.sectors), *self.sectors)
+        res = str(self.bitmap)
         # per VHD spec, pad result to next 512 byte boundary.
         # noted that VPC adds one more block than we do.
         res += ((512 - (len(res) % 512)) % 512) * chr(0)
@@ -186,22 +210,23 @@ class SectorBitmap(object):
 class DataBlock(object):
     sectorsPerBlock = 4096
     sectorSize = 512
+    blockSize = sectorsPerBlock * sectorSize
+    zeroBlock = blockSize * chr(0)
 
     def __init__(self, data):
-        assert len(data) <= (self.sectorsPerBlock * self.sectorSize)
+        assert len(data) <= self.blockSize
         self.sectorBitmap = SectorBitmap(self.sectorsPerBlock)
         self.setData(data)
 
     def setData(self, data):
+        # Blocks are always stored whole
+        data += (self.blockSize - len(data)) * chr(0)
         self.data = data
-        ref = self.sectorSize * chr(0)
-        for i in range(self.sectorsPerBlock):
-            chunk = data[i * self.sectorSize: (i + 1) * self.sectorSize]
-            if chunk != ref:
-                self.sectorBitmap.touch(i)
+        if data != self.zeroBlock:
+            self.sectorBitmap.setFromData(data, self.sectorSize)
 
     def isEmpty(self):
-        return not max(x for x in self.sectorBitmap.sectors)
+        return self.sectorBitmap.isEmpty()
 
     def pack(self):
         return self.sectorBitmap.pack() + self.data
@@ -242,11 +267,34 @@ class ParentLocatorEntry(PackedHeader):
         return res
 
 
-def makeDynamic(inFn, outFn):
+def _allocatedBlocks(inF, blockSize):
+    """
+    Yield the index of each block of C{inF} that contains allocated data,
+    skipping blocks that lie entirely within holes.
+    """
+    last = -1
+    for offset, length, isData in sparsefile.iterExtents(inF):
+        if not isData:
+            continue
+        first = max(offset / blockSize, last + 1)
+        last = (offset + length - 1) / blockSize
+        for index in xrange(first, last + 1):
+            yield index
+
+
+def makeDynamic(inFn, outFn, consume=False):
+    """
+    Convert raw image C{inFn} to a dynamic VHD at C{outFn}.
+
+    If C{consume} is set, the input is deallocated block by block as it is
+    copied and removed at the end, so that the conversion needs scratch
+    space for little more than one copy of the data.
+    """
     st = os.stat(inFn)
 
-    inF = open(inFn)
-    outF = open(outFn, 'w')
+    inF = open(inFn, consume and 'r+b' or 'rb')
+    punch = consume
+    outF = open(outFn, 'wb', OUTPUT_BUFFER)
     footer = VHDFooter()
     footer.originalSize = footer.currentSize = st[stat.ST_SIZE]
     footer.dataOffset = 512
@@ -254,7 +302,7 @@ def makeDynamic(inFn, outFn):
 
     header = SparseDiskHeader()
 
-    blockSize = DataBlock.sectorsPerBlock * DataBlock.sectorSize
+    blockSize = DataBlock.blockSize
     numBatEntries = footer.originalSize / blockSize + \
         int(bool(footer.originalSize % blockSize))
 
@@ -266,25 +314,33 @@ def makeDynamic(inFn, outFn):
     batIndex = outF.tell()
     outF.write(bat.pack())
 
-    data = None
-    blockIndex = 0
-    while data != '':
+    # Unallocated regions of the input are never read
+    for blockIndex in _allocatedBlocks(inF, blockSize):
+        inF.seek(blockIndex * blockSize)
         data = inF.read(blockSize)
-        if not data:
-            break
+        if not data or data == DataBlock.zeroBlock:
+            continue
         block = DataBlock(data)
-        if not block.isEmpty():
-            assert not (outF.tell() % DataBlock.sectorSize)
-            bat[blockIndex] = outF.tell() / DataBlock.sectorSize
-            outF.write(block.pack())
-        blockIndex += 1
+        assert not (outF.tell() % DataBlock.sectorSize)
+        bat[blockIndex] = outF.tell() / DataBlock.sectorSize
+        outF.write(block.pack())
+        if punch and not sparsefile.punchHole(inF,
+                blockIndex * blockSize, blockSize):
+            # Not supported by the scratch filesystem
+            punch = False
 
     outF.write(footer.pack())
     outF.seek(batIndex)
     outF.write(bat.pack())
     outF.close()
+    inF.close()
+    if consume:
+        os.unlink(inFn)
 
 def makeFlat(inFn):
+    """
+    Turn raw image C{inFn} into a fixed VHD in place by appending a footer.
+    """
     st = os.stat(inFn)
     inF = open(inFn, "a")
     footer = VHDFooter()
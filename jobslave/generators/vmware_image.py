@@ -15,17 +15,27 @@
 #
 
 
+import errno
+import fcntl
+import logging
 import os
 import stat
+import threading
+import time
 from collections import namedtuple
 
 from jobslave import buildtypes
+from jobslave import compress
+from jobslave import vmdk
 from jobslave.generators import bootable_image, raw_hd_image, constants, \
     ovf_image
+from jobslave.imagegen import MSG_INTERVAL
 from jobslave.util import logCall
 from conary.lib import util
 from conary.deps import deps
 
+log = logging.getLogger(__name__)
+
 def vmEscape(data, eatNewlines = True):
     data = data.replace('|', '|7C')
     escapeDict = {
@@ -130,10 +140,12 @@ class VMwareImage(raw_hd_image.RawHdImage):
         return (name, version)
 
     @bootable_image.timeMe
-    def createVMDK(self, hdImage, outfile, size):
+    def createVMDK(self, hdImage, outfile, size, callback=None):
         createVMDK(hdImage, outfile, size, geometry=self.geometry,
                 adapter=self.adapter, hwVersion=self.hwVersion,
-                streaming=False)
+                streaming=False, callback=callback,
+                writer=self.getBuildData('vmdkWriter'),
+                verify=self.getBuildData('vmdkVerify'))
 
     @bootable_image.timeMe
     def createVMX(self, outfile, type='vmx'):
@@ -197,36 +209,45 @@ class VMwareImage(raw_hd_image.RawHdImage):
         for use in the OVF 1.0 generator.
         """
         if not callback:
-            callback = VMwareCallback()
+            callback = VMwareCallback(self.status)
         vmxPath = os.path.join(self.workingDir, self.basefilename + '.vmx')
         vmdkPath = os.path.join(self.workingDir, self.basefilename + '.vmdk')
         outputPath = os.path.join(self.outputDir, self.basefilename +
                 '.vmware.zip')
         self.capacity = disk.totalSize
-        # TODO: Add progress to raw2vmdk and pass it to creatingDisk()
         callback.creatingDisk(None, None)
-        self.createVMDK(disk.image, vmdkPath, self.capacity)
+        self.createVMDK(disk.image, vmdkPath, self.capacity, callback)
         disk.destroy()
 
-        # TODO: Add progress to self.gzip() and pass it to creatingArchive()
+        # The archive is written by zip(1), which reports no progress
         callback.creatingArchive(None, None)
         self.createVMX(vmxPath)
         self.setModes(self.workingDir)
         self.zipArchive(self.workingDir, outputPath)
+        self.startUpload(outputPath)
         self.outputFileList.append(
             (outputPath, self.productName + ' Image'))
         return vmdkPath
 
     def compressDiskImage(self, vmdkPath):
         if not self.WithCompressedDisks:
-            # Need to add the file to the final directory
-            destf = util.AtomicFile(os.path.join(self.outputDir, self.basefilename + '.vmdk'))
-            util.copyfileobj(file(vmdkPath), destf)
-            destf.commit()
-            return destf.finalPath
+            # Need to add the file to the final directory. It is not changed
+            # afterwards, so a hardlink will do where both are on the same
+            # filesystem.
+            destPath = os.path.join(self.outputDir, self.basefilename + '.vmdk')
+            util.removeIfExists(destPath)
+            try:
+                os.link(vmdkPath, destPath)
+            except OSError, err:
+                if err.errno not in (errno.EXDEV, errno.EPERM):
+                    raise
+                destf = util.AtomicFile(destPath)
+                util.copyfileobj(file(vmdkPath), destf)
+                destf.commit()
+            return destPath
         vmdkGzOutputFile = os.path.join(self.outputDir, self.basefilename +
                 '.vmdk.gz')
-        self.gzip(vmdkPath, vmdkGzOutputFile)
+        self.gzip(vmdkPath, vmdkGzOutputFile, codec=compress.GZIP)
         util.remove(vmdkPath)
         return vmdkGzOutputFile
 
@@ -346,37 +367,162 @@ class VMwareESXImage(VMwareImage):
         self.vmSnapshots = False
 
     @bootable_image.timeMe
-    def createOvfVMDK(self, hdImage, outfile, size):
+    def createOvfVMDK(self, hdImage, outfile, size, callback=None):
         createVMDK(hdImage, outfile, size, geometry=self.geometry,
                 adapter=self.adapter, hwVersion=self.hwVersion,
-                streaming=True)
+                streaming=True, threads=0,
+                level=self.getBuildData('vmdkCompressionLevel'),
+                callback=callback, writer=self.getBuildData('vmdkWriter'),
+                verify=self.getBuildData('vmdkVerify'))
 
     def writeMachine(self, disk, callback=None):
         """Create VMDK for the OVF processor, but no actual output images."""
         if not callback:
-            callback = VMwareCallback()
+            callback = VMwareCallback(self.status)
         vmdkPath = os.path.join(self.workingDir, self.basefilename + '.vmdk')
         self.capacity = disk.totalSize
-        # TODO: Add progress to raw2vmdk and pass it to creatingDisk()
         callback.creatingDisk(None, None)
-        self.createOvfVMDK(disk.image, vmdkPath, disk.totalSize)
+        self.createOvfVMDK(disk.image, vmdkPath, disk.totalSize, callback)
         disk.destroy()
         return vmdkPath
 
 
 class VMwareCallback(object):
 
-    def creatingDisk(self, completed, total):
-        pass
+    def __init__(self, status=None):
+        self.status = status
+        self.msg = ''
+        self.timeStamp = 0
+
+    def update(self, msg):
+        curTime = time.time()
+        # only push an update if it differs from the current message
+        if not self.status:
+            return
+        if self.msg != msg and (curTime - self.timeStamp) > MSG_INTERVAL:
+            self.msg = msg
+            self.status(msg)
+            self.timeStamp = curTime
+
+    def creatingDisk(self, completed, total, skipped=0, rate=0):
+        if not total:
+            return
+        self.update("Creating disk: %d%% (%d of %d MB at %.1f MB/s, "
+                "%d empty grains skipped)" % (completed * 100 / total,
+                    completed / 1048576, total / 1048576, rate / 1048576,
+                    skipped))
 
     def creatingArchive(self, completed, total):
-        pass
+        if not total:
+            self.update("Creating archive")
+            return
+        self.update("Creating archive: %d%%" % (completed * 100 / total))
+
+
+class _ProgressReader(threading.Thread):
+    """
+    Parse progress lines written by raw2vmdk to a pipe and pass them on to a
+    L{VMwareCallback}.
+    """
+
+    def __init__(self, fd, callback):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fobj = os.fdopen(fd, 'r')
+        self.callback = callback
+        self.startTime = time.time()
+        self.completed = self.written = self.skipped = 0
+
+    def run(self):
+        try:
+            for line in iter(self.fobj.readline, ''):
+                fields = line.split()
+                if len(fields) != 5 or fields[0] != 'progress':
+                    continue
+                (self.completed, total, self.written, self.skipped
+                        ) = [int(x) for x in fields[1:]]
+                self.callback.creatingDisk(self.completed, total,
+                        skipped=self.skipped, rate=self.rate())
+        finally:
+            self.fobj.close()
+
+    def rate(self):
+        elapsed = time.time() - self.startTime
+        return elapsed and self.completed / elapsed or 0
+
+
+RAW2VMDK = '/usr/bin/raw2vmdk'
+# Descriptor raw2vmdk writes its progress to
+PROGRESS_FD = 3
+
+# Ways of producing a VMDK: the raw2vmdk binary or jobslave.vmdk
+WRITER_RAW2VMDK = 'raw2vmdk'
+WRITER_PYTHON = 'python'
 
 
 def createVMDK(hdImage, outfile, size, geometry, adapter, hwVersion,
-        streaming=False):
+        streaming=False, threads=None, level=None, callback=None,
+        writer=WRITER_RAW2VMDK, verify=False):
+    """
+    Convert raw disk C{hdImage} to a VMDK. For streamOptimized disks,
+    C{threads} compression threads are used (0 for one per CPU) at zlib
+    compression C{level}. Progress is reported to C{callback}, if given.
+
+    C{writer} selects the C{raw2vmdk} binary or the in-process writer in
+    L{jobslave.vmdk}; both produce the same disk. If C{verify} is set, the
+    structure of the new disk is checked before returning.
+    """
+    _convertVMDK(hdImage, outfile, size, geometry, adapter, hwVersion,
+            streaming, threads, level, callback, writer)
+    if not verify:
+        return
+    start = time.time()
+    problems = vmdk.verifyFile(outfile)
+    if problems:
+        for problem in problems:
+            log.error("%s", problem)
+        raise vmdk.VMDKError("Created a corrupt VMDK %s: %s" % (
+            os.path.basename(outfile), problems[0]))
+    log.info("Verified %s in %.1f seconds", os.path.basename(outfile),
+            time.time() - start)
+
+
+def _passFd(fd):
+    """
+    Run in a child before exec: move C{fd} to L{PROGRESS_FD} and close every
+    other descriptor above stderr that would survive the exec.
+    """
+    os.dup2(fd, PROGRESS_FD)
+    for name in os.listdir('/proc/self/fd'):
+        other = int(name)
+        if other <= PROGRESS_FD:
+            continue
+        try:
+            if not fcntl.fcntl(other, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                os.close(other)
+        except (IOError, OSError):
+            # The descriptor listdir itself used
+            pass
+
+
+def _convertVMDK(hdImage, outfile, size, geometry, adapter, hwVersion,
+        streaming, threads, level, callback, writer):
+    if writer == WRITER_PYTHON:
+        stats = vmdk.writeVMDK(hdImage, outfile,
+                geometry.cylindersRequired(size), heads=geometry.heads,
+                sectors=geometry.sectors, adapter=adapter,
+                hwVersion=hwVersion, streaming=streaming,
+                level=(level is None and 1 or level),
+                workers=(threads or None), callback=callback)
+        log.info("Converted %d MB to VMDK at %.1f MB/s: %d grains written, "
+                "%d empty grains skipped", stats.completed / 1048576,
+                stats.rate() / 1048576, stats.written, stats.skipped)
+        return
+    if writer != WRITER_RAW2VMDK:
+        raise RuntimeError("Unknown VMDK writer '%s'" % (writer,))
+
     args = [
-            '/usr/bin/raw2vmdk',
+            RAW2VMDK,
             '-C', str(geometry.cylindersRequired(size)),
             '-H', str(geometry.heads),
             '-S', str(geometry.sectors),
@@ -385,6 +531,25 @@ def createVMDK(hdImage, outfile, size, geometry, adapter, hwVersion,
             ]
     if streaming:
         args += ['-s']
-    args += [hdImage, outfile]
-
-    logCall(args)
+        if threads is not None:
+            args += ['-j', str(threads)]
+        if level is not None:
+            args += ['-z', str(level)]
+    if callback is None:
+        logCall(args + [hdImage, outfile])
+        return
+
+    readFd, writeFd = os.pipe()
+    reader = _ProgressReader(readFd, callback)
+    reader.start()
+    try:
+        # close_fds would also close the pipe, so the child closes
+        # everything but the pipe itself
+        logCall(args + ['-P', str(PROGRESS_FD), hdImage, outfile],
+                close_fds=False, preexec_fn=lambda: _passFd(writeFd))
+    finally:
+        os.close(writeFd)
+        reader.join()
+    log.info("Converted %d MB to VMDK at %.1f MB/s: %d grains written, "
+            "%d empty grains skipped", reader.completed / 1048576,
+            reader.rate() / 1048576, reader.written, reader.skipped)
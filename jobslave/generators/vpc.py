@@ -18,6 +18,7 @@
 import os
 
 from jobslave import buildtypes
+from jobslave import compress
 from jobslave import imagegen
 from jobslave.generators import constants
 from jobslave.generators import bootable_image, raw_hd_image, ovf_image
@@ -31,17 +32,20 @@ class VirtualPCImage(raw_hd_image.RawHdImage):
 
     @bootable_image.timeMe
     def createVHD(self, hdImage, filebase):
+        # The raw image is converted in place: a fixed VHD is the raw image
+        # plus a footer, and dynamic conversion releases the raw image as it
+        # goes. hdImage no longer exists afterwards.
         diskType = self.getBuildData('vhdDiskType')
         if diskType == 'fixed':
             vhd.makeFlat(hdImage)
             os.rename(hdImage, filebase + '.vhd')
         elif diskType == 'difference':
-            vhd.makeDynamic(hdImage, filebase + '-base.vhd')
+            vhd.makeDynamic(hdImage, filebase + '-base.vhd', consume=True)
             os.chmod(filebase + '-base.vhd', 0400)
             vhd.makeDifference(filebase + '-base.vhd', filebase + '.vhd',
                                self.basefilename + '-base.vhd')
         else:
-            vhd.makeDynamic(hdImage, filebase + '.vhd')
+            vhd.makeDynamic(hdImage, filebase + '.vhd', consume=True)
 
     @bootable_image.timeMe
     def createVMC(self, fileBase):
@@ -81,7 +85,10 @@ class VirtualPCImage(raw_hd_image.RawHdImage):
         self.createVMC(os.path.join(workingDir, self.basefilename))
 
         self.status('Compressing Microsoft Virtual PC Image')
-        self.gzip(workingDir, outputFile)
+        # OVF only allows gzip compressed disks
+        outputFile = self.gzip(workingDir, outputFile,
+                codec=(self.buildOVF10 and compress.GZIP or None))
+        self.startUpload(outputFile)
         self.outputFileList.append((outputFile, 'Virtual Server'))
 
         if self.buildOVF10:
@@ -15,23 +15,30 @@
 #
 
 
-import gzip
+import logging
 import os
 
+from jobslave import compress
+from jobslave import sparsefile
+from jobslave import tarwriter
 from jobslave.generators import constants
 from jobslave.generators import raw_hd_image, bootable_image
-from jobslave.util import logCall
+from jobslave.util import divCeil
 
 from conary.deps import deps
 from conary.lib import util
 
+log = logging.getLogger(__name__)
+
+# Disks are split into chunks of 1GB (not GiB)
+CHUNK_SIZE = 1000000000
+
 
 class XenOVA(raw_hd_image.RawHdImage):
     templateName = 'ova.xml.in'
     suffix = '.xva'
 
-    @bootable_image.timeMe
-    def createXVA(self, outfile, size):
+    def getOvaXml(self, size):
         # Read in the stub file
         infile = file(os.path.join(constants.templateDir, self.templateName),
                       'rb')
@@ -61,16 +68,15 @@ class XenOVA(raw_hd_image.RawHdImage):
  
         template = template.replace('@VDB_ENTRIES@', vbdLines)
         template = template.replace('@VDI_ENTRIES@', vdiLines)
-        # write the file to the proper location
+        return template
+
+    @bootable_image.timeMe
+    def createXVA(self, outfile, size):
         ofile = file(outfile, 'wb')
-        ofile.write(template)
+        ofile.write(self.getOvaXml(size))
         ofile.close()
 
     def write(self):
-        # Output setup
-        topDir = os.path.join(self.workDir, 'ova_base')
-        util.mkdirChain(topDir)
-
         outputDir = os.path.join(constants.finishedDir, self.UUID)
         util.mkdirChain(outputDir)
         deliverable = os.path.join(outputDir, self.basefilename + self.suffix)
@@ -79,46 +85,61 @@ class XenOVA(raw_hd_image.RawHdImage):
         image_path = os.path.join(self.workDir, 'hdimage')
         disk = self.makeHDImage(image_path)
 
-        # Open a manifest for tar so that it writes out files in the optimal
-        # order.
-        manifest_path = os.path.join(self.workDir, 'files')
-        manifest = open(manifest_path, 'w')
-
-        # Write the ova.xml file
-        ovaName = 'ova.xml'
-        ovaPath = os.path.join(topDir, ovaName)
-        self.createXVA(ovaPath, disk.totalSize)
-        print >>manifest, ovaName
-
-        # Split the HD image into 1GB (not GiB) chunks
-        label = 'xvda'
-        chunk_dir = os.path.join(topDir, label)
-        chunkPrefix = os.path.join(chunk_dir, 'chunk-')
-        util.mkdirChain(os.path.split(chunkPrefix)[0])
-
-        self.status('Splitting hard disk image')
-        infile = open(image_path, 'rb')
-        n = 0
-        tocopy = os.stat(image_path).st_size
-        while True:
-            chunkname = '%s%04d.gz' % (chunkPrefix, n)
-            outfile = gzip.GzipFile(chunkname, 'wb')
-            tocopy -= util.copyfileobj(infile, outfile, sizeLimit=1000000000)
-            outfile.close()
-            print >>manifest, chunkname
-            if not tocopy:
-                break
-            n += 1
-        infile.close()
-
-        # Delete the FS image to free up temp space
-        os.unlink(image_path)
-
-        # Create XVA file
-        manifest.close()
+        # XenServer requires gzip chunks
+        codec, level, workers = self.getCompression(compress.GZIP)
+        if level is None:
+            level = compress.CODECS[compress.GZIP][1]
         self.status('Creating XVA Image')
-        logCall('tar -cv -f "%s" -C "%s" -T "%s"' % \
-                         (deliverable, topDir, manifest_path))
+        self.createXVAArchive(deliverable, disk.totalSize, image_path,
+                level=level, workers=workers)
         self.outputFileList.append((deliverable, 'Citrix XenServer (TM) Image'),)
 
-        self.postOutput(self.outputFileList)            
+        self.postOutput(self.outputFileList)
+
+    @bootable_image.timeMe
+    def createXVAArchive(self, outfile, size, image, level=6, workers=None):
+        writeXVA(outfile, self.getOvaXml(size), image, level=level,
+                workers=workers, consume=True, status=self.status)
+
+
+def writeXVA(outfile, ovaXml, image, label='xvda', level=6, workers=None,
+        consume=False, status=None):
+    """
+    Write an XVA archive to C{outfile}: C{ovaXml} followed by raw disk
+    C{image} split into gzipped chunks under C{label}/. Each chunk is
+    compressed straight into the archive by C{workers} threads, skipping
+    holes in the image.
+
+    If C{consume} is set, each chunk of the image is deallocated once it has
+    been compressed and the image is removed at the end, so that scratch
+    space for a second copy of the disk is never needed.
+    """
+    size = os.stat(image).st_size
+    numChunks = max(divCeil(size, CHUNK_SIZE), 1)
+    inF = open(image, consume and 'r+b' or 'rb')
+    punch = consume
+    try:
+        with open(outfile, 'wb') as outF:
+            archive = tarwriter.TarWriter(outF)
+            archive.addData('ova.xml', ovaXml)
+            for n in range(numChunks):
+                if status:
+                    status('Compressing disk image: chunk %d of %d' % (n + 1,
+                        numChunks))
+                start = n * CHUNK_SIZE
+                end = min(start + CHUNK_SIZE, size)
+                member = archive.member('%s/chunk-%04d.gz' % (label, n))
+                stats = compress.gzipSparseFile(inF, member, level=level,
+                        workers=workers, start=start, end=end)
+                member.close()
+                log.info("Compressed chunk %d of %d: %s", n + 1, numChunks,
+                        stats)
+                if punch and end > start and not sparsefile.punchHole(inF,
+                        start, end - start):
+                    # Not supported by the scratch filesystem
+                    punch = False
+            archive.close()
+    finally:
+        inF.close()
+    if consume:
+        os.unlink(image)
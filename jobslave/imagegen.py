@@ -21,6 +21,7 @@ import re
 import StringIO
 import sys
 import urllib
+from contextlib import contextmanager
 
 from conary import conarycfg
 from conary import conaryclient
@@ -31,6 +32,7 @@ from conary.lib import formattrace
 from conary.lib import util, log as conaryLog
 from conary.trovetup import TroveTuple
 
+from jobslave import cscache
 from jobslave import jobstatus
 from jobslave import response
 from jobslave.generators import constants, ovf_image
@@ -53,7 +55,7 @@ class Generator(object):
         self.jobData = JobData(jobData)
 
         if cfg.masterUrl:
-            self.response = response.ResponseProxy(cfg.masterUrl, self.jobData)
+            self.response = self._newResponse(self.jobData)
         else:
             self.response = response.BaseResponseProxy()
         self.UUID = self.jobData['UUID'].encode('ascii')
@@ -98,7 +100,8 @@ class Generator(object):
     def run(self):
         try:
             # Route log data to the rBuilder's build log.
-            self.logger = LogHandler(self.response)
+            self.logger = LogHandler(self.response,
+                    spoolDir=constants.tmpDir)
             self.logger.start()
             rootLogger = logging.getLogger()
             self.logger.setFormatter(rootLogger.handlers[0].formatter)
@@ -133,23 +136,73 @@ class Generator(object):
             if self.logger:
                 self.logger.flush()
 
+        finally:
+            # Uploads still running now belong to a job that failed before
+            # collecting them
+            try:
+                self.response.close(abort=True)
+            except:
+                log.exception("Failed to stop background uploads:")
+
         if self.logger:
+            logging.getLogger().removeHandler(self.logger)
             self.logger.close()
+            stats = self.logger.stats()
+            if stats['dropped']:
+                log.warning("%d build log records were not sent upstream",
+                        stats['dropped'])
             self.logger = None
 
+    def _newResponse(self, jobData):
+        return response.ResponseProxy(self.cfg.masterUrl, jobData,
+                chunkSize=self.cfg.uploadChunkSize,
+                workers=self.cfg.uploadWorkers,
+                retries=self.cfg.uploadRetries,
+                sendfile=self.cfg.uploadSendfile,
+                timeout=self.cfg.uploadTimeout)
+
+    def getChangesetCache(self):
+        """
+        Return the changeset cache shared by jobs on this node, or C{None} if
+        it is disabled.
+        """
+        if not self.cfg.changesetCacheSize:
+            return None
+        return cscache.ChangesetCache(self.cfg.changesetCachePath,
+                maxSize=self.cfg.changesetCacheSize * 1048576)
+
+    @contextmanager
     def _response(self, forJobData):
-        if forJobData:
-            return response.ResponseProxy(self.cfg.masterUrl, forJobData)
-        return self.response
+        """
+        Yield the proxy to report on the job C{forJobData}, or on this job
+        if that is not set. A proxy made for another job is closed when the
+        block ends.
+        """
+        if not forJobData:
+            yield self.response
+            return
+        response = self._newResponse(forJobData)
+        try:
+            yield response
+        finally:
+            response.close()
 
     def status(self, message, status=jobstatus.RUNNING, forJobData=None):
         log.info("Sending job status: %d %s", status, message)
-        response = self._response(forJobData)
-        response.sendStatus(status, message)
+        with self._response(forJobData) as response:
+            response.sendStatus(status, message)
+
+    def startUpload(self, filePath):
+        """
+        Start uploading the finished output file C{filePath} in the
+        background while the job carries on. It still has to be passed to
+        L{postOutput} to be listed in the build's files.
+        """
+        self.response.startUpload(filePath)
 
     def postOutput(self, fileList, attributes=None, forJobData=None):
-        response = self._response(forJobData)
-        response.postOutput(fileList, attributes=attributes)
+        with self._response(forJobData) as response:
+            response.postOutput(fileList, attributes=attributes)
 
     def _sendStackTrace(self, e_type, e_value, e_tb):
         # Scrub the most likely place for user passwords to appear.
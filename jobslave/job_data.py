@@ -15,6 +15,8 @@
 #
 
 
+from jobslave import buildtypes
+
 BUILD_DEFAULTS = {
         'autoResolve': False,
         'maxIsoSize': '681574400',
@@ -38,6 +40,14 @@ BUILD_DEFAULTS = {
         'mirrorUrl': '',
         'zisofs': True,
         'diskAdapter': 'lsilogic',
+        'diskAllocation': 'sparse',
+        'compressionCodec': 'gzip',
+        'compressionLevel': 6,
+        'compressionWorkers': 0,
+        'vmdkCompressionLevel': 1,
+        'vmdkWriter': 'raw2vmdk',
+        'vmdkVerify': True,
+        'filesystemSizing': 'auto',
         'unionfs': False,
         'showMediaCheck': False,
         'amiHugeDiskMountpoint': '',
@@ -45,11 +55,24 @@ BUILD_DEFAULTS = {
         'vmCPUs': 1,
         }
 
+# Overrides of BUILD_DEFAULTS for particular build types
+BUILD_TYPE_DEFAULTS = {
+        # Disk images are large and compress well at lower levels
+        buildtypes.RAW_HD_IMAGE: {
+            'compressionLevel': 5,
+            },
+        buildtypes.VIRTUAL_PC_IMAGE: {
+            'compressionLevel': 5,
+            },
+        }
+
 
 class JobData(dict):
 
     def getBuildData(self, key):
         value = self.get('data', {}).get(key)
+        if value is None:
+            value = BUILD_TYPE_DEFAULTS.get(self.get('buildType'), {}).get(key)
         if value is None:
             value = BUILD_DEFAULTS.get(key)
         return value
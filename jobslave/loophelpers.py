@@ -15,11 +15,208 @@
 #
 
 
+import errno
+import fcntl
+import logging
 import os
+import stat
+import struct
+import threading
 from jobslave.util import logCall
 
+log = logging.getLogger(__name__)
+
+LOOP_MAJOR = 7
+LOOP_CONTROL = '/dev/loop-control'
+
+# from linux/loop.h
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_GET_STATUS64 = 0x4C05
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+
+# struct loop_info64
+LOOP_INFO64 = '=QQQQQIIII64s64s32sQQ'
+# struct loop_config: fd, block_size, loop_info64, __reserved[8]
+LOOP_CONFIG = '=II' + LOOP_INFO64[1:] + '8Q'
+
+# Number of times to retry when another process grabs the free loop device
+# between LOOP_CTL_GET_FREE and binding it.
+MAX_ATTEMPTS = 20
+
+
+class LoopError(RuntimeError):
+    pass
+
+
+def _packInfo(image, offset, size):
+    return (0, 0, 0, offset or 0, size or 0, 0, 0, 0, 0,
+            os.path.basename(image)[:63], '', '', 0, 0)
+
+
+class LoopDevice(object):
+    """
+    A loop device bound to a (image, offset, size) triple, shared between all
+    users of that triple.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.refs = 0
+
+
+class LoopManager(object):
+    """
+    Attach and detach loop devices directly through the loop ioctls.
+
+    Free devices are claimed atomically: if another process binds the device
+    returned by LOOP_CTL_GET_FREE first, the bind fails with EBUSY and another
+    device is requested. Attachments are reference counted per backing range
+    so that repeated attach calls for the same filesystem share one device,
+    and released device nodes are kept in a pool to be tried first next time.
+    """
+
+    def __init__(self, control=LOOP_CONTROL):
+        self.control = control
+        self.lock = threading.RLock()
+        self.byKey = {}
+        self.byPath = {}
+        self.pool = []
+
+    def available(self):
+        return os.path.exists(self.control)
+
+    def attach(self, image, offset=None, size=None):
+        key = (os.path.realpath(image), offset or 0, size or 0)
+        with self.lock:
+            loop = self.byKey.get(key)
+            if loop is None:
+                path = self._bind(image, offset, size)
+                loop = LoopDevice(path, key)
+                self.byKey[key] = loop
+                self.byPath[path] = loop
+                log.debug("Attached %s (offset %s size %s) to %s", image,
+                        offset, size, path)
+            loop.refs += 1
+            return loop.path
+
+    def detach(self, path):
+        with self.lock:
+            loop = self.byPath.get(path)
+            if loop is None:
+                # Not ours; release it anyway for compatibility with callers
+                # that attached by other means.
+                self._unbind(path)
+                return
+            loop.refs -= 1
+            if loop.refs > 0:
+                return
+            del self.byKey[loop.key]
+            del self.byPath[path]
+            if self._unbind(path):
+                self.pool.append(path)
+            log.debug("Detached %s", path)
+
+    def refcount(self, path):
+        with self.lock:
+            loop = self.byPath.get(path)
+            return loop and loop.refs or 0
+
+    def _candidates(self):
+        while self.pool:
+            yield self.pool.pop(0)
+        ctl = os.open(self.control, os.O_RDWR)
+        try:
+            while True:
+                num = fcntl.ioctl(ctl, LOOP_CTL_GET_FREE)
+                yield self._devNode(num)
+        finally:
+            os.close(ctl)
+
+    def _devNode(self, num):
+        path = '/dev/loop%d' % num
+        if not os.path.exists(path):
+            try:
+                os.mknod(path, 0660 | stat.S_IFBLK,
+                        os.makedev(LOOP_MAJOR, num))
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        return path
+
+    def _bind(self, image, offset, size):
+        backing = os.open(image, os.O_RDWR)
+        try:
+            candidates = self._candidates()
+            try:
+                for attempt in range(MAX_ATTEMPTS):
+                    path = candidates.next()
+                    try:
+                        self._configure(path, backing, image, offset, size)
+                    except (IOError, OSError), err:
+                        if err.errno in (errno.EBUSY, errno.ENXIO,
+                                errno.ENOENT):
+                            # Somebody else got there first, or a pooled
+                            # device went away.
+                            continue
+                        raise
+                    return path
+            finally:
+                candidates.close()
+        finally:
+            os.close(backing)
+        raise LoopError("Unable to find a free loop device for %s" % image)
+
+    def _configure(self, path, backing, image, offset, size):
+        dev = os.open(path, os.O_RDWR)
+        try:
+            info = _packInfo(image, offset, size)
+            config = struct.pack(LOOP_CONFIG, backing, 0, *(info + (0,) * 8))
+            try:
+                fcntl.ioctl(dev, LOOP_CONFIGURE, config)
+                return
+            except IOError, err:
+                if err.errno not in (errno.EINVAL, errno.ENOTTY):
+                    raise
+            # Kernels older than 5.8 need two calls
+            fcntl.ioctl(dev, LOOP_SET_FD, backing)
+            try:
+                fcntl.ioctl(dev, LOOP_SET_STATUS64,
+                        struct.pack(LOOP_INFO64, *info))
+            except:
+                fcntl.ioctl(dev, LOOP_CLR_FD, 0)
+                raise
+        finally:
+            os.close(dev)
+
+    def _unbind(self, path):
+        try:
+            dev = os.open(path, os.O_RDONLY)
+            try:
+                fcntl.ioctl(dev, LOOP_CLR_FD, 0)
+            finally:
+                os.close(dev)
+        except (IOError, OSError), err:
+            if err.errno != errno.ENXIO:
+                log.warning("Failed to detach %s: %s", path, err)
+            return False
+        return True
+
+
+_manager = LoopManager()
+
+
+def getManager():
+    return _manager
+
 
 def loopAttach(image, offset=None, size=None):
+    if _manager.available():
+        return _manager.attach(image, offset=offset, size=size)
+    # Fall back to losetup on hosts without loop-control
     p = os.popen('losetup -f')
     dev = p.read().strip()
     p.close()
@@ -34,4 +231,7 @@ def loopAttach(image, offset=None, size=None):
 
 
 def loopDetach(dev):
+    if _manager.available():
+        _manager.detach(dev)
+        return
     logCall(['losetup', '-d', dev], ignoreErrors=True)
@@ -57,6 +57,7 @@ class LVMContainer(object):
         self.current_pe = 0
         self.pe_count = (totalSize - self.loc_data) // self.extent_size
         self.pvid = lvm_uuid()
+        self.inSession = False
         if not os.path.exists(image):
             open(image, 'w').close()
 
@@ -102,11 +103,35 @@ stripes = [
         fs = bootable_image.Filesystem(self.image, fsType, size=size,
                 offset=offset, fsLabel=name)
         self.filesystems.append(fs)
+        if self.inSession:
+            fs.attach()
         return fs
 
+    def open(self):
+        """
+        Start a session in which every volume, including those added later,
+        stays attached until L{close} is called.
+        """
+        if self.inSession:
+            return
+        self.inSession = True
+        for fs in self.filesystems:
+            fs.attach()
+
+    def close(self):
+        if not self.inSession:
+            return
+        self.inSession = False
+        for fs in self.filesystems:
+            fs.detach()
+
+    def getTimings(self):
+        return dict((fs.fsLabel, fs.timings) for fs in self.filesystems)
+
     def unmount(self):
         for fs in self.filesystems:
             fs.umount()
+        self.close()
         self.writeHeader()
 
     def writeHeader(self):
@@ -19,17 +19,22 @@
 Communicate status and artifacts back to the parent rBuilder.
 """
 
+import collections
 import logging
 import os
-import Queue
+import tempfile
 import threading
 import time
+import zlib
+from multiprocessing.pool import ThreadPool
 from conary.lib import digestlib
 from conary.lib.http import http_error
 from conary.lib.http import opener
 from conary.lib.http.request import URL
 from xml.etree import ElementTree as ET
+from jobslave import artifacts
 from jobslave import jobstatus
+from jobslave import upload
 
 log = logging.getLogger(__name__)
 
@@ -42,53 +47,183 @@ class BaseResponseProxy(object):
     def sendLog(self, data):
         pass
 
+    def startUpload(self, filePath):
+        pass
+
     def postOutput(self, fileList, withMetadata=True, attributes=None):
         pass
 
     def getImage(self, imageUrl):
         pass
 
+    def close(self, abort=False):
+        pass
+
 
 class ResponseProxy(BaseResponseProxy):
-    def __init__(self, masterUrl, jobData):
+    """
+    Send status, logs and output files to the parent rBuilder.
+
+    Output files are uploaded in the background by C{workers} threads, as
+    soon as they are passed to L{startUpload} or at the latest when they are
+    passed to L{postOutput}. Files larger than C{chunkSize} (if set) are sent
+    as a series of C{PUT} requests with a C{Content-Range} header, each
+    retried up to C{retries} times from its own offset, so a failure part way
+    through does not start the file over.
+
+    With C{sendfile} set, files are sent to plain HTTP servers by
+    L{upload.putFile} rather than being read into Python.
+    """
+
+    logCompressSize = 16 * 1024
+
+    def __init__(self, masterUrl, jobData, chunkSize=0, workers=1, retries=3,
+            sendfile=True, timeout=300):
         self.masterUrl = URL(masterUrl)
         self.imageBase = '%sapi/v1/images/%d' % (masterUrl, jobData['buildId'])
         self.uploadBase = '%suploadBuild/%d/' % (masterUrl, jobData['buildId'])
         self.outputToken = jobData['outputToken']
-        self.opener = opener.URLOpener(connectAttempts=2, followRedirects=True)
+        self.opener = self._newOpener()
+        self.chunkSize = chunkSize
+        self.workers = max(workers, 1)
+        self.retries = retries
+        self.timeout = timeout
+        self.useSendfile = sendfile and upload.canSendfile(self.uploadBase)
+        # Upload threads each get their own opener and connection
+        self._local = threading.local()
+        self._local.opener = self.opener
+        self._lock = threading.Lock()
+        self._pool = None
+        self._uploads = {}
 
         # Create a logger for things that are inside the log sending path, so
         # we can log to console without causing an infinite loop.
         self.log = logging.getLogger(__name__ + '.proxy')
         self.log.__class__ = NonSendingLogger
 
-    def post(self, method, path, contentType='application/xml', body=None):
-        headers = {
+    def _newOpener(self):
+        return opener.URLOpener(connectAttempts=2, followRedirects=True)
+
+    def _getOpener(self):
+        if not hasattr(self._local, 'opener'):
+            self._local.opener = self._newOpener()
+        return self._local.opener
+
+    def post(self, method, path, contentType='application/xml', body=None,
+            headers=None):
+        headers = dict(headers or {})
+        headers.update({
                 'Content-Type': contentType,
                 'X-rBuilder-OutputToken': self.outputToken,
-                }
+                })
         if path is None:
             url = self.imageBase
         else:
             url = "%s/%s" % (self.imageBase.rstrip('/'), path)
         return self.opener.open(url, data=body, method=method, headers=headers)
 
-    def postFileObject(self, method, targetName, fobj, size):
+    def _headers(self, extra=None):
         headers = {
                 'Content-Type': 'application/octet-stream',
                 'X-rBuilder-OutputToken': self.outputToken,
                 }
-        url = self.uploadBase + targetName
-        req = self.opener.newRequest(url, method=method, headers=headers)
-        body = DigestingReader(fobj)
+        headers.update(extra or {})
+        return headers
+
+    def _put(self, method, url, body, size, headers=None):
+        opener = self._getOpener()
+        req = opener.newRequest(url, method=method,
+                headers=self._headers(headers))
         req.setData(body, size=size)
-        self.opener.open(req)
-        return body.hexdigest()
+        opener.open(req)
+
+    def _ranges(self, size):
+        """
+        Yield the offset, length and extra headers of each request needed to
+        send C{size} bytes.
+        """
+        if not (self.chunkSize and size > self.chunkSize):
+            yield 0, size, {}
+            return
+        for offset in xrange(0, size, self.chunkSize):
+            length = min(self.chunkSize, size - offset)
+            yield offset, length, {'Content-Range': 'bytes %d-%d/%d' % (
+                offset, offset + length - 1, size)}
 
-    def postFile(self, method, targetName, filePath):
+    def _retry(self, url, offset, func, rewind=None, giveUp=()):
+        for attempt in range(self.retries + 1):
+            try:
+                return func()
+            except giveUp:
+                raise
+            except Exception, err:
+                if attempt == self.retries:
+                    raise
+                log.warning("Upload of %s failed at offset %d, "
+                        "retrying: %s", url, offset, err)
+                time.sleep(2 ** attempt)
+                if rewind:
+                    rewind()
+
+    def postFileObject(self, method, targetName, fobj, size, digest=None):
+        """
+        Upload C{size} bytes from C{fobj} and return their SHA-1 digest. If
+        C{digest} is given it is trusted rather than computed while sending.
+        """
+        url = self.uploadBase + targetName
+        if self.chunkSize and size > self.chunkSize:
+            return self._postChunks(method, url, fobj, size, digest)
+        if digest:
+            body = fobj
+        else:
+            body = DigestingReader(fobj)
+        self._put(method, url, body, size)
+        return digest or body.hexdigest()
+
+    def _postChunks(self, method, url, fobj, size, digest):
+        fileDigest = digestlib.sha1()
+        for offset, length, headers in self._ranges(size):
+            if digest:
+                body = RangeReader(fobj, offset, length)
+            else:
+                # Carries on from the digest of the chunks before it
+                body = DigestingReader(fobj, offset, length, fileDigest)
+            self._retry(url, offset, lambda: self._put(method, url, body,
+                length, headers), lambda: body.seek(0))
+            if not digest:
+                fileDigest = body.digest
+        return digest or fileDigest.hexdigest()
+
+    def _sendFile(self, method, url, fobj, size, digest):
+        hasher = None
+        if not digest:
+            hasher = upload.FileHasher(fobj, size)
+            hasher.start()
+        try:
+            for offset, length, headers in self._ranges(size):
+                self._retry(url, offset, lambda: upload.putFile(method, url,
+                    self._headers(headers), fobj, offset, length,
+                    timeout=self.timeout), giveUp=upload.UploadError)
+        finally:
+            if hasher:
+                hasher.join()
+        return digest or hasher.hexdigest()
+
+    def postFile(self, method, targetName, filePath, digest=None):
         fobj = open(filePath, 'rb')
-        size = os.fstat(fobj.fileno()).st_size
-        return self.postFileObject(method, targetName, fobj, size)
+        try:
+            size = os.fstat(fobj.fileno()).st_size
+            if self.useSendfile:
+                try:
+                    return self._sendFile(method,
+                            self.uploadBase + targetName, fobj, size, digest)
+                except upload.UploadError, err:
+                    # Redirects and errors are left to the regular client
+                    log.warning("%s, uploading again without sendfile", err)
+                    fobj.seek(0)
+            return self.postFileObject(method, targetName, fobj, size, digest)
+        finally:
+            fobj.close()
 
     def sendStatus(self, code, message):
         root = ET.Element('image')
@@ -103,28 +238,71 @@ class ResponseProxy(BaseResponseProxy):
             log.exception("Failed to send status upstream")
 
     def sendLog(self, data):
+        """
+        Append C{data} to the build log, gzipped if it is at least
+        C{logCompressSize} bytes. Errors are raised so that L{LogHandler} can
+        keep the data and try again.
+        """
+        headers = {}
+        if len(data) >= self.logCompressSize:
+            gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = gz.compress(data) + gz.flush()
+            headers['Content-Encoding'] = 'gzip'
         try:
-            try:
-                self.post('POST', 'build_log', contentType='text/plain', body=data)
-            except http_error.ResponseError, err:
-                if err.errcode != 204: # No Content
-                    raise
-        except:
-            self.log.exception("Error sending build log:")
+            self.post('POST', 'build_log', contentType='text/plain', body=data,
+                    headers=headers)
+        except http_error.ResponseError, err:
+            if err.errcode != 204: # No Content
+                raise
 
-    def postOutput(self, fileList, withMetadata=True, attributes=None):
-        root = ET.Element('files')
-        for n, (filePath, description) in enumerate(fileList):
-            # unicodify file names, dropping any invalid bytes
-            fileName = os.path.basename(filePath).decode('utf8', 'ignore')
+    def _postOutputFile(self, filePath):
+        # unicodify file names, dropping any invalid bytes
+        fileName = os.path.basename(filePath).decode('utf8', 'ignore')
 
-            fileSize = os.stat(filePath).st_size
-            log.info("Uploading %d of %d: %s (%d bytes)",
-                    n + 1, len(fileList), fileName, fileSize)
+        # Sizes and digests recorded when the file was written save
+        # hashing it again on the way out
+        artifact = artifacts.registry.lookup(filePath)
+        if artifact:
+            fileSize, digest = artifact.size, artifact.sha1
+        else:
+            fileSize, digest = os.stat(filePath).st_size, None
+        log.info("Uploading %s (%d bytes)", fileName, fileSize)
 
+        if digest:
+            self.postFile('PUT', fileName, filePath, digest=digest)
+        else:
             digest = self.postFile('PUT', fileName, filePath)
-            log.info(" %s uploaded, SHA-1 digest is %s", fileName, digest)
+            artifacts.registry.record(filePath, {'sha1': digest})
+        log.info(" %s uploaded, SHA-1 digest is %s", fileName, digest)
+        return fileName, fileSize, digest
+
+    def startUpload(self, filePath):
+        """
+        Start uploading the finished file C{filePath} in the background.
+        L{postOutput} waits for the upload rather than sending it again.
+        """
+        with self._lock:
+            if filePath in self._uploads:
+                return
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            self._uploads[filePath] = self._pool.apply_async(
+                    self._postOutputFile, (filePath,))
 
+    def postOutput(self, fileList, withMetadata=True, attributes=None):
+        for filePath, _ in fileList:
+            self.startUpload(filePath)
+        try:
+            results = [self._uploads[filePath].get()
+                    for filePath, _ in fileList]
+        finally:
+            with self._lock:
+                for filePath, _ in fileList:
+                    self._uploads.pop(filePath, None)
+
+        root = ET.Element('files')
+        for (_, description), (fileName, fileSize, digest) in zip(fileList,
+                results):
             file = ET.SubElement(root, 'file')
             ET.SubElement(file, 'title').text = description
             ET.SubElement(file, 'size').text = str(fileSize)
@@ -143,66 +321,243 @@ class ResponseProxy(BaseResponseProxy):
         imageUrl = self.masterUrl.join(imageUrl.path)
         return self.opener.open(imageUrl)
 
+    def close(self, abort=False):
+        """
+        Shut down the background uploads. With C{abort} set, uploads that
+        have not started yet are dropped instead of waited for. Errors from
+        uploads that L{postOutput} never collected are logged.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            uploads, self._uploads = self._uploads, {}
+        if pool is None:
+            return
+        if abort:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+        for filePath, result in sorted(uploads.items()):
+            if not result.ready():
+                # Dropped before it started
+                continue
+            try:
+                result.get(0)
+            except Exception:
+                log.exception("Background upload of %s failed:", filePath)
+
 
 class LogHandler(threading.Thread, logging.Handler):
     """
-    Log handler that periodically sends records upstream to the parent
-    rBuilder. All sending is done from a separate thread to avoid blocking the
+    Log handler that sends records upstream to the parent rBuilder in
+    batches. All sending is done from a separate thread to avoid blocking the
     caller.
+
+    A batch is sent once C{maxSize} bytes are waiting or C{maxWait} seconds
+    have passed. At most C{bufferSize} bytes are held in memory; beyond that
+    the oldest records are dropped and counted in C{dropped}. Batches that
+    cannot be sent are spooled to a temporary file in C{spoolDir}, up to
+    C{spoolSize} bytes, and sent again in order with delays growing from
+    C{minBackoff} to C{maxBackoff} seconds.
     """
-    maxSize = 4096
+    maxSize = 64 * 1024
     maxWait = 4
+    bufferSize = 4 * 1024 * 1024
+    spoolSize = 64 * 1024 * 1024
+    minBackoff = 1
+    maxBackoff = 60
 
-    def __init__(self, response):
+    def __init__(self, response, spoolDir=None):
         threading.Thread.__init__(self)
         logging.Handler.__init__(self)
         self.response = response
-        self.buffer = Queue.Queue()
-        self.started = self.stopped = False
+        self.spoolDir = spoolDir
+        self.records = collections.deque()
+        self.pending = 0
+        self.cond = threading.Condition(threading.Lock())
+        self.stopped = self.flushing = False
         self.daemon = True
 
+        # Records dropped so far, and how many of those the log already says
+        # are missing
+        self.dropped = 0
+        self.reported = 0
+        self.sentBytes = 0
+        self.failures = 0
+
+        self.spool = None
+        self.spoolStart = self.spoolEnd = 0
+
+        self.log = logging.getLogger(__name__ + '.logs')
+        self.log.__class__ = NonSendingLogger
+
     def close(self):
-        self.acquire()
-        started = self.started
+        self.cond.acquire()
         self.stopped = True
-        self.release()
+        self.cond.notify()
+        self.cond.release()
 
-        if started:
+        if self.ident is not None:
             self.join()
+        self.dropped += len(self.records)
+        self.records.clear()
+        self.pending = 0
+        if self.spool:
+            # Whatever is still spooled could not be sent before stopping
+            self.spool.seek(self.spoolStart)
+            self.dropped += self.spool.read(
+                    self.spoolEnd - self.spoolStart).count('\n')
+            self.spoolStart = self.spoolEnd = 0
+            self.spool.close()
+            self.spool = None
 
         logging.Handler.close(self)
 
+    def flush(self):
+        """
+        Send whatever is waiting without waiting for the batch to fill.
+        """
+        self.cond.acquire()
+        self.flushing = True
+        self.cond.notify()
+        self.cond.release()
+
     def emit(self, record):
         if getattr(record, 'dontSend', False):
             return
-        self.buffer.put(self.format(record) + '\n')
+        try:
+            line = self.format(record) + '\n'
+        except:
+            self.handleError(record)
+            return
+        self.cond.acquire()
+        try:
+            self.records.append(line)
+            self.pending += len(line)
+            while self.pending > self.bufferSize:
+                self.pending -= len(self.records.popleft())
+                self.dropped += 1
+            if self.pending >= self.maxSize:
+                self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def stats(self):
+        """
+        Return counters describing how much of the log has been shipped.
+        """
+        self.cond.acquire()
+        try:
+            return dict(
+                    pending=self.pending,
+                    dropped=self.dropped,
+                    sentBytes=self.sentBytes,
+                    spooled=self.spoolEnd - self.spoolStart,
+                    failures=self.failures,
+                    )
+        finally:
+            self.cond.release()
+
+    def _take(self):
+        """
+        Remove and return the next batch of about C{maxSize} bytes. Must be
+        called with the lock held.
+        """
+        items = []
+        size = 0
+        if self.dropped > self.reported:
+            # Leave a mark in the log where records went missing
+            items.append("*** %d log records dropped ***\n"
+                    % (self.dropped - self.reported))
+            self.reported = self.dropped
+        while self.records and size < self.maxSize:
+            item = self.records.popleft()
+            items.append(item)
+            size += len(item)
+        self.pending -= size
+        if not self.records:
+            self.flushing = False
+        return ''.join(items)
+
+    def _spoolData(self, data):
+        if self.spoolEnd - self.spoolStart + len(data) > self.spoolSize:
+            self.cond.acquire()
+            self.dropped += data.count('\n')
+            self.cond.release()
+            return
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile(dir=self.spoolDir,
+                    prefix='buildlog-')
+        self.spool.seek(self.spoolEnd)
+        self.spool.write(data)
+        self.spoolEnd = self.spool.tell()
+
+    def _ship(self, data):
+        """
+        Send C{data} after anything spooled by earlier failures. Returns
+        C{False} if sending failed, leaving the unsent data in the spool.
+        """
+        if self.spoolEnd > self.spoolStart:
+            self._spoolData(data)
+            data = ''
+        while self.spoolEnd > self.spoolStart:
+            self.spool.seek(self.spoolStart)
+            chunk = self.spool.read(min(self.spoolEnd - self.spoolStart,
+                self.maxSize * 16))
+            if not self._send(chunk):
+                return False
+            self.spoolStart += len(chunk)
+        self.spoolStart = self.spoolEnd = 0
+        if self.spool:
+            self.spool.truncate(0)
+        if data and not self._send(data):
+            self._spoolData(data)
+            return False
+        return True
+
+    def _send(self, data):
+        try:
+            self.response.sendLog(data)
+        except:
+            self.failures += 1
+            self.log.exception("Error sending build log:")
+            return False
+        self.sentBytes += len(data)
+        return True
 
     def run(self):
-        self.acquire()
-        self.started = True
-        self.release()
-
+        backoff = 0
         while True:
-            # Check if we're stopped first, but exit only after emptying the
-            # queue.
-            self.acquire()
-            stopped = self.stopped
-            self.release()
-
-            # Collect as many items as possible in 1 second.
-            start = time.time()
-            items = []
-            while time.time() - start < 1.0:
-                try:
-                    items.append(self.buffer.get(True, 0.1))
-                except Queue.Empty:
-                    continue
-
-            # Send all collected items upstream
-            if items:
-                self.response.sendLog(''.join(items))
-
-            if stopped:
+            # Wait for a full batch, the batch timer, or the delay after a
+            # failure.
+            self.cond.acquire()
+            try:
+                deadline = time.time() + (backoff or self.maxWait)
+                while not self.stopped:
+                    if not backoff and (self.flushing
+                            or self.pending >= self.maxSize):
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                stopped = self.stopped
+                data = self._take()
+            finally:
+                self.cond.release()
+
+            failed = False
+            if data or self.spoolEnd > self.spoolStart:
+                if self._ship(data):
+                    backoff = 0
+                else:
+                    failed = True
+                    backoff = min(max(backoff * 2, self.minBackoff),
+                            self.maxBackoff)
+
+            # Once stopped, keep going until the buffer is empty unless
+            # upstream is failing
+            if stopped and (failed or not self.records):
                 return
 
 
@@ -216,23 +571,57 @@ class NonSendingLogger(logging.Logger):
         return record
 
 
-class DigestingReader(object):
+class RangeReader(object):
+    """
+    Read C{length} bytes of C{fobj} starting at C{offset}, or everything
+    from C{offset} on if C{length} is C{None}.
+    """
 
-    def __init__(self, fobj):
+    def __init__(self, fobj, offset=0, length=None):
         self.fobj = fobj
-        self.digest = digestlib.sha1()
-
-    def read(self, numbytes=None):
+        self.offset = offset
+        self.length = length
+        self.seek(0)
+
+    def read(self, numbytes=-1):
+        if self.remaining is not None:
+            if numbytes < 0 or numbytes > self.remaining:
+                numbytes = self.remaining
+            if not numbytes:
+                return ''
         d = self.fobj.read(numbytes)
-        self.digest.update(d)
+        if self.remaining is not None:
+            self.remaining -= len(d)
         return d
 
     def seek(self, where):
-        # This allows the conary http client to rewind the body file, and
-        # resets the digest along with it.
+        # This allows the conary http client to rewind the body file.
         assert where == 0
-        self.digest = digestlib.sha1()
-        self.fobj.seek(0)
+        self.fobj.seek(self.offset)
+        self.remaining = self.length
+
+
+class DigestingReader(RangeReader):
+    """
+    L{RangeReader} that feeds what it reads to C{digest}, a new SHA-1 by
+    default. Rewinding restores the digest to its state at C{offset}, so a
+    retried chunk does not restart the file's digest from the beginning.
+    """
+
+    def __init__(self, fobj, offset=0, length=None, digest=None):
+        if digest is None:
+            digest = digestlib.sha1()
+        self.checkpoint = digest.copy()
+        RangeReader.__init__(self, fobj, offset, length)
+
+    def read(self, numbytes=-1):
+        d = RangeReader.read(self, numbytes)
+        self.digest.update(d)
+        return d
+
+    def seek(self, where):
+        RangeReader.seek(self, where)
+        self.digest = self.checkpoint.copy()
 
     def hexdigest(self):
         return self.digest.hexdigest()
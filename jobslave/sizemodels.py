@@ -0,0 +1,243 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Estimate filesystem sizes from the files that will be installed into them.
+
+Each model takes a L{jobslave.filesystems.MountUsage} and the amount of free
+space requested and returns the size in bytes of a filesystem, as created by
+L{jobslave.generators.bootable_image.Filesystem.format}, that can hold both.
+"""
+
+from math import ceil
+
+from jobslave.filesystems import BLOCK_SIZE
+from jobslave.util import divCeil
+
+MB = 1024 * 1024
+
+# Room for files created during the install that are not part of any
+# changeset. Initrds, tag script output and caches take a roughly fixed
+# amount; the conary and rpm databases grow with the number of files.
+INSTALL_SLACK = 48 * MB
+SLACK_PER_FILE = 2048
+
+# Padding used by the legacy model, which predates the per-filesystem models
+# and must keep producing the same sizes.
+LEGACY_SLACK = 20 * MB
+LEGACY_RATIO = 0.87
+
+
+def installSlack(usage):
+    """
+    Return the bytes to leave for files written during the install into the
+    filesystem described by C{usage}.
+    """
+    return INSTALL_SLACK + (usage.files + usage.directories) * SLACK_PER_FILE
+
+
+class SizeModel(object):
+
+    def __init__(self, fsType):
+        self.fsType = fsType
+
+    def getSize(self, usage, freeSpace=0):
+        raise NotImplementedError
+
+
+class LegacyModel(SizeModel):
+    """
+    Pad the data size by a fixed amount and a fixed ratio.
+    """
+
+    def getSize(self, usage, freeSpace=0):
+        return int(ceil((usage.legacySize + freeSpace + LEGACY_SLACK)
+            / LEGACY_RATIO))
+
+
+class BlockModel(SizeModel):
+    """
+    Base class for models that compute metadata overhead from a candidate
+    size and iterate until the size is large enough for data plus metadata.
+    """
+    maxIterations = 20
+
+    def neededBlocks(self, usage, freeSpace):
+        return (usage.dataBlocks + usage.dirBlocks
+                + divCeil(freeSpace + installSlack(usage), BLOCK_SIZE))
+
+    def overheadBlocks(self, blocks, usage):
+        raise NotImplementedError
+
+    def minimumBlocks(self, blocks, usage):
+        return 0
+
+    def getSize(self, usage, freeSpace=0):
+        needed = self.neededBlocks(usage, freeSpace)
+        blocks = max(needed, self.minimumBlocks(needed, usage))
+        for x in range(self.maxIterations):
+            total = max(needed + self.overheadBlocks(blocks, usage),
+                    self.minimumBlocks(blocks, usage))
+            if total <= blocks:
+                break
+            blocks = total
+        return long(blocks) * BLOCK_SIZE
+
+
+class ExtModel(BlockModel):
+    """
+    ext3/ext4 as created by mke2fs with a 4 KiB block size and the stock
+    mke2fs.conf: one inode per 16 KiB (per 4 KiB below 512 MiB), 5% of
+    blocks reserved for root, and the default journal size.
+    """
+    blocksPerGroup = 32768
+    reservedRatio = 0.05
+    descSize = 32
+    extents = False
+    # Inodes 1-10 are reserved and 11 is lost+found
+    reservedInodes = 11
+    inodeMargin = 1.05
+
+    def inodeParams(self, blocks):
+        # (bytes per inode, inode size) from mke2fs.conf
+        if blocks * BLOCK_SIZE < 512 * MB:
+            return 4096, 128
+        return 16384, 256
+
+    def neededBlocks(self, usage, freeSpace):
+        blocks = BlockModel.neededBlocks(self, usage, freeSpace)
+        if not self.extents:
+            blocks += usage.mapBlocks
+        return blocks
+
+    def minimumBlocks(self, blocks, usage):
+        # Enough blocks that the inode ratio used at this size yields enough
+        # inodes. Growing past the small filesystem threshold lowers the
+        # ratio, which the next iteration picks up.
+        inodes = int((usage.files + usage.directories + self.reservedInodes)
+                * self.inodeMargin)
+        ratio, inodeSize = self.inodeParams(blocks)
+        return divCeil(inodes * ratio, BLOCK_SIZE)
+
+    @staticmethod
+    def journalBlocks(blocks):
+        # ext2fs_default_journal_size()
+        if blocks < 2048:
+            return 0
+        if blocks < 32768:
+            return 1024
+        if blocks < 256 * 1024:
+            return 4096
+        if blocks < 512 * 1024:
+            return 8192
+        if blocks < 4096 * 1024:
+            return 16384
+        if blocks < 8192 * 1024:
+            return 32768
+        if blocks < 16384 * 1024:
+            return 65536
+        if blocks < 32768 * 1024:
+            return 131072
+        return 262144
+
+    @staticmethod
+    def hasBackup(group):
+        # sparse_super: groups 0, 1 and powers of 3, 5 and 7
+        if group <= 1:
+            return True
+        for base in (3, 5, 7):
+            n = base
+            while n < group:
+                n *= base
+            if n == group:
+                return True
+        return False
+
+    def overheadBlocks(self, blocks, usage):
+        groups = divCeil(blocks, self.blocksPerGroup)
+        ratio, inodeSize = self.inodeParams(blocks)
+        inodesPerGroup = self.blocksPerGroup * BLOCK_SIZE / ratio
+        inodeTable = groups * divCeil(inodesPerGroup * inodeSize, BLOCK_SIZE)
+        bitmaps = 2 * groups
+
+        # Superblock and group descriptor backups, including the descriptor
+        # blocks reserved for online resize (up to 1024x growth).
+        descPerBlock = BLOCK_SIZE / self.descSize
+        gdtBlocks = divCeil(groups, descPerBlock)
+        maxGroups = divCeil(min(blocks * 1024, 2 ** 32 - 1),
+                self.blocksPerGroup)
+        reservedGdt = min(max(divCeil(maxGroups, descPerBlock) - gdtBlocks,
+            0), BLOCK_SIZE / 4)
+        backups = sum(1 for x in range(groups) if self.hasBackup(x))
+        superBlocks = backups * (1 + gdtBlocks + reservedGdt)
+
+        reserved = int(ceil(blocks * self.reservedRatio))
+        return (inodeTable + bitmaps + superBlocks + reserved
+                + self.journalBlocks(blocks))
+
+
+class Ext3Model(ExtModel):
+    pass
+
+
+class Ext4Model(ExtModel):
+    extents = True
+    descSize = 64
+
+
+class XfsModel(BlockModel):
+    """
+    XFS with mkfs.xfs defaults: dynamically allocated 512 byte inodes, an
+    internal log and the in-kernel reserve block pool.
+    """
+    inodeSize = 512
+    inodesPerChunk = 64
+    agCount = 4
+    minLog = 10 * MB
+    maxLog = 2048 * MB
+    # Free space and inode btrees, AG headers
+    metadataRatio = 0.01
+
+    def overheadBlocks(self, blocks, usage):
+        inodes = usage.files + usage.directories + 3
+        chunks = divCeil(inodes, self.inodesPerChunk)
+        inodeBlocks = divCeil(chunks * self.inodesPerChunk * self.inodeSize,
+                BLOCK_SIZE)
+        logBytes = min(max(blocks * BLOCK_SIZE / 256, self.minLog),
+                self.maxLog)
+        reserve = min(int(ceil(blocks * 0.05)), 8192)
+        metadata = int(ceil(blocks * self.metadataRatio)) + self.agCount * 4
+        return (inodeBlocks + divCeil(logBytes, BLOCK_SIZE) + reserve
+                + metadata)
+
+
+MODELS = {
+        'ext3': Ext3Model,
+        'ext4': Ext4Model,
+        'xfs': XfsModel,
+        }
+
+
+def getModel(fsType, legacy=False):
+    """
+    Return a size model instance for filesystem type C{fsType}. Types with no
+    specific model, or all types if C{legacy} is set, use the fixed padding
+    of L{LegacyModel}.
+    """
+    if legacy:
+        return LegacyModel(fsType)
+    return MODELS.get(fsType, LegacyModel)(fsType)
@@ -19,7 +19,7 @@ import logging
 import json
 import sys
 from conary.lib.cfg import ConfigFile
-from conary.lib.cfgtypes import CfgBool, CfgString, CfgPath
+from conary.lib.cfgtypes import CfgBool, CfgDict, CfgInt, CfgString, CfgPath
 
 from jobslave import jobhandler
 from jobslave.util import setupLogging
@@ -32,6 +32,43 @@ class SlaveConfig(ConfigFile):
     jobDataPath = (CfgPath, '/tmp/jobData')
     templateCache = (CfgPath, '/mnt/anaconda-templates')
     binPath = (CfgPath, '/usr/bin')
+    # Upload output files this many at a time, in chunks of this many bytes
+    # (0 sends each file in one request), retrying a failed chunk this many
+    # times
+    uploadWorkers = (CfgInt, 2)
+    uploadChunkSize = (CfgInt, 0)
+    uploadRetries = (CfgInt, 3)
+    # Send uploads to plain HTTP masters with sendfile(2)
+    uploadSendfile = (CfgBool, True)
+    # Give up on an upload request after this many seconds without progress
+    uploadTimeout = (CfgInt, 300)
+    # Size changesets in a pool of this many forked processes (1 reads them
+    # in the job's own process). The pool forks after the log and upload
+    # threads have started, which can deadlock a worker, so it is opt-in.
+    sizingWorkers = (CfgInt, 1)
+    # Keep up to this many MiB of changesets for later jobs on this node
+    # (0 disables the cache), away from the scratch space images are built in
+    changesetCacheSize = (CfgInt, 0)
+    changesetCachePath = (CfgPath, '/srv/jobslave/changesets')
+    # Apply changesets while downloading up to this many ahead, if the image
+    # is not sized first (0, the default, downloads everything before
+    # installing)
+    installPrefetch = (CfgInt, 0)
+    # SQLite pragmas for the conary database while installing. The database
+    # is checkpointed and returned to rollback journal mode afterwards.
+    conarydbPragmas = (CfgDict(CfgString), {
+        'cache_size': '200000',
+        'journal_mode': 'WAL',
+        'mmap_size': '268435456',
+        'synchronous': 'OFF',
+        'temp_store': 'MEMORY',
+        })
+    # Install troves into a staging root and copy it into the image
+    # filesystems in one pass, instead of restoring each file through the
+    # loop device. Staging uses a tmpfs unless a directory on fast scratch
+    # storage is given.
+    installStaging = (CfgBool, False)
+    stagingDir = (CfgPath, None)
 
 
 def main(args):
@@ -0,0 +1,153 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Allocate disk image containers using ftruncate/fallocate instead of dd.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# from linux/fs.h; not exported by the os module
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# Allocation modes, selectable per build with the diskAllocation build data
+ALLOC_SPARSE = 'sparse'
+ALLOC_PREALLOCATE = 'preallocate'
+ALLOC_MODES = (ALLOC_SPARSE, ALLOC_PREALLOCATE)
+
+_fallocate = None
+
+
+def _getFallocate():
+    global _fallocate
+    if _fallocate is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'fallocate64', None) or libc.fallocate
+        func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                ctypes.c_int64]
+        func.restype = ctypes.c_int
+        _fallocate = func
+    return _fallocate
+
+
+def fallocate(fd, mode, offset, length):
+    """
+    Call fallocate(2) on file descriptor C{fd}, raising C{OSError} on
+    failure.
+    """
+    if hasattr(fd, 'fileno'):
+        fd = fd.fileno()
+    rc = _getFallocate()(fd, mode, offset, length)
+    if rc != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def punchHole(fd, offset, length):
+    """
+    Deallocate C{length} bytes at C{offset} without changing the file size.
+    The range will read back as zeroes. Returns C{False} if the filesystem
+    does not support hole punching, in which case nothing is changed.
+    """
+    try:
+        fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset,
+                length)
+    except OSError, err:
+        if err.errno in (errno.EOPNOTSUPP, errno.ENOSYS):
+            return False
+        raise
+    return True
+
+
+def allocate(path, size, mode=ALLOC_SPARSE):
+    """
+    Create (or resize) the file at C{path} to be C{size} bytes long.
+
+    In C{sparse} mode the file is simply extended with ftruncate, so no blocks
+    are allocated until they are written. In C{preallocate} mode all blocks
+    are reserved up front with fallocate so that running out of scratch space
+    is detected before the install starts rather than halfway through it. If
+    the filesystem cannot preallocate, a sparse file is created instead.
+    """
+    if mode not in ALLOC_MODES:
+        raise ValueError("Invalid disk allocation mode '%s'" % (mode,))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        if mode == ALLOC_PREALLOCATE:
+            try:
+                fallocate(fd, 0, 0, size)
+            except OSError, err:
+                if err.errno not in (errno.EOPNOTSUPP, errno.ENOSYS):
+                    raise
+                log.warning("Filesystem does not support preallocation; "
+                        "creating a sparse file instead")
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+    return allocatedSize(path)
+
+
+def allocatedSize(path):
+    """
+    Return the number of bytes actually allocated on disk for C{path}.
+    """
+    return os.stat(path).st_blocks * 512
+
+
+def iterExtents(fd, start=0, end=None):
+    """
+    Yield C{(offset, length, isData)} tuples covering the file open on C{fd}
+    from C{start} to C{end} (default end of file), alternating between
+    allocated data and holes. Holes read back as zeroes. If the filesystem
+    cannot report holes, the whole range is returned as data.
+    """
+    if hasattr(fd, 'fileno'):
+        fd = fd.fileno()
+    if end is None:
+        end = os.fstat(fd).st_size
+    pos = start
+    while pos < end:
+        try:
+            dataStart = os.lseek(fd, pos, SEEK_DATA)
+        except OSError, err:
+            if err.errno == errno.ENXIO:
+                # Nothing but hole until the end of the file
+                dataStart = end
+            elif err.errno == errno.EINVAL and pos == start:
+                yield start, end - start, True
+                return
+            else:
+                raise
+        dataStart = min(dataStart, end)
+        if dataStart > pos:
+            yield pos, dataStart - pos, False
+        if dataStart >= end:
+            break
+        dataEnd = min(os.lseek(fd, dataStart, SEEK_HOLE), end)
+        yield dataStart, dataEnd - dataStart, True
+        pos = dataEnd
@@ -0,0 +1,168 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Write tar archives one member at a time without staging the members on
+disk first.
+
+Members whose size is not known in advance, such as compressed data, are
+streamed straight into the archive after a placeholder header, which is
+rewritten with the real size once the member is complete. This requires the
+archive to be a seekable file.
+"""
+
+import tarfile
+import time
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+RECORD_SIZE = tarfile.RECORDSIZE
+
+
+class TarMember(object):
+    """
+    File-like object for the data of one archive member. Call L{close} when
+    done to finish the member.
+    """
+
+    def __init__(self, archive, info):
+        self.archive = archive
+        self.info = info
+        self.size = 0
+
+    def write(self, data):
+        self.archive.fobj.write(data)
+        self.size += len(data)
+
+    def close(self):
+        if self.archive._member is self:
+            self.archive._finishMember(self)
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+
+
+class TarWriter(object):
+    """
+    Write a GNU tar archive to file object C{fobj}. All members get the
+    same modification time, by default the time the archive was started.
+    """
+
+    def __init__(self, fobj, mtime=None):
+        self.fobj = fobj
+        if mtime is None:
+            mtime = int(time.time())
+        self.mtime = mtime
+        self.offset = fobj.tell()
+        self._member = None
+
+    def _info(self, name, size, mode):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = mode
+        info.mtime = self.mtime
+        info.uname = info.gname = 'root'
+        return info
+
+    def _pad(self, size):
+        remainder = size % BLOCK_SIZE
+        if remainder:
+            self.fobj.write('\0' * (BLOCK_SIZE - remainder))
+
+    def addData(self, name, data, mode=0644):
+        """
+        Add a member named C{name} holding the string C{data}. Returns the
+        offset of the data in the archive, for use with L{rewrite}.
+        """
+        assert self._member is None
+        self.fobj.write(self._info(name, len(data), mode).tobuf(
+            tarfile.GNU_FORMAT))
+        offset = self.fobj.tell()
+        self.fobj.write(data)
+        self._pad(len(data))
+        return offset
+
+    def rewrite(self, offset, data):
+        """
+        Overwrite member data already in the archive, starting at C{offset}.
+        The new data must not be longer than the old, as the member size in
+        its header is left alone.
+        """
+        end = self.fobj.tell()
+        self.fobj.seek(offset)
+        self.fobj.write(data)
+        self.fobj.seek(end)
+
+    def addFile(self, name, fobj, size, mode=0644, bufSize=1024 * 1024,
+            digest=None):
+        """
+        Add a member named C{name} with C{size} bytes read from C{fobj}. If
+        C{digest} is given, it is a hash object that is updated with the
+        data as it is copied.
+        """
+        assert self._member is None
+        self.fobj.write(self._info(name, size, mode).tobuf(
+            tarfile.GNU_FORMAT))
+        left = size
+        while left:
+            data = fobj.read(min(left, bufSize))
+            if not data:
+                raise IOError("Unexpected end of file adding %s to archive"
+                        % (name,))
+            if digest is not None:
+                digest.update(data)
+            self.fobj.write(data)
+            left -= len(data)
+        self._pad(size)
+
+    def member(self, name, mode=0644):
+        """
+        Start a member named C{name} whose size is not known yet and return
+        a L{TarMember} to write its contents to.
+        """
+        assert self._member is None
+        info = self._info(name, 0, mode)
+        info.offset = self.fobj.tell()
+        # The header is the same length whatever the size turns out to be
+        self.fobj.write(info.tobuf(tarfile.GNU_FORMAT))
+        self._member = TarMember(self, info)
+        return self._member
+
+    def _finishMember(self, member):
+        self._member = None
+        self._pad(member.size)
+        end = self.fobj.tell()
+        member.info.size = member.size
+        self.fobj.seek(member.info.offset)
+        self.fobj.write(member.info.tobuf(tarfile.GNU_FORMAT))
+        self.fobj.seek(end)
+
+    def close(self):
+        """
+        Write the end of archive marker, padded to a full record as GNU tar
+        does.
+        """
+        assert self._member is None
+        self.fobj.write('\0' * (BLOCK_SIZE * 2))
+        length = self.fobj.tell() - self.offset
+        remainder = length % RECORD_SIZE
+        if remainder:
+            self.fobj.write('\0' * (RECORD_SIZE - remainder))
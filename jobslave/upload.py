@@ -0,0 +1,176 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Upload files over plain HTTP with the body copied from the page cache to
+the socket by sendfile(2), so the data never passes through Python strings.
+
+Digests of the uploaded data come from a separate thread hashing an mmap of
+the file, which runs alongside the transfer. hashlib releases the GIL while
+hashing large buffers, so the two do not contend.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import httplib
+import mmap
+import os
+import select
+import socket
+import threading
+import urllib
+import urlparse
+
+HASH_SIZE = 8 * 1024 * 1024
+
+_sendfile = None
+
+
+class UploadError(IOError):
+
+    def __init__(self, url, status, reason):
+        IOError.__init__(self, "%s: %s %s" % (url, status, reason))
+        self.url = url
+        self.status = status
+        self.reason = reason
+
+
+def _getSendfile():
+    global _sendfile
+    if _sendfile is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'sendfile64', None) or libc.sendfile
+        func.argtypes = [ctypes.c_int, ctypes.c_int,
+                ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        func.restype = ctypes.c_ssize_t
+        _sendfile = func
+    return _sendfile
+
+
+def sendfile(outFd, inFd, offset, count):
+    """
+    Copy up to C{count} bytes at C{offset} in C{inFd} to C{outFd} without
+    going through user space, and return the number of bytes copied.
+    """
+    pos = ctypes.c_int64(offset)
+    while True:
+        rc = _getSendfile()(outFd, inFd, ctypes.byref(pos), count)
+        if rc >= 0:
+            return rc
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+
+def canSendfile(url):
+    """
+    Return C{True} if uploads to C{url} can use L{putFile}: sendfile cannot
+    write through TLS, and credentials in the URL and proxies are left to the
+    regular client.
+    """
+    url = urlparse.urlsplit(url)
+    if url.scheme != 'http' or url.username:
+        return False
+    if 'http' in urllib.getproxies() and not urllib.proxy_bypass(url.hostname):
+        return False
+    try:
+        _getSendfile()
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+def putFile(method, url, headers, fobj, offset, length, timeout=None):
+    """
+    Send C{length} bytes of C{fobj} starting at C{offset} as the body of a
+    C{method} request to the plain HTTP C{url}. Raises L{UploadError} if the
+    server does not answer with success, including redirects, which are not
+    followed. Raises C{socket.timeout} if the connection stalls for
+    C{timeout} seconds.
+    """
+    parts = urlparse.urlsplit(url)
+    path = parts.path
+    if parts.query:
+        path += '?' + parts.query
+    conn = httplib.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+    try:
+        conn.putrequest(method, path, skip_accept_encoding=True)
+        for key, value in headers.iteritems():
+            conn.putheader(key, value)
+        conn.putheader('Content-Length', str(length))
+        conn.endheaders()
+        sock = conn.sock.fileno()
+        sent = 0
+        while sent < length:
+            try:
+                count = sendfile(sock, fobj.fileno(), offset + sent,
+                        length - sent)
+            except OSError, err:
+                # With a timeout the socket is non-blocking
+                if err.errno != errno.EAGAIN:
+                    raise
+                if not select.select([], [sock], [], timeout)[1]:
+                    raise socket.timeout("%s: timed out" % url)
+                continue
+            if not count:
+                raise IOError("%s ended before %d bytes were sent" %
+                        (getattr(fobj, 'name', 'File'), length))
+            sent += count
+        response = conn.getresponse()
+        response.read()
+        if not 200 <= response.status < 300:
+            raise UploadError(url, response.status, response.reason)
+    finally:
+        conn.close()
+
+
+class FileHasher(threading.Thread):
+    """
+    Compute the C{algorithm} digest of the first C{length} bytes of the file
+    open as C{fobj}, on a thread of its own. Call L{hexdigest} for the
+    result.
+    """
+
+    def __init__(self, fobj, length, algorithm='sha1'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fileno = fobj.fileno()
+        self.length = length
+        self.digest = hashlib.new(algorithm)
+        self.error = None
+
+    def run(self):
+        try:
+            if not self.length:
+                return
+            mm = mmap.mmap(self.fileno, self.length, mmap.MAP_SHARED,
+                    mmap.PROT_READ)
+            try:
+                for offset in xrange(0, self.length, HASH_SIZE):
+                    self.digest.update(buffer(mm, offset, HASH_SIZE))
+            finally:
+                mm.close()
+        except Exception, err:
+            self.error = err
+
+    def hexdigest(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.digest.hexdigest()
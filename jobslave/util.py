@@ -15,6 +15,7 @@
 #
 
 
+import fcntl
 import logging
 import os
 import re
@@ -23,6 +24,7 @@ import stat
 import subprocess
 import sys
 import tempfile
+from contextlib import contextmanager
 from conary.lib import log
 
 
@@ -161,6 +163,20 @@ def getFileSize(filePath):
     return os.stat(filePath)[stat.ST_SIZE]
 
 
+@contextmanager
+def lockFile(path, mode=fcntl.LOCK_EX):
+    """
+    Hold a flock(2) lock of type C{mode} on C{path}, creating it if needed,
+    for the duration of the block.
+    """
+    fobj = open(path, 'a')
+    try:
+        fcntl.flock(fobj.fileno(), mode)
+        yield
+    finally:
+        fobj.close()
+
+
 def setupLogging(logLevel=logging.INFO, toStderr=True, toFile=None):
     """
     Set up a root logger with default options and possibly a file to
@@ -0,0 +1,817 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Write, check and repair VMware sparse disks (VMDK).
+
+The output is the same as that of C{raw2vmdk}: monolithicSparse (split into
+twoGbMaxExtentSparse extents above 4095 MiB) or streamOptimized, as described
+in the VMware Virtual Disk Format 5.0 technote. Grains that lie in a hole of
+the input, or that read back as all zeroes, are left out. streamOptimized
+grains are deflated on a pool of worker threads.
+
+L{VMDKReader} checks the metadata of existing disks through a memory mapping
+of the file, and L{fixGrainDirectory} rebuilds the trailing metadata of a
+streamOptimized disk from its grains.
+"""
+
+import collections
+import mmap
+import multiprocessing
+import os
+import stat
+import struct
+import time
+import zlib
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from jobslave import artifacts
+from jobslave import sparsefile
+
+SECTOR_SIZE = 512
+GRAIN_SECTORS = 128
+GRAIN_SIZE = GRAIN_SECTORS * SECTOR_SIZE
+GTES_PER_GT = 512
+# Sectors occupied by one grain table
+GT_SECTORS = GTES_PER_GT * 4 / SECTOR_SIZE
+
+MONOLITHIC_SPARSE = 'monolithicSparse'
+STREAM_OPTIMIZED = 'streamOptimized'
+TWO_GB_MAX_EXTENT_SPARSE = 'twoGbMaxExtentSparse'
+
+MAX_EXTENT_SIZE = 2047 * 1024 * 1024
+MAX_MONOLITHIC_SIZE = 4095 * 1024 * 1024
+
+MAGIC = 'KDMV'
+# Start of a descriptor file that lists separate extent files
+DESCRIPTOR_MAGIC = '# Disk DescriptorFile'
+GD_AT_END = 0xffffffffffffffff
+COMPRESSION_NONE = 0
+COMPRESSION_DEFLATE = 1
+
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+
+Header = namedtuple('Header', 'magicNumber version flags capacity '
+    'grainSize descriptorOffset descriptorSize numGTEsPerGT rgdOffset '
+    'gdOffset overHead uncleanShutdown singleEndLineChar nonEndLineChar '
+    'doubleEndLineChar1 doubleEndLineChar2 compressAlgorithm pad')
+HEADER_FORMAT = '<4sIIQQQQIQQQBccccH433s'
+
+# lba, compressed size
+GRAIN_MARKER_FORMAT = '<QI'
+# numSectors, size (always 0), type, padding to a full sector
+METADATA_MARKER_FORMAT = '<QII496s'
+
+_ZERO_GRAIN = '\0' * GRAIN_SIZE
+
+
+def _pad(number, size):
+    return (number + size - 1) / size * size
+
+
+def _divCeil(number, size):
+    return (number + size - 1) / size
+
+
+def numGTs(extentSize):
+    return _divCeil(_divCeil(extentSize, GRAIN_SIZE), GTES_PER_GT)
+
+
+def makeHeader(diskType, extentSize, descriptorSectors):
+    """
+    Return the L{Header} of an extent of C{extentSize} bytes, with an
+    embedded descriptor of C{descriptorSectors} sectors (0 for none).
+    """
+    gts = numGTs(extentSize)
+    # Sectors for the grain directory followed by all of the grain tables
+    gdSectors = _divCeil(gts * 4, SECTOR_SIZE)
+    metadataSectors = gdSectors + gts * GT_SECTORS
+    descriptorOffset = descriptorSectors and 1 or 0
+    if diskType == STREAM_OPTIMIZED:
+        version, flags = 3, 0x30001
+        rgdOffset = 0
+        gdOffset = GD_AT_END
+        overHead = GRAIN_SECTORS
+        compression = COMPRESSION_DEFLATE
+    else:
+        version, flags = 1, 0x3
+        # Leave at least one sector for the header
+        rgdOffset = max(descriptorOffset + descriptorSectors, 1)
+        gdOffset = rgdOffset + metadataSectors
+        overHead = _pad(gdOffset + metadataSectors, GRAIN_SECTORS)
+        compression = COMPRESSION_NONE
+    return Header(MAGIC, version, flags, extentSize / SECTOR_SIZE,
+            GRAIN_SECTORS, descriptorOffset, descriptorSectors, GTES_PER_GT,
+            rgdOffset, gdOffset, overHead, 0, '\n', ' ', '\r', '\n',
+            compression, '')
+
+
+def packHeader(header):
+    return struct.pack(HEADER_FORMAT, *header)
+
+
+def unpackHeader(data):
+    return Header(*struct.unpack(HEADER_FORMAT, data[:SECTOR_SIZE]))
+
+
+def packMarker(numSectors, markerType):
+    return struct.pack(METADATA_MARKER_FORMAT, numSectors, 0, markerType, '')
+
+
+class Descriptor(object):
+    """
+    The text descriptor of a disk, listing its extents as
+    C{(sectors, filename)} pairs.
+    """
+
+    def __init__(self, diskType, extents, cylinders, heads, sectors,
+            adapter='ide', hwVersion=7):
+        self.diskType = diskType
+        self.extents = extents
+        self.cylinders = cylinders
+        self.heads = heads
+        self.sectors = sectors
+        self.adapter = adapter
+        self.hwVersion = hwVersion
+
+    def __str__(self):
+        if self.diskType == STREAM_OPTIMIZED:
+            access = 'RDONLY'
+        else:
+            access = 'RW'
+        lines = [
+                '# Disk DescriptorFile',
+                'version=1 ',
+                'CID=fffffffe ',
+                'parentCID=ffffffff ',
+                'createType="%s" ' % self.diskType,
+                '',
+                '# Extent description',
+                ]
+        for sectors, fileName in self.extents:
+            lines.append('%s %d SPARSE "%s"' % (access, sectors,
+                os.path.basename(fileName)))
+        lines += [
+                '',
+                '# The Disk Data Base ',
+                '#DDB',
+                '',
+                'ddb.adapterType = "%s"' % self.adapter,
+                'ddb.encoding = "UTF-8"',
+                'ddb.geometry.cylinders = "%d"' % self.cylinders,
+                'ddb.geometry.heads = "%d"' % self.heads,
+                'ddb.geometry.sectors = "%d"' % self.sectors,
+                'ddb.toolsVersion = "8193"',
+                'ddb.virtualHWVersion = "%d"' % self.hwVersion,
+                ]
+        return '\n'.join(lines) + '\n'
+
+
+class VMDKStats(object):
+    """
+    Progress of a conversion: bytes of input covered so far, and grains
+    written or skipped because they were empty.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.completed = 0
+        self.written = 0
+        self.skipped = 0
+        self.startTime = time.time()
+        self.elapsed = 0.0
+
+    def rate(self):
+        elapsed = self.elapsed or time.time() - self.startTime
+        return elapsed and self.completed / elapsed or 0
+
+    def __str__(self):
+        return ("%d bytes in %.1f seconds (%d grains written, %d empty "
+                "grains skipped)" % (self.completed, self.elapsed,
+                    self.written, self.skipped))
+
+
+def _read(fd, length):
+    chunks = []
+    while length:
+        data = os.read(fd, length)
+        if not data:
+            break
+        chunks.append(data)
+        length -= len(data)
+    return ''.join(chunks)
+
+
+def iterGrains(fd, size, stats):
+    """
+    Yield the contents of each grain of the C{size} byte image open on C{fd},
+    or C{None} for grains that are empty. If C{fd} is a regular file, grains
+    that lie entirely in a hole are not read. Otherwise it is read
+    sequentially from its current position.
+    """
+    regular = stat.S_ISREG(os.fstat(fd).st_mode)
+    if regular:
+        dataExtents = ((offset, offset + length) for offset, length, isData
+                in sparsefile.iterExtents(fd, 0, size) if isData)
+    dataStart = dataEnd = 0
+    for offset in xrange(0, size, GRAIN_SIZE):
+        length = min(GRAIN_SIZE, size - offset)
+        stats.completed += length
+        if regular:
+            while dataEnd <= offset:
+                dataStart, dataEnd = next(dataExtents, (size, size))
+            if offset + length <= dataStart:
+                stats.skipped += 1
+                yield None
+                continue
+            os.lseek(fd, offset, 0)
+        data = _read(fd, length)
+        if len(data) != length:
+            raise IOError("Unexpected end of input at byte %d of %d" %
+                    (offset + len(data), size))
+        if data == _ZERO_GRAIN[:length]:
+            stats.skipped += 1
+            yield None
+            continue
+        stats.written += 1
+        yield data
+
+
+class _Done(object):
+    """Stand-in for an async result that is already available."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class VMDKWriter(object):
+    """
+    Convert a raw disk image to a VMDK at C{outPath}.
+
+    C{callback}, if given, is an object whose C{creatingDisk(completed, total,
+    skipped=0, rate=0)} method is called after every grain table.
+    """
+
+    def __init__(self, outPath, cylinders, heads=16, sectors=63,
+            adapter='ide', hwVersion=7, streaming=False, level=1,
+            workers=None, callback=None):
+        self.outPath = outPath
+        self.cylinders = cylinders
+        self.heads = heads
+        self.sectors = sectors
+        self.adapter = adapter
+        self.hwVersion = hwVersion
+        self.streaming = streaming
+        self.level = level
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = max(workers, 1)
+        self.callback = callback
+        self.stats = None
+
+    def _progress(self):
+        if self.callback:
+            self.callback.creatingDisk(self.stats.completed, self.stats.total,
+                    skipped=self.stats.skipped, rate=self.stats.rate())
+
+    def _descriptor(self, diskType, extents):
+        return Descriptor(diskType, extents, self.cylinders, self.heads,
+                self.sectors, self.adapter, self.hwVersion)
+
+    def write(self, inFile, size=None):
+        """
+        Write the disk from C{inFile}, a file object or descriptor, which
+        holds C{size} bytes (by default the size of the file). Returns a
+        L{VMDKStats}.
+        """
+        if hasattr(inFile, 'fileno'):
+            inFile = inFile.fileno()
+        if size is None:
+            size = os.fstat(inFile).st_size
+        self.stats = VMDKStats(size)
+        grains = iterGrains(inFile, size, self.stats)
+        outSize = _pad(size, SECTOR_SIZE)
+        if self.streaming:
+            descriptor = self._descriptor(STREAM_OPTIMIZED,
+                    [(outSize / SECTOR_SIZE, self.outPath)])
+            self._writeExtent(self._writeStream, self.outPath, grains,
+                    outSize, descriptor)
+        elif outSize <= MAX_MONOLITHIC_SIZE:
+            descriptor = self._descriptor(MONOLITHIC_SPARSE,
+                    [(outSize / SECTOR_SIZE, self.outPath)])
+            self._writeExtent(self._writeSparse, self.outPath, grains,
+                    outSize, descriptor)
+        else:
+            extents = []
+            base, ext = os.path.splitext(self.outPath)
+            for n, offset in enumerate(xrange(0, outSize, MAX_EXTENT_SIZE)):
+                extentSize = min(MAX_EXTENT_SIZE, outSize - offset)
+                extents.append((extentSize / SECTOR_SIZE,
+                    '%s-s%03d%s' % (base, n + 1, ext)))
+            descriptor = self._descriptor(TWO_GB_MAX_EXTENT_SPARSE, extents)
+            with open(self.outPath, 'wb') as outFile:
+                outFile.write(str(descriptor))
+            for sectors, extentPath in extents:
+                self._writeExtent(self._writeSparse, extentPath, grains,
+                        sectors * SECTOR_SIZE, None)
+        self.stats.elapsed = time.time() - self.stats.startTime
+        self._progress()
+        return self.stats
+
+    def _writeExtent(self, writer, path, grains, extentSize, descriptor):
+        # Stream extents are written in order, so they are hashed on the way
+        with artifacts.ArtifactFile(path) as outFile:
+            writer(outFile, grains, extentSize, descriptor)
+
+    def _writeHeader(self, outFile, diskType, extentSize, descriptor):
+        descriptorText = descriptor and str(descriptor) or ''
+        descriptorSectors = _divCeil(len(descriptorText), SECTOR_SIZE)
+        header = makeHeader(diskType, extentSize, descriptorSectors)
+        outFile.write(packHeader(header))
+        outFile.write(descriptorText.ljust(descriptorSectors * SECTOR_SIZE,
+            '\0'))
+        return header
+
+    def _writeSparse(self, outFile, grains, extentSize, descriptor):
+        header = self._writeHeader(outFile, descriptor
+                and MONOLITHIC_SPARSE or TWO_GB_MAX_EXTENT_SPARSE,
+                extentSize, descriptor)
+        gts = numGTs(extentSize)
+        gdSectors = _divCeil(gts * 4, SECTOR_SIZE)
+        # Both directories point to tables that follow them contiguously
+        for gdOffset in (header.rgdOffset, header.gdOffset):
+            outFile.seek(gdOffset * SECTOR_SIZE)
+            outFile.write(struct.pack('<%dI' % gts, *[
+                gdOffset + gdSectors + n * GT_SECTORS for n in range(gts)]))
+        # Make sure the file covers the metadata even with no grains
+        outFile.seek(header.overHead * SECTOR_SIZE - 1)
+        outFile.write('\0')
+
+        table = [0] * (gts * GTES_PER_GT)
+        sector = header.overHead
+        for n in range(_divCeil(extentSize, GRAIN_SIZE)):
+            data = next(grains)
+            if data is not None:
+                table[n] = sector
+                sector += GRAIN_SECTORS
+                outFile.write(data)
+            if (n + 1) % GTES_PER_GT == 0:
+                self._progress()
+        table = struct.pack('<%dI' % len(table), *table)
+        for gdOffset in (header.rgdOffset, header.gdOffset):
+            outFile.seek((gdOffset + gdSectors) * SECTOR_SIZE)
+            outFile.write(table)
+
+    def _writeStream(self, outFile, grains, extentSize, descriptor):
+        header = self._writeHeader(outFile, STREAM_OPTIMIZED, extentSize,
+                descriptor)
+        outFile.write('\0' * max(GRAIN_SIZE - outFile.tell(), 0))
+        self.pos = outFile.tell()
+        gts = numGTs(extentSize)
+        directory = [0] * _pad(gts, GRAIN_SECTORS)
+        pool = ThreadPool(self.workers)
+        try:
+            numGrains = _divCeil(extentSize, GRAIN_SIZE)
+            for gtNum in range(gts):
+                first = gtNum * GTES_PER_GT
+                table = [0] * GTES_PER_GT
+                pending = collections.deque()
+                for n in range(first, min(first + GTES_PER_GT, numGrains)):
+                    data = next(grains)
+                    if data is None:
+                        continue
+                    # zlib releases the GIL while deflating, so threads scale
+                    pending.append((n, pool.apply_async(zlib.compress,
+                        (data, self.level))))
+                    # Bound the number of grains in flight
+                    while len(pending) >= 2 * self.workers:
+                        self._writeGrain(outFile, table, first,
+                                *pending.popleft())
+                while pending:
+                    self._writeGrain(outFile, table, first, *pending.popleft())
+                if any(table):
+                    directory[gtNum] = self.pos / SECTOR_SIZE + 1
+                    self._writeMetadata(outFile, MARKER_GT,
+                            struct.pack('<%dI' % GTES_PER_GT, *table))
+                self._progress()
+            pool.close()
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.join()
+        header = header._replace(gdOffset=self.pos / SECTOR_SIZE + 1)
+        self._writeMetadata(outFile, MARKER_GD,
+                struct.pack('<%dI' % len(directory), *directory))
+        self._writeMetadata(outFile, MARKER_FOOTER, packHeader(header))
+        outFile.write(packMarker(0, MARKER_EOS))
+
+    def _writeGrain(self, outFile, table, first, n, result):
+        data = result.get()
+        table[n - first] = self.pos / SECTOR_SIZE
+        record = struct.pack(GRAIN_MARKER_FORMAT, n * GRAIN_SECTORS,
+                len(data)) + data
+        record += '\0' * (_pad(len(record), SECTOR_SIZE) - len(record))
+        outFile.write(record)
+        self.pos += len(record)
+
+    def _writeMetadata(self, outFile, markerType, data):
+        data += '\0' * (_pad(len(data), SECTOR_SIZE) - len(data))
+        outFile.write(packMarker(len(data) / SECTOR_SIZE, markerType))
+        outFile.write(data)
+        self.pos += SECTOR_SIZE + len(data)
+
+
+def writeVMDK(inFile, outPath, cylinders, heads=16, sectors=63,
+        adapter='ide', hwVersion=7, streaming=False, level=1, workers=None,
+        size=None, callback=None):
+    """
+    Convert the raw disk image C{inFile} (a path, file object or descriptor)
+    to a VMDK at C{outPath} and return a L{VMDKStats}. The disk is
+    streamOptimized if C{streaming} is set, with grains deflated at zlib
+    C{level} by C{workers} threads (default one per CPU).
+    """
+    writer = VMDKWriter(outPath, cylinders, heads=heads, sectors=sectors,
+            adapter=adapter, hwVersion=hwVersion, streaming=streaming,
+            level=level, workers=workers, callback=callback)
+    if isinstance(inFile, basestring):
+        with open(inFile, 'rb') as fobj:
+            return writer.write(fobj, size)
+    return writer.write(inFile, size)
+
+
+class VMDKError(RuntimeError):
+    pass
+
+
+class Grain(namedtuple('Grain', 'lba sector size')):
+    """A compressed grain: its LBA, the sector of its marker, data size."""
+    __slots__ = ()
+
+
+class VMDKReader(object):
+    """
+    Random access to the metadata of a VMDK through a read-only mapping of
+    the file, so that checking a disk only touches the pages holding
+    markers and tables.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fobj:
+            self.size = os.fstat(fobj.fileno()).st_size
+            if self.size < SECTOR_SIZE:
+                raise VMDKError("%s: too short to be a VMDK" % (path,))
+            self.map = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(DESCRIPTOR_MAGIC)] == DESCRIPTOR_MAGIC:
+            self.header = None
+            return
+        self.header = unpackHeader(self.map[:SECTOR_SIZE])
+        if self.header.magicNumber != MAGIC:
+            raise VMDKError("%s: bad magic number %r" % (path,
+                self.header.magicNumber))
+
+    def close(self):
+        self.map.close()
+
+    @property
+    def streamOptimized(self):
+        return (self.header is not None
+                and self.header.compressAlgorithm == COMPRESSION_DEFLATE)
+
+    @property
+    def descriptor(self):
+        if self.header is None:
+            return self.map[:].rstrip('\0')
+        start = self.header.descriptorOffset * SECTOR_SIZE
+        return self.map[start:start + self.header.descriptorSize
+                * SECTOR_SIZE].rstrip('\0')
+
+    def extentFiles(self):
+        """
+        Return the extents named by a descriptor-only file as
+        C{(sectors, path)} pairs.
+        """
+        extents = []
+        for line in self.descriptor.splitlines():
+            fields = line.split()
+            if len(fields) == 4 and fields[2] == 'SPARSE':
+                extents.append((int(fields[1]), os.path.join(
+                    os.path.dirname(self.path), fields[3].strip('"'))))
+        return extents
+
+    def _uint32s(self, sector, count):
+        offset = sector * SECTOR_SIZE
+        if offset + count * 4 > self.size:
+            raise VMDKError("%s: table at sector %d is past the end of the "
+                    "file" % (self.path, sector))
+        return struct.unpack_from('<%dI' % count, self.map, offset)
+
+    def iterMarkers(self):
+        """
+        Walk the markers of a streamOptimized disk, yielding
+        C{(sector, val, size, type)} tuples. C{type} is C{None} for grains,
+        whose C{val} is the LBA and C{size} the compressed size. Metadata
+        markers have C{size} 0 and C{val} the number of sectors that follow.
+        Stops after the end of stream marker or at the end of the file.
+        """
+        pos = self.header.overHead * SECTOR_SIZE
+        while pos + SECTOR_SIZE <= self.size:
+            val, size = struct.unpack_from(GRAIN_MARKER_FORMAT, self.map, pos)
+            if size:
+                yield pos / SECTOR_SIZE, val, size, None
+                pos = _pad(pos + struct.calcsize(GRAIN_MARKER_FORMAT) + size,
+                        SECTOR_SIZE)
+                continue
+            markerType, = struct.unpack_from('<I', self.map, pos + 12)
+            yield pos / SECTOR_SIZE, val, size, markerType
+            if markerType == MARKER_EOS:
+                return
+            pos += SECTOR_SIZE + val * SECTOR_SIZE
+
+    def grainData(self, grain):
+        start = grain.sector * SECTOR_SIZE + struct.calcsize(
+                GRAIN_MARKER_FORMAT)
+        return self.map[start:start + grain.size]
+
+    def verify(self, checkData=False):
+        """
+        Check the structure of the disk and return a list of problems, empty
+        if there are none. If C{checkData} is set, every compressed grain is
+        also inflated.
+        """
+        try:
+            if self.header is None:
+                return self._verifyExtents(checkData)
+            if self.streamOptimized:
+                return self._verifyStream(checkData)
+            return self._verifySparse()
+        except (VMDKError, struct.error, zlib.error), err:
+            return [str(err)]
+
+    def _verifyExtents(self, checkData):
+        problems = []
+        for sectors, path in self.extentFiles():
+            if not os.path.exists(path):
+                problems.append("%s: missing extent %s" % (self.path, path))
+                continue
+            problems.extend(verifyFile(path, checkData))
+        if not problems and not self.extentFiles():
+            problems.append("%s: descriptor lists no extents" % (self.path,))
+        return problems
+
+    def _verifySparse(self):
+        problems = []
+        header = self.header
+        if header.overHead * SECTOR_SIZE > self.size:
+            return ["%s: file is shorter than its metadata" % (self.path,)]
+        gts = numGTs(header.capacity * SECTOR_SIZE)
+        grainSectors = set()
+        gd = self._uint32s(header.gdOffset, gts)
+        rgd = self._uint32s(header.rgdOffset, gts)
+        for gtNum in range(gts):
+            table = self._uint32s(gd[gtNum], GTES_PER_GT)
+            if self._uint32s(rgd[gtNum], GTES_PER_GT) != table:
+                problems.append("%s: grain table %d differs from its "
+                        "redundant copy" % (self.path, gtNum))
+            for n, sector in enumerate(table):
+                if not sector:
+                    continue
+                if (sector < header.overHead
+                        or sector * SECTOR_SIZE >= self.size):
+                    problems.append("%s: grain %d points outside the data "
+                            "area (sector %d)" % (self.path,
+                                gtNum * GTES_PER_GT + n, sector))
+                elif sector in grainSectors:
+                    problems.append("%s: sector %d is used by more than one "
+                            "grain" % (self.path, sector))
+                grainSectors.add(sector)
+        return problems
+
+    def _verifyStream(self, checkData):
+        problems = []
+        header = self.header
+        capacity = header.capacity
+        tables = {}
+        directory = footer = None
+        eos = False
+        grains = []
+        lastLba = -1
+        for sector, val, size, markerType in self.iterMarkers():
+            if markerType is None:
+                if val % GRAIN_SECTORS or val >= capacity or val <= lastLba:
+                    problems.append("%s: grain at sector %d has bad LBA %d" %
+                            (self.path, sector, val))
+                if (sector * SECTOR_SIZE + size
+                        + struct.calcsize(GRAIN_MARKER_FORMAT) > self.size):
+                    problems.append("%s: grain at sector %d is truncated" %
+                            (self.path, sector))
+                    break
+                lastLba = val
+                grains.append(Grain(val, sector, size))
+            elif markerType == MARKER_GT:
+                tables[sector + 1] = self._uint32s(sector + 1, GTES_PER_GT)
+            elif markerType == MARKER_GD:
+                directory = (sector + 1, self._uint32s(sector + 1,
+                    val * SECTOR_SIZE / 4))
+            elif markerType == MARKER_FOOTER:
+                footer = unpackHeader(self.map[(sector + 1) * SECTOR_SIZE:
+                    (sector + 2) * SECTOR_SIZE])
+            elif markerType == MARKER_EOS:
+                eos = True
+            else:
+                problems.append("%s: unknown marker type %d at sector %d" %
+                        (self.path, markerType, sector))
+                break
+        if not eos:
+            problems.append("%s: end of stream marker not found" %
+                    (self.path,))
+        if footer is None or directory is None:
+            problems.append("%s: grain directory or footer not found" %
+                    (self.path,))
+            return problems
+        if footer.gdOffset != directory[0]:
+            problems.append("%s: footer points to a grain directory at "
+                    "sector %d, found at %d" % (self.path, footer.gdOffset,
+                        directory[0]))
+
+        expected = buildTables(grains)
+        gd = directory[1]
+        for gtNum in range(max(len(gd), max(expected or [0]) + 1)):
+            gtSector = gtNum < len(gd) and gd[gtNum] or 0
+            want = expected.get(gtNum)
+            if want is None:
+                if gtSector:
+                    problems.append("%s: grain table %d is listed but has "
+                            "no grains" % (self.path, gtNum))
+                continue
+            if gtSector not in tables:
+                problems.append("%s: grain directory entry %d does not point "
+                        "to a grain table" % (self.path, gtNum))
+            elif tables[gtSector] != want:
+                problems.append("%s: grain table %d does not match its "
+                        "grains" % (self.path, gtNum))
+
+        if checkData:
+            for grain in grains:
+                length = min(GRAIN_SIZE, (capacity - grain.lba) * SECTOR_SIZE)
+                data = zlib.decompress(self.grainData(grain))
+                # raw2vmdk leaves the final partial grain short
+                if len(data) != length and grain.lba + GRAIN_SECTORS <= (
+                        capacity):
+                    problems.append("%s: grain at LBA %d inflates to %d "
+                            "bytes" % (self.path, grain.lba, len(data)))
+        return problems
+
+    def extract(self, outFile):
+        """
+        Write the raw disk image held by a single extent disk to C{outFile}.
+        """
+        header = self.header
+        outFile.truncate(header.capacity * SECTOR_SIZE)
+        if self.streamOptimized:
+            for sector, val, size, markerType in self.iterMarkers():
+                if markerType is None:
+                    outFile.seek(val * SECTOR_SIZE)
+                    outFile.write(zlib.decompress(self.grainData(
+                        Grain(val, sector, size))))
+            return
+        gts = numGTs(header.capacity * SECTOR_SIZE)
+        for gtNum, gtSector in enumerate(self._uint32s(header.gdOffset, gts)):
+            for n, sector in enumerate(self._uint32s(gtSector, GTES_PER_GT)):
+                if sector:
+                    outFile.seek((gtNum * GTES_PER_GT + n) * GRAIN_SIZE)
+                    start = sector * SECTOR_SIZE
+                    outFile.write(self.map[start:start + GRAIN_SIZE])
+
+
+def buildTables(grains):
+    """
+    Return the grain tables that describe C{grains}, as a dictionary of
+    table number to table.
+    """
+    tables = {}
+    for grain in grains:
+        grainNum = grain.lba / GRAIN_SECTORS
+        gtNum, n = divmod(grainNum, GTES_PER_GT)
+        table = tables.setdefault(gtNum, [0] * GTES_PER_GT)
+        table[n] = grain.sector
+    return dict((x, tuple(y)) for x, y in tables.iteritems())
+
+
+def verifyFile(path, checkData=False):
+    """
+    Check the VMDK at C{path} and return a list of problems found.
+    """
+    try:
+        reader = VMDKReader(path)
+    except (VMDKError, IOError, OSError, mmap.error), err:
+        return [str(err)]
+    try:
+        return reader.verify(checkData)
+    finally:
+        reader.close()
+
+
+def verifyFiles(paths, checkData=False, workers=None):
+    """
+    Check several VMDKs at once and return a dictionary mapping each path to
+    its list of problems.
+    """
+    if not paths:
+        return {}
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = ThreadPool(max(min(workers, len(paths)), 1))
+    try:
+        results = pool.map(lambda path: verifyFile(path, checkData), paths)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(paths, results))
+
+
+def fixGrainDirectory(path):
+    """
+    Rebuild the grain tables, grain directory, footer and end of stream
+    marker of a streamOptimized disk from its grain markers, e.g. after a
+    writer was interrupted or wrote a bad directory. Grain tables that are
+    wrong are rewritten in place and missing ones are appended. Returns
+    C{False} if the disk was already correct.
+    """
+    reader = VMDKReader(path)
+    try:
+        if not reader.streamOptimized:
+            raise VMDKError("%s: only streamOptimized disks can be repaired"
+                    % (path,))
+        if not reader.verify():
+            return False
+        header = reader.header
+        grains = []
+        # Table number -> sector of its data, for tables already in the file
+        present = {}
+        lastTable = -1
+        end = header.overHead * SECTOR_SIZE
+        for sector, val, size, markerType in reader.iterMarkers():
+            if markerType is None:
+                recordEnd = _pad(sector * SECTOR_SIZE + size +
+                        struct.calcsize(GRAIN_MARKER_FORMAT), SECTOR_SIZE)
+                if recordEnd > reader.size or val >= header.capacity:
+                    break
+                grains.append(Grain(val, sector, size))
+                lastTable = val / GRAIN_SECTORS / GTES_PER_GT
+            elif markerType == MARKER_GT:
+                if lastTable >= 0 and val == GT_SECTORS:
+                    present[lastTable] = sector + 1
+                recordEnd = (sector + 1 + val) * SECTOR_SIZE
+            else:
+                # Everything from the directory on is regenerated
+                break
+            end = recordEnd
+    finally:
+        reader.close()
+
+    tables = buildTables(grains)
+    directory = [0] * _pad(numGTs(header.capacity * SECTOR_SIZE),
+            GRAIN_SECTORS)
+    with open(path, 'r+b') as fobj:
+        fobj.truncate(end)
+        for gtNum, table in sorted(tables.iteritems()):
+            data = struct.pack('<%dI' % GTES_PER_GT, *table)
+            if gtNum in present:
+                fobj.seek(present[gtNum] * SECTOR_SIZE)
+                fobj.write(data)
+                directory[gtNum] = present[gtNum]
+            else:
+                fobj.seek(end)
+                fobj.write(packMarker(GT_SECTORS, MARKER_GT) + data)
+                directory[gtNum] = end / SECTOR_SIZE + 1
+                end += SECTOR_SIZE + len(data)
+        fobj.seek(end)
+        header = header._replace(gdOffset=end / SECTOR_SIZE + 1)
+        data = struct.pack('<%dI' % len(directory), *directory)
+        fobj.write(packMarker(len(data) / SECTOR_SIZE, MARKER_GD) + data)
+        fobj.write(packMarker(1, MARKER_FOOTER) + packHeader(header))
+        fobj.write(packMarker(0, MARKER_EOS))
+    return True
@@ -0,0 +1,91 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import hashlib
+import os
+
+from jobslave import artifacts
+from jobslave import compress
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class ArtifactsTest(JobSlaveHelper):
+
+    def testRecordWhileWriting(self):
+        registry = artifacts.Registry()
+        path = os.path.join(self.workDir, 'out')
+        with artifacts.ArtifactFile(path, registry=registry) as fobj:
+            fobj.write('hello ')
+            fobj.write('world')
+        artifact = registry.lookup(path)
+        self.assertEqual(artifact.size, 11)
+        self.assertEqual(artifact.sha1, hashlib.sha1('hello world').hexdigest())
+
+        # Hardlinks share the entry
+        link = os.path.join(self.workDir, 'link')
+        os.link(path, link)
+        self.assertEqual(registry.lookup(link), artifact)
+
+        # Changing the file makes the entry stale
+        with open(path, 'a') as fobj:
+            fobj.write('!')
+        self.assertEqual(registry.lookup(path), None)
+        artifact = registry.record(path,
+                {'sha1': hashlib.sha1('hello world!').hexdigest()})
+        self.assertEqual(artifact.size, 12)
+        self.assertEqual(registry.lookup(link), artifact)
+
+    def testSeek(self):
+        registry = artifacts.Registry()
+        path = os.path.join(self.workDir, 'out')
+        with artifacts.ArtifactFile(path, registry=registry) as fobj:
+            fobj.write('hello')
+            fobj.seek(5)
+            fobj.write(' world')
+        self.assertEqual(registry.lookup(path).sha1,
+                hashlib.sha1('hello world').hexdigest())
+
+        with artifacts.ArtifactFile(path, registry=registry) as fobj:
+            fobj.write('hello world')
+            fobj.seek(0)
+            fobj.write('j')
+        artifact = registry.lookup(path)
+        self.assertEqual((artifact.size, artifact.sha1), (11, None))
+
+        try:
+            with artifacts.ArtifactFile(path, registry=registry) as fobj:
+                fobj.write('partial')
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(registry.lookup(path), None)
+
+    def testCompress(self):
+        source = os.path.join(self.workDir, 'source')
+        with open(source, 'wb') as fobj:
+            fobj.write(os.urandom(300000))
+        for codec in (compress.GZIP, compress.XZ):
+            dest = source + compress.getSuffix(codec)
+            compress.compressFile(source, dest, codec=codec, workers=2)
+            artifact = artifacts.registry.lookup(dest)
+            self.assertEqual(artifact.size, os.stat(dest).st_size)
+            if codec == compress.GZIP:
+                self.assertEqual(artifact.sha1,
+                        hashlib.sha1(open(dest).read()).hexdigest())
+            else:
+                # Written by xz through the descriptor
+                self.assertEqual(artifact.sha1, None)
@@ -20,11 +20,13 @@ import tempfile
 import time
 from StringIO import StringIO
 
+from conary import dbstore
 from conary import versions
 from conary.lib import util
 from conary.deps import deps
 
 import jobslave_helper
+from jobslave import filesystems
 from jobslave import helperfuncs
 from jobslave.generators import constants
 from jobslave.generators import bootable_image
@@ -204,6 +206,97 @@ class BootableImageHelperTest(jobslave_helper.JobSlaveHelper):
         self.assertEqual(bootable_image.logCall._mock.calls[0][0][0][0], 'mkfs.ext4')
         self.assertEqual(len(jobslave.loophelpers.loopDetach._mock.calls), 1)
 
+    def testSession(self):
+        fsm = bootable_image.Filesystem('/dev/null', 'ext4', 104857600,
+                offset = 512)
+        mock.mock(bootable_image, 'logCall')
+        mock.mockFunction(jobslave.loophelpers.loopDetach)
+        mock.mockFunction(jobslave.loophelpers.loopAttach)
+        jobslave.loophelpers.loopAttach._mock.setDefaultReturn('/dev/loop0')
+        mock.mock(bootable_image.Filesystem, '_get_uuid')
+        with fsm.session():
+            fsm.format()
+            fsm.mount('/mnt/null')
+            fsm.umount()
+            self.assertEqual(len(jobslave.loophelpers.loopDetach._mock.calls),
+                    0)
+        self.assertEqual(len(jobslave.loophelpers.loopAttach._mock.calls), 1)
+        self.assertEqual(len(jobslave.loophelpers.loopDetach._mock.calls), 1)
+        self.assertEqual(sorted(fsm.timings), ['attach', 'detach', 'format',
+            'mount', 'mounted', 'probe', 'umount'])
+
+    def testChangesetPipeline(self):
+        fetched = []
+        def fetch(num):
+            fetched.append(num)
+            path = os.path.join(self.workDir, '%d.ccs' % num)
+            open(path, 'w').write('x' * 10)
+            return path
+        pipeline = bootable_image.ChangesetPipeline(fetch, 5, 2)
+        pipeline.start()
+        pipeline.waitFor(1)
+        # Stays within the window of the hunk being applied
+        time.sleep(0.1)
+        self.assertEqual(fetched, [0, 1])
+        pipeline.waitFor(4)
+        self.assertEqual(fetched[:4], [0, 1, 2, 3])
+        pipeline.waitFor(5)
+        pipeline.finish()
+        self.assertEqual(fetched, [0, 1, 2, 3, 4])
+        self.assertEqual(pipeline.downloaded, 50)
+
+        # Download errors surface in the install waiting on the hunk, and
+        # again when the install finishes
+        def fail(num):
+            raise RuntimeError("repository unavailable")
+        pipeline = bootable_image.ChangesetPipeline(fail, 5, 2)
+        pipeline.start()
+        self.assertRaises(RuntimeError, pipeline.waitFor, 1)
+        self.assertRaises(RuntimeError, pipeline.finish)
+
+    def testInstallPhaseTimings(self):
+        now = [100.0]
+        self.mock(bootable_image.time, 'time', lambda: now[0])
+        callback = bootable_image.InstallCallback(lambda *args: None)
+        callback.update = lambda *args: None
+        callback.preparingChangeSet()
+        now[0] += 2
+        callback.creatingDatabaseTransaction(1, 1)
+        now[0] += 1
+        callback.restoreFiles(10, 10)
+        now[0] += 5
+        callback.committingTransaction()
+        now[0] += 3
+        callback.setUpdateHunk(2, 2)
+        now[0] += 4
+        callback.preparingChangeSet()
+        now[0] += 1
+        self.assertEqual(callback.phaseTimings(), {'prepare': 3,
+            'db transaction': 1, 'restore': 5, 'db commit': 3})
+
+
+class StubConaryClient(object):
+    """
+    Just enough of a conary client to hold a real sqlite database, the way
+    the conary database does.
+    """
+
+    class Holder(object):
+        pass
+
+    def __init__(self, cfg):
+        db = dbstore.connect(util.joinPaths(cfg.root,
+            cfg.dbPath + '/conarydb'), driver='sqlite')
+        cu = db.cursor()
+        cu.execute("CREATE TABLE IF NOT EXISTS Instances (name STRING)")
+        db.commit()
+        self.db = self.Holder()
+        self.db.db = self.Holder()
+        self.db.db.db = db
+
+    def close(self):
+        self.db.db.db.close()
+
 
 class StubFilesystem(object):
     def __init__(self):
@@ -292,10 +385,30 @@ class BootableImageTest(jobslave_helper.JobSlaveHelper):
             '/':     bootable_image.FsRequest('root', '/',     'ext4', 0, 500000000),
             '/boot': bootable_image.FsRequest('boot', '/boot', 'ext4',    200000000, 0),
             }
+        self.bootable.jobData.setdefault('data', {})['filesystemSizing'] = \
+                'legacy'
         self.bootable.getTroveSize = lambda *a, **k: ({'/boot': 10240}, 0)
         realSizes = self.bootable.getImageSize()
         self.assertEqual(realSizes, {'/boot': 200000000, '/': 598865408})
 
+    def testGetImageSizeModel(self):
+        self.bootable.mountDict = {
+            '/':     bootable_image.FsRequest('root', '/',     'ext4', 0, 500000000),
+            '/boot': bootable_image.FsRequest('boot', '/boot', 'ext4',    200000000, 0),
+            'swap':  bootable_image.FsRequest('swap', 'swap',  'swap', 0, 1048576),
+            }
+        usage = filesystems.MountUsage('/', 409600)
+        usage.dataBlocks = 100
+        usage.files = 100
+        usage.directories = 10
+        self.bootable.getTroveUsage = lambda *a, **k: {'/': usage}
+        realSizes = self.bootable.getImageSize()
+        self.assertEqual(realSizes['/boot'], 200000000)
+        self.assertEqual(realSizes['swap'], 1048576)
+        # Large enough for the data, but without the fixed 13% padding
+        self.failUnless(500000000 + 409600 < realSizes['/'] < 598865408)
+        self.assertEqual(realSizes['/'] % 512, 0)
+
     def testAddFilesystem(self):
         self.bootable.addFilesystem('/', 'ext3')
         self.failIf(self.bootable.filesystems != {'/': 'ext3'},
@@ -341,6 +454,83 @@ sysfs                   /sys                    sysfs   defaults        0 0
         finally:
             bootable_image.sortMountPoints = sortMountPoints
 
+    def testStagingRoot(self):
+        workDir = self.bootable.workDir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(self.bootable._getStagingRoot(), None)
+            self.bootable.cfg.installStaging = True
+            # Installing into a directory rather than image filesystems
+            self.assertEqual(self.bootable._getStagingRoot(), None)
+
+            fs = StubFilesystem()
+            fs.mounted = True
+            fs.size = 1048576
+            self.bootable.filesystems['/'] = fs
+            mock.mock(bootable_image, 'logCall')
+            stage = self.bootable._getStagingRoot()
+            self.assertEqual(stage, os.path.join(workDir, 'stage'))
+            bootable_image.logCall._mock.assertCalled(
+                    'mount -n -t tmpfs -o mode=0755,size=1048576 none %s'
+                    % stage)
+
+            self.bootable.cfg.stagingDir = os.path.join(workDir, 'scratch')
+            stage = self.bootable._getStagingRoot()
+            self.assertEqual(os.path.dirname(stage),
+                    self.bootable.cfg.stagingDir)
+            self.assertEqual(os.listdir(stage), [])
+            self.assertEqual(os.stat(stage).st_mode & 07777, 0755)
+        finally:
+            util.rmtree(workDir)
+
+    def testConaryDb(self):
+        workDir = tempfile.mkdtemp()
+        self.mock(constants, 'dbTemplatePath', os.path.join(workDir, 'tmpl'))
+        self.mock(bootable_image.conaryclient, 'ConaryClient',
+                StubConaryClient)
+        oldRoot = self.bootable.conarycfg.root
+        def pragma(cclient, name):
+            cu = cclient.db.db.db.cursor()
+            cu.execute("PRAGMA %s" % name)
+            return cu.fetchone()[0]
+        try:
+            # An install runs in WAL mode on a copy of the template, and
+            # puts the database back in rollback journal mode when done
+            root = os.path.join(workDir, 'install')
+            path = util.joinPaths(root,
+                    self.bootable.conarycfg.dbPath + '/conarydb')
+            cclient = self.bootable._openClient(root, installPragmas=True)
+            self.assertEqual(len(os.listdir(constants.dbTemplatePath)), 1)
+            self.assertEqual(pragma(cclient, 'page_size'), 4096)
+            self.assertEqual(pragma(cclient, 'journal_mode'), 'wal')
+            self.assertEqual(pragma(cclient, 'synchronous'), 0)
+            cclient.db.db.db.cursor().execute(
+                    "INSERT INTO Instances VALUES ('foo')")
+            cclient.db.db.db.commit()
+            self.failUnless(os.path.exists(path + '-wal'))
+            self.bootable._finishDb(cclient)
+            self.assertEqual(pragma(cclient, 'journal_mode'), 'delete')
+            cclient.close()
+            self.failIf(os.path.exists(path + '-wal'))
+
+            db = dbstore.connect(path, driver='sqlite')
+            cu = db.cursor()
+            cu.execute("PRAGMA journal_mode")
+            self.assertEqual(cu.fetchone()[0], 'delete')
+            cu.execute("SELECT name FROM Instances")
+            self.assertEqual([x[0] for x in cu.fetchall()], ['foo'])
+            db.close()
+
+            # Other databases only get the baseline pragmas
+            cclient = self.bootable._openClient(os.path.join(workDir, 'other'))
+            self.assertEqual(pragma(cclient, 'journal_mode'), 'memory')
+            self.assertEqual(pragma(cclient, 'cache_size'), 200000)
+            cclient.close()
+            self.assertEqual(sorted(self.bootable.dbTimings),
+                    ['checkpoint', 'create', 'open', 'pragmas'])
+        finally:
+            self.bootable.conarycfg.root = oldRoot
+            util.rmtree(workDir)
+
     def testMakeImage(self):
         self.bootable.workDir = tempfile.mkdtemp()
         try:
@@ -409,7 +599,8 @@ SELINUX=enforcing
 SELINUXTYPE=targeted
 ''')
 
-            self.bootable.downloadChangesets = lambda: None
+            self.bootable.downloadChangesets = lambda *args: None
+            self.bootable._startPipeline = lambda *args: None
             self.bootable.updateGroupChangeSet = lambda *args, **kwargs: None
             self.bootable.mountDict = {'/': None}
             def mockLog(cmd, ignoreErrors=False):
@@ -0,0 +1,84 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import gzip
+import zlib
+import os
+import StringIO
+import tarfile
+
+from jobslave import compress
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class CompressTest(JobSlaveHelper):
+
+    def _data(self):
+        return os.urandom(300000) + ''.join(str(x) for x in range(200000))
+
+    def testGzipStream(self):
+        data = self._data()
+        for workers in (1, 4):
+            out = StringIO.StringIO()
+            stats = compress.gzipStream(StringIO.StringIO(data), out,
+                    workers=workers, blockSize=65536)
+            self.assertEqual(stats.totalBytes, len(data))
+            out.seek(0)
+            self.assertEqual(gzip.GzipFile(fileobj=out).read(), data)
+
+    def testGzipEmpty(self):
+        out = StringIO.StringIO()
+        compress.gzipStream(StringIO.StringIO(''), out)
+        out.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=out).read(), '')
+
+    def testCompressTree(self):
+        src = os.path.join(self.workDir, 'tree')
+        os.mkdir(src)
+        self.touch(os.path.join(src, 'junk'), contents='hello\n')
+        dest = os.path.join(self.workDir, 'tree.tar.gz')
+        compress.compressTree(self.workDir, 'tree', dest)
+        tar = tarfile.open(dest)
+        self.assertEqual(tar.extractfile('tree/junk').read(), 'hello\n')
+
+    def testBadCodec(self):
+        self.assertRaises(ValueError, compress.compressStream,
+                StringIO.StringIO(''), StringIO.StringIO(), codec='lzop')
+
+    def testCrc32Zeros(self):
+        for crc in (0, zlib.crc32('abc')):
+            for length in (0, 1, 7, 4096, 100001):
+                self.assertEqual(compress.crc32Zeros(crc, length),
+                        zlib.crc32('\0' * length, crc) & 0xffffffff)
+
+    def testGzipSparseFile(self):
+        path = os.path.join(self.workDir, 'sparse.img')
+        f = open(path, 'wb')
+        f.seek(1000000)
+        f.write('data' * 1000)
+        f.write('\0' * 200000)
+        f.seek(3000000)
+        f.write('end')
+        f.close()
+        dest = path + '.gz'
+        stats = compress.compressFile(path, dest, workers=2)
+        expected = open(path, 'rb').read()
+        self.assertEqual(gzip.open(dest).read(), expected)
+        self.assertEqual(stats.totalBytes, len(expected))
+        self.assertEqual(stats.compressedBytes, os.stat(dest).st_size)
+        self.failUnless(stats.dataBytes < len(expected))
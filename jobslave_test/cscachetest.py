@@ -0,0 +1,117 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import threading
+import time
+
+from jobslave import cscache
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class ChangesetCacheTest(JobSlaveHelper):
+
+    def _download(self, contents, calls):
+        def download(path):
+            calls.append(path)
+            open(path, 'w').write(contents)
+        return download
+
+    def testFetch(self):
+        cache = cscache.ChangesetCache(os.path.join(self.workDir, 'cache'))
+        calls = []
+        first = os.path.join(self.workDir, 'first.ccs')
+        second = os.path.join(self.workDir, 'second.ccs')
+        self.assertEqual(cache.fetch('foo', first,
+            self._download('foo data', calls)), False)
+        self.assertEqual(cache.fetch('foo', second,
+            self._download('foo data', calls)), True)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(open(second).read(), 'foo data')
+        # Jobs get links to the stored file, so removing them keeps it
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        os.unlink(first)
+        os.unlink(second)
+        self.assertEqual(cache.fetch('foo', first,
+            self._download('foo data', calls)), True)
+
+        cache.forget('foo')
+        self.assertEqual(open(first).read(), 'foo data')
+        self.assertEqual(cache.fetch('foo', first,
+            self._download('new foo data', calls)), False)
+        self.assertEqual(open(first).read(), 'new foo data')
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def testFailedDownload(self):
+        cache = cscache.ChangesetCache(os.path.join(self.workDir, 'cache'))
+        def download(path):
+            raise RuntimeError("repository unavailable")
+        dest = os.path.join(self.workDir, 'out.ccs')
+        self.assertRaises(RuntimeError, cache.fetch, 'foo', dest, download)
+        self.assertEqual(os.listdir(cache.tmpDir), [])
+        self.assertEqual(os.path.exists(dest), False)
+
+    def testEvict(self):
+        cache = cscache.ChangesetCache(os.path.join(self.workDir, 'cache'),
+                maxSize=8)
+        calls = []
+        dest = os.path.join(self.workDir, 'out.ccs')
+        for n, key in enumerate(['one', 'two', 'one', 'three']):
+            cache.fetch(key, dest, self._download(key, calls))
+            # Make sure mtimes differ
+            path = cache._objectPath(cache._hashKey(key))
+            os.utime(path, (n, n))
+        # Nothing is evicted until asked
+        self.assertEqual(sum(len(x[2]) for x in os.walk(cache.objectDir)), 3)
+        cache.evict()
+        # 'two' was used least recently and went to make room for 'three'
+        self.assertEqual(cache.fetch('one', dest,
+            self._download('xx', calls)), True)
+        self.assertEqual(cache.fetch('three', dest,
+            self._download('xx', calls)), True)
+        self.assertEqual(cache.fetch('two', dest,
+            self._download('two', calls)), False)
+        # Keys share one lock file per hash prefix
+        self.assertEqual(sorted(os.listdir(cache.lockDir)),
+                sorted(set(cache._hashKey(x)[:2]
+                    for x in ['one', 'two', 'three'])))
+
+    def testConcurrentFetch(self):
+        cache = cscache.ChangesetCache(os.path.join(self.workDir, 'cache'))
+        calls = []
+
+        def download(path):
+            calls.append(path)
+            time.sleep(0.1)
+            open(path, 'w').write('data')
+
+        def fetch(n):
+            # Each thread opens the cache on its own, like separate jobs
+            other = cscache.ChangesetCache(cache.path)
+            other.fetch('foo', os.path.join(self.workDir, '%d.ccs' % n),
+                    download)
+
+        threads = [threading.Thread(target=fetch, args=(n,))
+                for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        for n in range(4):
+            self.assertEqual(open(os.path.join(self.workDir,
+                '%d.ccs' % n)).read(), 'data')
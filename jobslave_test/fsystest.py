@@ -32,3 +32,30 @@ class FilesystemsTest(unittest.TestCase):
         sizes = {'/usr/share': 8192L, '/': 4096L, '/bin': 0, '/usr': 16384L}
         r = filesystems.calculatePartitionSizes(ujob, mounts)
         self.failUnlessEqual(r, (sizes, 28672L))
+
+    def testMountIndex(self):
+        index = filesystems.MountIndex(['/', '/usr/', '/usr/share'])
+        self.failUnlessEqual(index.find('/usr/share/doc'), '/usr/share')
+        self.failUnlessEqual(index.find('/usr/sbin'), '/usr')
+        self.failUnlessEqual(index.find('/usrlocal/bin'), '/')
+        self.failUnlessEqual(index.find('/etc'), '/')
+        index = filesystems.MountIndex(['/boot'])
+        self.failUnlessEqual(index.find('/etc'), None)
+
+    def testSizeCache(self):
+        cspath = resources.get_archive("tmpwatch.ccs")
+        ujob = UpdateJob(None)
+        ujob.setJobsChangesetList([cspath])
+        filesystems._sizeCache.clear()
+        r = filesystems.calculatePartitionSizes(ujob, ['/'])
+        self.failUnlessEqual(len(filesystems._sizeCache), 1)
+
+        def fail(csPath):
+            raise AssertionError("changeset should not be reread")
+        origSize = filesystems._sizeChangeSet
+        filesystems._sizeChangeSet = fail
+        try:
+            self.failUnlessEqual(filesystems.calculatePartitionSizes(
+                ujob, ['/']), r)
+        finally:
+            filesystems._sizeChangeSet = origSize
@@ -31,6 +31,9 @@ class GeneratorStub(object):
         self.original_basefilename = 'a b'
         self.basefilename = 'a_b'
 
+    def startUpload(self, filePath):
+        pass
+
     def postOutput(self, fileList):
         self.posted_output = fileList
 
@@ -149,7 +152,7 @@ class BootableImageStub(ImageGeneratorStub):
     def installGrub(self, fakeRoot, image, size):
         pass
 
-    def gzip(self, source, dest = None):
+    def gzip(self, source, dest = None, tarArgs = (), codec = None):
         return dest
 
 class InstallableIsoStub(ImageGeneratorStub):
@@ -51,9 +51,15 @@ class DummyResponse(object):
     def sendLog(self, data):
         pass
 
+    def startUpload(self, filePath):
+        pass
+
     def postOutput(self, fileList, withMetadata=None, attributes=None):
         pass
 
+    def close(self, abort=False):
+        pass
+
 
 class JobSlaveHelper(TestCase):
 
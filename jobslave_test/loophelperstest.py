@@ -0,0 +1,79 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import errno
+
+from jobslave import loophelpers
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class LoopManagerTest(JobSlaveHelper):
+
+    def setUp(self):
+        JobSlaveHelper.setUp(self)
+        self.mgr = loophelpers.LoopManager(control='/nonexistent')
+        self.bound = []
+        self.unbound = []
+        self.busy = set()
+        self.free = ['/dev/loop%d' % x for x in range(4)]
+
+        def candidates():
+            while self.mgr.pool:
+                yield self.mgr.pool.pop(0)
+            for path in self.free:
+                yield path
+
+        def configure(path, backing, image, offset, size):
+            if path in self.busy:
+                raise IOError(errno.EBUSY, 'busy')
+            self.busy.add(path)
+            self.bound.append((path, offset, size))
+
+        def unbind(path):
+            self.busy.discard(path)
+            self.unbound.append(path)
+            return True
+        self.mock(self.mgr, '_candidates', candidates)
+        self.mock(self.mgr, '_configure', configure)
+        self.mock(self.mgr, '_unbind', unbind)
+
+    def testRefcount(self):
+        dev = self.mgr.attach('/dev/null', offset=512, size=1024)
+        self.assertEqual(self.mgr.attach('/dev/null', offset=512, size=1024),
+                dev)
+        self.assertEqual(self.mgr.refcount(dev), 2)
+        self.assertEqual(len(self.bound), 1)
+        self.mgr.detach(dev)
+        self.assertEqual(self.unbound, [])
+        self.mgr.detach(dev)
+        self.assertEqual(self.unbound, [dev])
+        self.assertEqual(self.mgr.pool, [dev])
+
+    def testDistinctRanges(self):
+        dev1 = self.mgr.attach('/dev/null', offset=0, size=1024)
+        dev2 = self.mgr.attach('/dev/null', offset=1024, size=1024)
+        self.assertNotEqual(dev1, dev2)
+
+    def testBusyRetry(self):
+        self.busy.add('/dev/loop0')
+        self.assertEqual(self.mgr.attach('/dev/null'), '/dev/loop1')
+
+    def testPoolReuse(self):
+        dev = self.mgr.attach('/dev/null')
+        self.mgr.detach(dev)
+        self.free.remove(dev)
+        self.assertEqual(self.mgr.attach('/dev/null', offset=4096), dev)
@@ -18,6 +18,7 @@
 import os
 import random
 import time
+from jobslave import loophelpers
 from jobslave import lvm
 from jobslave_test import resources
 from jobslave_test.jobslave_helper import JobSlaveHelper
@@ -121,3 +122,22 @@ creation_time = 0
         expected = os.popen("xxd " + resources.get_archive('lvm.dsk')).read()
         actual = os.popen("xxd " + image).read()
         self.assertEqualWithDiff(actual, expected)
+
+    def testLVMSession(self):
+        attached = []
+        detached = []
+        self.mock(loophelpers, 'loopAttach',
+                lambda *a, **kw: attached.append(a) or '/dev/loop0')
+        self.mock(loophelpers, 'loopDetach', detached.append)
+        image = os.path.join(self.workDir, 'session.img')
+        container = lvm.LVMContainer(totalSize=20*1024*1024, image=image)
+        first = container.addFilesystem('root', '/', 'ext3', 4*1024*1024)
+        container.open()
+        container.addFilesystem('var', '/var', 'ext3', 4*1024*1024)
+        self.assertEqual(len(attached), 2)
+        first.attach()
+        first.detach()
+        self.assertEqual(detached, [])
+        container.unmount()
+        self.assertEqual(detached, ['/dev/loop0', '/dev/loop0'])
+        self.assertEqual(sorted(container.getTimings()), ['root', 'var'])
@@ -30,11 +30,11 @@ class RawHdImage(JobSlaveHelper):
         self.mock(bootable_image.loophelpers, 'loopDetach', lambda *a, **kw:
             None)
 
-        def mockCalculatePartitionSizes(uJob, mounts):
-            sizes = dict.fromkeys(mounts, 1024*2)
-            return sizes, sum(sizes.values())
-        self.mock(bootable_image.filesystems, 'calculatePartitionSizes',
-                mockCalculatePartitionSizes)
+        def mockCalculatePartitionUsage(uJob, mounts, workers=1):
+            return dict((x, bootable_image.filesystems.MountUsage(x, 1024*2))
+                    for x in mounts)
+        self.mock(bootable_image.filesystems, 'calculatePartitionUsage',
+                mockCalculatePartitionUsage)
 
         self.img = raw_hd_image.RawHdImage(self.slaveCfg, self.data)
         mock.mock(self.img, 'bootloader')
@@ -83,6 +83,7 @@ NOZEROCONF=yes
         util.mkdirChain(img.changesetDir)
 
         mock.mockMethod(img.downloadChangesets)
+        mock.mockMethod(img.startUpload)
         mock.mockMethod(img.postOutput)
         mock.mockMethod(img.loadRPM)
         mock.mock(bootable_image.Filesystem, '_get_uuid')
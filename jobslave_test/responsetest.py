@@ -0,0 +1,268 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+from xml.etree import ElementTree as ET
+
+from jobslave import response
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class FakeRequest(object):
+
+    def __init__(self, url, method, headers):
+        self.url = url
+        self.method = method
+        self.headers = headers
+
+    def setData(self, body, size=None):
+        self.body = body
+        self.size = size
+
+
+class FakeOpener(object):
+    """
+    Records requests, reading upload bodies the way the HTTP client does.
+    Fails the request numbers listed in C{failures} part way through.
+    """
+
+    def __init__(self, failures=()):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.failures = set(failures)
+
+    def newRequest(self, url, method, headers):
+        return FakeRequest(url, method, headers)
+
+    def open(self, req, data=None, method=None, headers=None):
+        if not isinstance(req, FakeRequest):
+            req = FakeRequest(req, method, headers)
+            req.data = data
+            with self.lock:
+                self.requests.append(req)
+            return
+        with self.lock:
+            num = len(self.requests)
+            self.requests.append(req)
+        req.data = req.body.read(1000)
+        if num in self.failures:
+            raise socket.error("connection reset")
+        while True:
+            data = req.body.read(1000)
+            if not data:
+                break
+            req.data += data
+
+
+class ResponseTest(JobSlaveHelper):
+
+    def _proxy(self, opener, **kwargs):
+        kwargs.setdefault('sendfile', False)
+        proxy = response.ResponseProxy('http://no.master/api/',
+                dict(buildId=1, outputToken='token'), **kwargs)
+        proxy.opener = proxy._local.opener = opener
+        proxy._newOpener = lambda: opener
+        self.mock(response.time, 'sleep', lambda seconds: None)
+        return proxy
+
+    def _files(self, count=3, size=5000):
+        paths = []
+        for n in range(count):
+            path = os.path.join(self.workDir, 'file%d' % n)
+            with open(path, 'wb') as fobj:
+                fobj.write(os.urandom(size))
+            paths.append(path)
+        return paths
+
+    def testPostOutput(self):
+        opener = FakeOpener()
+        proxy = self._proxy(opener, workers=3)
+        paths = self._files()
+        proxy.postOutput([(x, 'title') for x in paths])
+        uploads = dict((x.url, x.data) for x in opener.requests[:-1])
+        for path in paths:
+            self.assertEqual(uploads['http://no.master/api/uploadBuild/1/'
+                + os.path.basename(path)], open(path).read())
+
+        files = ET.fromstring(opener.requests[-1].data)
+        self.assertEqual([x.findtext('file_name') for x in files.findall('file')],
+                ['file0', 'file1', 'file2'])
+        self.assertEqual([x.findtext('sha1') for x in files.findall('file')],
+                [hashlib.sha1(open(x).read()).hexdigest() for x in paths])
+
+    def testStartUpload(self):
+        opener = FakeOpener()
+        proxy = self._proxy(opener, workers=2)
+        first, second = self._files(count=2)
+        proxy.startUpload(first)
+        proxy.startUpload(first)
+        proxy.postOutput([(first, 'first'), (second, 'second')])
+        # Each file is sent once, then the list of files
+        self.assertEqual(sorted(x.url for x in opener.requests[:-1]), [
+            'http://no.master/api/uploadBuild/1/file0',
+            'http://no.master/api/uploadBuild/1/file1'])
+        self.assertEqual(opener.requests[-1].url,
+                'http://no.master/api/api/v1/images/1/build_files')
+
+        # Failures in the background surface when the output is posted
+        opener = FakeOpener(failures=[0])
+        proxy = self._proxy(opener)
+        proxy.startUpload(first)
+        self.assertRaises(socket.error, proxy.postOutput, [(first, 'first')])
+
+    def testClose(self):
+        # Failures of uploads nobody waited for are logged on close
+        opener = FakeOpener(failures=[0])
+        proxy = self._proxy(opener, retries=0)
+        path, = self._files(count=1)
+        proxy.startUpload(path)
+        logged = []
+        self.mock(response.log, 'exception',
+                lambda msg, *args: logged.append(msg % args))
+        proxy.close()
+        self.assertEqual(logged, ['Background upload of %s failed:' % path])
+        self.assertEqual(proxy._pool, None)
+        proxy.close(abort=True)
+
+    def testChunkedResume(self):
+        # The second chunk fails once and is sent again on its own
+        opener = FakeOpener(failures=[1])
+        proxy = self._proxy(opener, chunkSize=2000)
+        path, = self._files(count=1)
+        contents = open(path).read()
+        self.assertEqual(proxy.postFile('PUT', 'file0', path),
+                hashlib.sha1(contents).hexdigest())
+        self.assertEqual([x.headers['Content-Range'] for x in opener.requests],
+                ['bytes 0-1999/5000', 'bytes 2000-3999/5000',
+                    'bytes 2000-3999/5000', 'bytes 4000-4999/5000'])
+        self.assertEqual(''.join(x.data for n, x in enumerate(opener.requests)
+            if n != 1), contents)
+
+        # Retries are limited
+        opener = FakeOpener(failures=[0, 1])
+        proxy = self._proxy(opener, chunkSize=2000, retries=1)
+        self.assertRaises(socket.error, proxy.postFile, 'PUT', 'file0', path)
+
+    def testDigestingReader(self):
+        path, = self._files(count=1)
+        contents = open(path).read()
+        digest = hashlib.sha1(contents[:1000])
+        reader = response.DigestingReader(open(path), 1000, 2000, digest)
+        self.assertEqual(reader.read(500), contents[1000:1500])
+        reader.seek(0)
+        self.assertEqual(reader.read(), contents[1000:3000])
+        self.assertEqual(reader.read(), '')
+        self.assertEqual(reader.hexdigest(),
+                hashlib.sha1(contents[:3000]).hexdigest())
+
+    def testSendLogCompressed(self):
+        opener = FakeOpener()
+        proxy = self._proxy(opener)
+        proxy.sendLog('short\n')
+        data = 'line of build output\n' * 1000
+        proxy.sendLog(data)
+        small, large = opener.requests
+        self.assertEqual(small.data, 'short\n')
+        self.assertEqual(small.headers.get('Content-Encoding'), None)
+        self.assertEqual(large.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(large.data, 16 + zlib.MAX_WBITS), data)
+
+
+class LogResponse(object):
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.batches = []
+
+    def sendLog(self, data):
+        if self.failures:
+            self.failures -= 1
+            raise socket.error("connection refused")
+        self.batches.append(data)
+
+
+class LogHandlerTest(JobSlaveHelper):
+
+    def _handler(self, sent, **kwargs):
+        handler = response.LogHandler(sent, spoolDir=self.workDir)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        for key, value in kwargs.items():
+            setattr(handler, key, value)
+        return handler
+
+    def _emit(self, handler, messages):
+        for message in messages:
+            handler.handle(logging.LogRecord('test', logging.INFO, __file__,
+                0, message, None, None))
+
+    def testBatches(self):
+        sent = LogResponse()
+        handler = self._handler(sent, maxSize=100, maxWait=60)
+        handler.start()
+        messages = ['message %03d' % x for x in range(100)]
+        self._emit(handler, messages)
+        handler.close()
+        self.assertEqual(''.join(sent.batches),
+                ''.join(x + '\n' for x in messages))
+        # Full batches were sent without waiting for the timer
+        self.assert_(len(sent.batches) > 1)
+        self.assertEqual(handler.stats()['dropped'], 0)
+
+    def testBufferFull(self):
+        sent = LogResponse()
+        handler = self._handler(sent, bufferSize=120)
+        self._emit(handler, ['message %03d' % x for x in range(20)])
+        self.assertEqual(handler.dropped, 10)
+        handler.start()
+        handler.close()
+        batch, = sent.batches
+        self.assertEqual(batch.splitlines(),
+                ['*** 10 log records dropped ***']
+                + ['message %03d' % x for x in range(10, 20)])
+
+    def testSpool(self):
+        # Batches that fail are kept on disk and sent in order later
+        sent = LogResponse(failures=2)
+        handler = self._handler(sent, maxSize=20, minBackoff=0.01)
+        handler.start()
+        messages = ['message %03d' % x for x in range(20)]
+        self._emit(handler, messages)
+        for x in range(500):
+            if handler.stats()['sentBytes'] == 20 * 12:
+                break
+            time.sleep(0.01)
+        handler.close()
+        self.assertEqual(''.join(sent.batches),
+                ''.join(x + '\n' for x in messages))
+        stats = handler.stats()
+        self.assertEqual(stats['failures'], 2)
+        self.assertEqual(stats['spooled'], 0)
+
+        # Records still spooled at exit count as dropped
+        sent = LogResponse(failures=100)
+        handler = self._handler(sent)
+        handler.start()
+        self._emit(handler, messages)
+        handler.close()
+        self.assertEqual(sent.batches, [])
+        self.assertEqual(handler.stats()['dropped'], 20)
@@ -0,0 +1,96 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+from jobslave import filesystems
+from jobslave import sizemodels
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+MB = 1024 * 1024
+
+
+class SizeModelsTest(JobSlaveHelper):
+
+    def _usage(self, dataBlocks, files, directories=1):
+        usage = filesystems.MountUsage('/', dataBlocks * 4096)
+        usage.dataBlocks = dataBlocks
+        usage.mapBlocks = dataBlocks / 1024
+        usage.files = files
+        usage.directories = directories
+        usage.dirBlocks = directories
+        return usage
+
+    def testGetModel(self):
+        self.assertEqual(sizemodels.getModel('ext3').__class__,
+                sizemodels.Ext3Model)
+        self.assertEqual(sizemodels.getModel('xfs').__class__,
+                sizemodels.XfsModel)
+        self.assertEqual(sizemodels.getModel('btrfs').__class__,
+                sizemodels.LegacyModel)
+        self.assertEqual(sizemodels.getModel('ext4', legacy=True).__class__,
+                sizemodels.LegacyModel)
+
+    def testLegacy(self):
+        usage = filesystems.MountUsage('/', 10240)
+        self.assertEqual(sizemodels.LegacyModel('ext4').getSize(usage,
+            500000000), 598829610)
+
+    def testInstallSlack(self):
+        # Databases written during the install grow with the file count
+        small = self._usage(262144, 1000, 100)
+        large = self._usage(262144, 200000, 10000)
+        self.assertEqual(sizemodels.installSlack(small), 52584448)
+        self.failUnless(sizemodels.installSlack(large) > 400 * MB)
+        model = sizemodels.Ext4Model('ext4')
+        self.failUnless(model.getSize(large) - model.getSize(small)
+                > 400 * MB)
+
+    def testExtJournal(self):
+        journal = sizemodels.ExtModel.journalBlocks
+        self.assertEqual(journal(1000), 0)
+        self.assertEqual(journal(32767), 1024)
+        self.assertEqual(journal(32768), 4096)
+        self.assertEqual(journal(1024 * 1024), 16384)
+        self.assertEqual(journal(64 * 1024 * 1024), 262144)
+
+    def testExtBackups(self):
+        groups = [x for x in range(100) if sizemodels.ExtModel.hasBackup(x)]
+        self.assertEqual(groups, [0, 1, 3, 5, 7, 9, 25, 27, 49, 81])
+
+    def testExtSize(self):
+        # 1 GiB of data in large files
+        usage = self._usage(262144, 1000, 100)
+        ext3 = sizemodels.Ext3Model('ext3').getSize(usage)
+        ext4 = sizemodels.Ext4Model('ext4').getSize(usage)
+        legacy = sizemodels.LegacyModel('ext3').getSize(usage)
+        self.failUnless(1024 * MB < ext3 < legacy)
+        self.failUnless(1024 * MB < ext4 < legacy)
+        self.assertEqual(ext3 % 4096, 0)
+
+    def testExtInodeBound(self):
+        # Lots of tiny files need more inodes than the data size provides
+        usage = self._usage(100000, 100000, 5000)
+        model = sizemodels.Ext4Model('ext4')
+        size = model.getSize(usage)
+        ratio, inodeSize = model.inodeParams(size / 4096)
+        self.failUnless(size / ratio >= 105011)
+
+    def testXfsSize(self):
+        usage = self._usage(262144, 1000, 100)
+        size = sizemodels.XfsModel('xfs').getSize(usage)
+        self.failUnless(1024 * MB < size
+                < sizemodels.LegacyModel('xfs').getSize(usage))
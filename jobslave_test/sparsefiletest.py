@@ -0,0 +1,70 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+
+from jobslave import sparsefile
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class SparseFileTest(JobSlaveHelper):
+
+    def testAllocateSparse(self):
+        path = os.path.join(self.workDir, 'sparse.img')
+        allocated = sparsefile.allocate(path, 64 * 1048576)
+        self.assertEqual(os.stat(path).st_size, 64 * 1048576)
+        self.failUnless(allocated < 1048576)
+
+    def testAllocatePreallocate(self):
+        path = os.path.join(self.workDir, 'prealloc.img')
+        sparsefile.allocate(path, 1048576, mode='preallocate')
+        self.assertEqual(os.stat(path).st_size, 1048576)
+
+    def testAllocateInvalidMode(self):
+        path = os.path.join(self.workDir, 'bogus.img')
+        self.assertRaises(ValueError, sparsefile.allocate, path, 4096,
+                mode='bogus')
+
+    def testPunchHole(self):
+        path = os.path.join(self.workDir, 'punch.img')
+        f = open(path, 'wb')
+        f.write('x' * 65536)
+        f.close()
+        f = open(path, 'r+b')
+        if sparsefile.punchHole(f, 4096, 8192):
+            f.seek(4096)
+            self.assertEqual(f.read(8192), '\0' * 8192)
+        f.close()
+        self.assertEqual(os.stat(path).st_size, 65536)
+
+    def testIterExtents(self):
+        path = os.path.join(self.workDir, 'extents.img')
+        f = open(path, 'wb')
+        f.seek(1048576)
+        f.write('x' * 4096)
+        f.truncate(4 * 1048576)
+        f.close()
+        f = open(path, 'rb')
+        extents = list(sparsefile.iterExtents(f))
+        f.close()
+        # Contiguous and covering the whole file
+        pos = 0
+        for offset, length, isData in extents:
+            self.assertEqual(offset, pos)
+            pos += length
+        self.assertEqual(pos, 4 * 1048576)
+        self.failUnless([x for x in extents if x[2]])
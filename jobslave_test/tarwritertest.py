@@ -0,0 +1,78 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import hashlib
+import os
+import StringIO
+import tarfile
+
+from jobslave import tarwriter
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class TarWriterTest(JobSlaveHelper):
+
+    def testArchive(self):
+        path = os.path.join(self.workDir, 'out.tar')
+        longName = 'dir/' + 'x' * 150
+        with open(path, 'wb') as fobj:
+            archive = tarwriter.TarWriter(fobj, mtime=1234567890)
+            archive.addData('first.xml', '<xml/>\n')
+            member = archive.member('second/chunk-0000')
+            member.write('hello ')
+            member.write('world')
+            self.assertEqual(member.close(), 11)
+            archive.addFile(longName, StringIO.StringIO('a' * 1000), 1000,
+                    mode=0600)
+            with archive.member('empty') as member:
+                pass
+            archive.close()
+        self.assertEqual(os.stat(path).st_size % tarwriter.RECORD_SIZE, 0)
+
+        tar = tarfile.open(path)
+        self.assertEqual(tar.getnames(), ['first.xml', 'second/chunk-0000',
+            longName, 'empty'])
+        self.assertEqual(tar.extractfile('first.xml').read(), '<xml/>\n')
+        self.assertEqual(tar.extractfile('second/chunk-0000').read(),
+                'hello world')
+        self.assertEqual(tar.extractfile(longName).read(), 'a' * 1000)
+        self.assertEqual(tar.extractfile('empty').read(), '')
+        info = tar.getmember(longName)
+        self.assertEqual((info.mode, info.mtime), (0600, 1234567890))
+
+    def testShortFile(self):
+        archive = tarwriter.TarWriter(StringIO.StringIO())
+        self.assertRaises(IOError, archive.addFile, 'short',
+                StringIO.StringIO('abc'), 10)
+
+    def testDigestAndRewrite(self):
+        fobj = StringIO.StringIO()
+        archive = tarwriter.TarWriter(fobj)
+        offset = archive.addData('disk.mf', 'SHA1(disk)= ' + '0' * 40 + '\n')
+        digest = hashlib.sha1()
+        archive.addFile('disk', StringIO.StringIO('x' * 5000), 5000,
+                bufSize=1024, digest=digest)
+        self.assertEqual(digest.hexdigest(), hashlib.sha1('x' * 5000).hexdigest())
+        archive.rewrite(offset + 12, digest.hexdigest())
+        archive.close()
+
+        fobj.seek(0)
+        tar = tarfile.open(fileobj=fobj)
+        self.assertEqual(tar.getnames(), ['disk.mf', 'disk'])
+        self.assertEqual(tar.extractfile('disk.mf').read(),
+                'SHA1(disk)= %s\n' % digest.hexdigest())
+        self.assertEqual(tar.extractfile('disk').read(), 'x' * 5000)
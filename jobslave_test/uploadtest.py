@@ -0,0 +1,150 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import BaseHTTPServer
+import hashlib
+import os
+import socket
+import threading
+
+from jobslave import response
+from jobslave import upload
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, dict(self.headers), body))
+        if self.server.redirect:
+            self.send_response(302)
+            self.send_header('Location', self.path)
+        elif self.server.failures:
+            self.server.failures -= 1
+            self.send_response(503)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class UploadTest(JobSlaveHelper):
+
+    def setUp(self):
+        JobSlaveHelper.setUp(self)
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.failures = 0
+        self.server.redirect = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        JobSlaveHelper.tearDown(self)
+
+    def _file(self, size=3000000):
+        path = os.path.join(self.workDir, 'disk.img')
+        with open(path, 'wb') as fobj:
+            fobj.write(os.urandom(size))
+        return path
+
+    def testPutFile(self):
+        path = self._file()
+        contents = open(path).read()
+        with open(path, 'rb') as fobj:
+            upload.putFile('PUT', self.url + 'disk.img', {'X-Test': 'yes'},
+                    fobj, 1000, 2000000)
+        (urlPath, headers, body), = self.server.requests
+        self.assertEqual(urlPath, '/disk.img')
+        self.assertEqual(headers['x-test'], 'yes')
+        self.assertEqual(body, contents[1000:2001000])
+
+        self.server.failures = 1
+        with open(path, 'rb') as fobj:
+            try:
+                upload.putFile('PUT', self.url + 'disk.img', {}, fobj, 0, 10)
+            except upload.UploadError, err:
+                self.assertEqual(err.status, 503)
+            else:
+                self.fail("UploadError not raised")
+
+    def testPutFileTimeout(self):
+        # A server that never reads the body
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        try:
+            path = self._file(64 * 1024 * 1024)
+            url = 'http://127.0.0.1:%d/disk.img' % sock.getsockname()[1]
+            with open(path, 'rb') as fobj:
+                self.assertRaises(socket.timeout, upload.putFile, 'PUT', url,
+                        {}, fobj, 0, 64 * 1024 * 1024, timeout=0.5)
+        finally:
+            sock.close()
+
+    def testFileHasher(self):
+        path = self._file()
+        for length in (0, 3000000):
+            with open(path, 'rb') as fobj:
+                hasher = upload.FileHasher(fobj, length)
+                hasher.start()
+                self.assertEqual(hasher.hexdigest(),
+                        hashlib.sha1(open(path).read(length)).hexdigest())
+
+    def testCanSendfile(self):
+        self.assertEqual(upload.canSendfile('http://master/api/'), True)
+        self.assertEqual(upload.canSendfile('https://master/api/'), False)
+        self.assertEqual(upload.canSendfile('http://user:pw@master/'), False)
+
+    def testResponseProxy(self):
+        path = self._file()
+        contents = open(path).read()
+        proxy = response.ResponseProxy(self.url,
+                dict(buildId=1, outputToken='token'), chunkSize=1000000)
+        self.mock(response.time, 'sleep', lambda seconds: None)
+        self.assertEqual(proxy.useSendfile, True)
+        self.assertEqual(proxy.postFile('PUT', 'disk.img', path),
+                hashlib.sha1(contents).hexdigest())
+        self.assertEqual([x[1]['content-range'] for x in self.server.requests],
+                ['bytes 0-999999/3000000', 'bytes 1000000-1999999/3000000',
+                    'bytes 2000000-2999999/3000000'])
+        self.assertEqual(''.join(x[2] for x in self.server.requests),
+                contents)
+
+    def testRedirectFallback(self):
+        path = self._file(1000)
+        proxy = response.ResponseProxy(self.url,
+                dict(buildId=1, outputToken='token'))
+        sent = []
+        def postFileObject(method, targetName, fobj, size, digest=None):
+            sent.append((targetName, fobj.tell(), size))
+            return 'digest'
+        proxy.postFileObject = postFileObject
+        self.server.redirect = True
+        # Redirects are not retried with sendfile but handed to the regular
+        # client
+        self.assertEqual(proxy.postFile('PUT', 'disk.img', path), 'digest')
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(sent, [('disk.img', 0, 1000)])
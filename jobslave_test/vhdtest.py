@@ -16,6 +16,7 @@
 
 
 import os
+import struct
 import tempfile
 
 from jobslave.generators import vhd
@@ -71,3 +72,53 @@ class VHDTest(JobSlaveHelper):
     def testBlockTable(self):
         blk = vhd.BlockAllocationTable(10)
         self.failIf(blk[1] != 4294967295L, "enexpected return")
+
+    def testSectorBitmap(self):
+        data = '\0' * 512 + 'x' + '\0' * 1023 + 'y'
+        blk = vhd.DataBlock(data)
+        self.failIf(blk.isEmpty())
+        bitmap = blk.sectorBitmap.pack()
+        self.assertEqual(len(bitmap), 512)
+        # sectors 1 and 3 are used
+        self.assertEqual(bitmap[0], chr(0x50))
+        self.assertEqual(bitmap[1:], '\0' * 511)
+        self.assertEqual(len(blk.pack()), 512 + blk.blockSize)
+        self.failUnless(vhd.DataBlock('\0' * 4096).isEmpty())
+
+    def testDynamicSparse(self):
+        blockSize = vhd.DataBlock.blockSize
+        f = open(self.fn, 'r+b')
+        f.seek(3 * blockSize + 100)
+        f.write('data')
+        f.truncate(8 * blockSize)
+        f.close()
+        fd, outFn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            vhd.makeDynamic(self.fn, outFn)
+            out = open(outFn, 'rb')
+            out.seek(1536)
+            bat = struct.unpack('>8L', out.read(32))
+            used = [n for (n, x) in enumerate(bat) if x != 0xffffffff]
+            self.assertEqual(used, [3])
+            out.seek(bat[3] * 512 + 512 + 100)
+            self.assertEqual(out.read(4), 'data')
+            out.close()
+        finally:
+            os.unlink(outFn)
+
+    def testDynamicConsume(self):
+        fd, inFn = tempfile.mkstemp()
+        f = os.fdopen(fd, 'w')
+        f.seek(vhd.DataBlock.blockSize + 512)
+        f.write('data')
+        f.close()
+        fd, outFn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            vhd.makeDynamic(inFn, outFn, consume=True)
+            self.failIf(os.path.exists(inFn))
+            self.validateVHD(outFn)
+            self.failUnless('data' in open(outFn).read())
+        finally:
+            os.unlink(outFn)
@@ -0,0 +1,255 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import hashlib
+import os
+import struct
+import zlib
+
+from jobslave import artifacts
+from jobslave import vmdk
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class VMDKTest(JobSlaveHelper):
+
+    def _image(self, size=40 * 1048576):
+        # Random data, a run of zeroes, a hole and some data at the end
+        path = os.path.join(self.workDir, 'disk.img')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(200000))
+            f.write('\0' * vmdk.GRAIN_SIZE)
+            f.seek(size - 1000)
+            f.write('x' * 1000)
+        return path
+
+    def _expected(self, path):
+        return open(path, 'rb').read()
+
+    def _readStream(self, path):
+        f = open(path, 'rb')
+        header = vmdk.unpackHeader(f.read(512))
+        out = bytearray(header.capacity * 512)
+        f.seek(header.overHead * 512)
+        while True:
+            pos = f.tell()
+            lba, size = struct.unpack(vmdk.GRAIN_MARKER_FORMAT, f.read(12))
+            if size:
+                data = zlib.decompress(f.read(size))
+                out[lba * 512:lba * 512 + len(data)] = data
+                f.seek(vmdk._pad(pos + 12 + size, 512))
+                continue
+            markerType, = struct.unpack('<I', f.read(4))
+            f.seek(pos + 512 + lba * 512)
+            if markerType == vmdk.MARKER_FOOTER:
+                f.seek(pos + 512)
+                footer = vmdk.unpackHeader(f.read(512))
+                self.assertEqual(footer.magicNumber, 'KDMV')
+                self.assertNotEqual(footer.gdOffset, vmdk.GD_AT_END)
+            if markerType == vmdk.MARKER_EOS:
+                break
+        return header, str(out)
+
+    def _readSparse(self, path):
+        f = open(path, 'rb')
+        header = vmdk.unpackHeader(f.read(512))
+        gts = vmdk.numGTs(header.capacity * 512)
+        f.seek(header.gdOffset * 512)
+        directory = struct.unpack('<%dI' % gts, f.read(gts * 4))
+        out = bytearray(header.capacity * 512)
+        for gtNum, gtOffset in enumerate(directory):
+            f.seek(gtOffset * 512)
+            table = struct.unpack('<512I', f.read(2048))
+            for n, sector in enumerate(table):
+                if sector:
+                    f.seek(sector * 512)
+                    offset = (gtNum * 512 + n) * vmdk.GRAIN_SIZE
+                    data = f.read(vmdk.GRAIN_SIZE)
+                    out[offset:offset + len(data)] = data
+        return header, str(out)
+
+    def testStreamOptimized(self):
+        path = self._image()
+        outPath = os.path.join(self.workDir, 'disk.vmdk')
+        stats = vmdk.writeVMDK(path, outPath, 80, heads=64, sectors=32,
+                adapter='lsilogic', hwVersion=10, streaming=True, workers=2)
+        self.assertEqual(stats.written, 5)
+        self.assertEqual(stats.skipped, 640 - 5)
+        header, data = self._readStream(outPath)
+        self.assertEqual(header.version, 3)
+        self.assertEqual(header.compressAlgorithm, vmdk.COMPRESSION_DEFLATE)
+        self.assertEqual(header.gdOffset, vmdk.GD_AT_END)
+        self.assertEqual(data, self._expected(path))
+        descriptor = open(outPath).read(512 * (header.descriptorSize + 1)
+                )[512:].rstrip('\0')
+        self.assertIn('createType="streamOptimized"', descriptor)
+        self.assertIn('RDONLY 81920 SPARSE "disk.vmdk"', descriptor)
+        self.assertIn('ddb.adapterType = "lsilogic"', descriptor)
+        # Written in order, so hashed as it was written
+        self.assertEqual(artifacts.registry.lookup(outPath).sha1,
+                hashlib.sha1(open(outPath).read()).hexdigest())
+
+    def testMonolithicSparse(self):
+        path = self._image()
+        outPath = os.path.join(self.workDir, 'disk.vmdk')
+        vmdk.writeVMDK(path, outPath, 80, heads=64, sectors=32)
+        header, data = self._readSparse(outPath)
+        self.assertEqual(header.version, 1)
+        self.assertEqual(header.compressAlgorithm, vmdk.COMPRESSION_NONE)
+        self.assertEqual(header.overHead % vmdk.GRAIN_SECTORS, 0)
+        self.assertEqual(data, self._expected(path))
+        # Only the non-empty grains are stored
+        self.assertEqual(os.stat(outPath).st_size,
+                header.overHead * 512 + 5 * vmdk.GRAIN_SIZE)
+
+    def testStreamFromPipe(self):
+        path = self._image(size=3 * 1048576)
+        outPath = os.path.join(self.workDir, 'disk.vmdk')
+        readFd, writeFd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(readFd)
+            os.write(writeFd, open(path, 'rb').read())
+            os._exit(0)
+        os.close(writeFd)
+        try:
+            vmdk.writeVMDK(readFd, outPath, 6, streaming=True,
+                    size=os.stat(path).st_size)
+        finally:
+            os.close(readFd)
+            os.waitpid(pid, 0)
+        header, data = self._readStream(outPath)
+        self.assertEqual(data, self._expected(path))
+
+    def testShortInput(self):
+        path = self._image(size=3 * 1048576)
+        outPath = os.path.join(self.workDir, 'disk.vmdk')
+        inFile = open(path, 'rb')
+        # Not a regular file, so the whole size has to be read
+        readFd, writeFd = os.pipe()
+        os.write(writeFd, inFile.read(1000))
+        os.close(writeFd)
+        try:
+            self.assertRaises(IOError, vmdk.writeVMDK, readFd, outPath, 6,
+                    streaming=True, size=3 * 1048576)
+        finally:
+            os.close(readFd)
+
+    def testCallback(self):
+        calls = []
+        class Callback(object):
+            def creatingDisk(self, completed, total, skipped=0, rate=0):
+                calls.append((completed, total, skipped))
+        path = self._image(size=40 * 1048576)
+        outPath = os.path.join(self.workDir, 'disk.vmdk')
+        vmdk.writeVMDK(path, outPath, 80, streaming=True,
+                callback=Callback())
+        # Once per grain table and once at the end
+        self.assertEqual(calls, [
+            (32 * 1048576, 40 * 1048576, 512 - 4),
+            (40 * 1048576, 40 * 1048576, 640 - 5),
+            (40 * 1048576, 40 * 1048576, 640 - 5),
+            ])
+
+    def testDescriptor(self):
+        descriptor = vmdk.Descriptor(vmdk.TWO_GB_MAX_EXTENT_SPARSE,
+                [(100, '/tmp/disk-s001.vmdk'), (50, '/tmp/disk-s002.vmdk')],
+                96, 64, 32, 'ide', 7)
+        self.assertEqual(str(descriptor).splitlines(), [
+            '# Disk DescriptorFile',
+            'version=1 ',
+            'CID=fffffffe ',
+            'parentCID=ffffffff ',
+            'createType="twoGbMaxExtentSparse" ',
+            '',
+            '# Extent description',
+            'RW 100 SPARSE "disk-s001.vmdk"',
+            'RW 50 SPARSE "disk-s002.vmdk"',
+            '',
+            '# The Disk Data Base ',
+            '#DDB',
+            '',
+            'ddb.adapterType = "ide"',
+            'ddb.encoding = "UTF-8"',
+            'ddb.geometry.cylinders = "96"',
+            'ddb.geometry.heads = "64"',
+            'ddb.geometry.sectors = "32"',
+            'ddb.toolsVersion = "8193"',
+            'ddb.virtualHWVersion = "7"',
+            ])
+
+    def _vmdk(self, streaming):
+        outPath = os.path.join(self.workDir, 'disk.vmdk')
+        vmdk.writeVMDK(self._image(), outPath, 80, streaming=streaming)
+        return outPath
+
+    def testVerify(self):
+        for streaming in (False, True):
+            outPath = self._vmdk(streaming)
+            self.assertEqual(vmdk.verifyFile(outPath, checkData=True), [])
+            reader = vmdk.VMDKReader(outPath)
+            extracted = os.path.join(self.workDir, 'extracted.img')
+            with open(extracted, 'wb') as fobj:
+                reader.extract(fobj)
+            reader.close()
+            self.assertEqual(open(extracted).read(),
+                    self._expected(os.path.join(self.workDir, 'disk.img')))
+
+    def testVerifyCorrupt(self):
+        outPath = self._vmdk(False)
+        header = vmdk.VMDKReader(outPath).header
+        with open(outPath, 'r+b') as fobj:
+            fobj.seek((header.gdOffset + 1) * 512)
+            fobj.write(struct.pack('<I', 0xffffff))
+        self.assertEqual(vmdk.verifyFile(outPath), [
+            outPath + ': grain table 0 differs from its redundant copy',
+            outPath + ': grain 0 points outside the data area '
+            '(sector 16777215)',
+            ])
+
+        path = self._image()
+        self.assertEqual(vmdk.verifyFile(path), [
+            "%s: bad magic number %r" % (path, open(path).read(4))])
+
+    def testFixGrainDirectory(self):
+        outPath = self._vmdk(True)
+        good = open(outPath).read()
+        self.assertEqual(vmdk.fixGrainDirectory(outPath), False)
+
+        # Lose the footer and end of stream marker
+        with open(outPath, 'r+b') as fobj:
+            fobj.truncate(len(good) - 3 * 512)
+        self.assertEqual(vmdk.verifyFile(outPath), [
+            outPath + ': end of stream marker not found',
+            outPath + ': grain directory or footer not found',
+            ])
+        self.assertEqual(vmdk.fixGrainDirectory(outPath), True)
+        self.assertEqual(open(outPath).read(), good)
+
+        # Lose the last grain table as well
+        with open(outPath, 'r+b') as fobj:
+            fobj.truncate(len(good) - 2 * 512 - 2048 - 3 * 512)
+        self.assertEqual(vmdk.fixGrainDirectory(outPath), True)
+        self.assertEqual(open(outPath).read(), good)
+        self.assertEqual(vmdk.verifyFile(outPath, checkData=True), [])
+
+    def testVerifyFiles(self):
+        outPath = self._vmdk(True)
+        missing = os.path.join(self.workDir, 'missing.vmdk')
+        results = vmdk.verifyFiles([outPath, missing])
+        self.assertEqual(results[outPath], [])
+        self.assertEqual(len(results[missing]), 1)
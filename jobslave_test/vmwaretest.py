@@ -17,8 +17,10 @@
 
 from lxml import etree
 import os
+import subprocess
 from testutils import mock
 
+from jobslave import vmdk
 from jobslave.job_data import JobData
 from jobslave.generators import vmware_image
 from jobslave_test.jobslave_helper import JobSlaveHelper
@@ -91,6 +93,72 @@ class VMwareTest(JobSlaveHelper):
         self._testGuestOS(vmware_image.VMwareESXImage, '', 'is: x86_64',
                 'other26xlinux-64')
 
+    def testCreateVMDKStreaming(self):
+        calls = []
+        self.mock(vmware_image, 'logCall', lambda cmd, **kw: calls.append(cmd))
+        class geometry:
+            heads = 64
+            sectors = 32
+            @staticmethod
+            def cylindersRequired(size):
+                return 96
+        vmware_image.createVMDK('disk.img', 'disk.vmdk', 100663296,
+                geometry=geometry, adapter='lsilogic', hwVersion=10,
+                streaming=True, threads=0, level=6)
+        self.assertEqual(calls, [['/usr/bin/raw2vmdk', '-C', '96', '-H', '64',
+            '-S', '32', '-A', 'lsilogic', '-V', '10', '-s', '-j', '0',
+            '-z', '6', 'disk.img', 'disk.vmdk']])
+
+    def testCreateVMDKInProcess(self):
+        calls = []
+        self.mock(vmware_image, 'logCall', lambda cmd, **kw: calls.append(cmd))
+        class geometry:
+            heads = 64
+            sectors = 32
+            @staticmethod
+            def cylindersRequired(size):
+                return 96
+        hdImage = os.path.join(self.workDir, 'disk.img')
+        with open(hdImage, 'wb') as f:
+            f.write('x' * 100000)
+            f.truncate(100663296)
+        outfile = os.path.join(self.workDir, 'disk.vmdk')
+        vmware_image.createVMDK(hdImage, outfile, 100663296,
+                geometry=geometry, adapter='lsilogic', hwVersion=10,
+                streaming=True, threads=0, level=6, writer='python')
+        self.assertEqual(calls, [])
+        header = vmdk.unpackHeader(open(outfile).read(512))
+        self.assertEqual(header.capacity, 100663296 / 512)
+        self.assertEqual(header.gdOffset, vmdk.GD_AT_END)
+
+    def testPassFd(self):
+        # Only the progress pipe reaches the child, at the fixed descriptor
+        readFd, writeFd = os.pipe()
+        leaked = open(os.devnull)
+        proc = subprocess.Popen(['/bin/sh', '-c',
+            'echo progress >&3; [ -e /proc/$$/fd/%d ] && echo leaked'
+            % leaked.fileno()], close_fds=False, stdout=subprocess.PIPE,
+            preexec_fn=lambda: vmware_image._passFd(writeFd))
+        stdout = proc.communicate()[0]
+        os.close(writeFd)
+        self.assertEqual(os.read(readFd, 100), 'progress\n')
+        self.assertEqual(stdout, '')
+        os.close(readFd)
+        leaked.close()
+
+    def testCallbackRateLimit(self):
+        messages = []
+        callback = vmware_image.VMwareCallback(messages.append)
+        callback.creatingDisk(None, None)
+        callback.creatingDisk(512 * 1048576, 1024 * 1048576, skipped=3,
+                rate=2 * 1048576)
+        callback.creatingDisk(768 * 1048576, 1024 * 1048576)
+        self.assertEqual(messages, ["Creating disk: 50% (512 of 1024 MB at "
+            "2.0 MB/s, 3 empty grains skipped)"])
+        callback.timeStamp = 0
+        callback.creatingArchive(None, None)
+        self.assertEqual(messages[-1], "Creating archive")
+
 class BaseVmwareImageTest(JobSlaveHelper):
     GeneratorClass = None
     OvfNsMap = dict(ovf='http://schemas.dmtf.org/ovf/envelope/1',
@@ -127,7 +195,10 @@ class BaseVmwareImageTest(JobSlaveHelper):
                 f.seek(1000000)
                 f.truncate()
         self.mock(vmware_image, 'logCall', mockLogCall)
+        # The fake disks written above are not real VMDKs
+        self.mock(vmware_image.vmdk, 'verifyFile', lambda *args, **kw: [])
         mock.mockMethod(img.downloadChangesets)
+        mock.mockMethod(img.startUpload)
         mock.mockMethod(img.postOutput)
         self.img = img
         return img
@@ -291,10 +362,12 @@ class VMwareImageTest(BaseVmwareImageTest):
         diskImagePath = self.vmwareDisk.image
         vmdkPath = os.path.join(os.path.dirname(diskImagePath),
                     'foo-1.0.1-x86/foo-1.0.1-x86.vmdk')
-        self.assertEquals(self.logCallArgs[-1],
-                (['/usr/bin/raw2vmdk', '-C', '96', '-H', '64', '-S', '32',
-                    '-A', 'lsilogic', '-V', '10', diskImagePath, vmdkPath, ],
-                    {}),)
+        cmd, kw = self.logCallArgs[-1]
+        self.assertEquals(cmd,
+                ['/usr/bin/raw2vmdk', '-C', '96', '-H', '64', '-S', '32',
+                    '-A', 'lsilogic', '-V', '10', '-P', '3', diskImagePath,
+                    vmdkPath, ])
+        self.assertEquals(sorted(kw), ['close_fds', 'preexec_fn'])
 
         # More memory
         self.data['data'].update(buildOVF10=True, vmCPUs=1, vmMemory=65536)
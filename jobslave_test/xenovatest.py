@@ -0,0 +1,55 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import gzip
+import os
+import tarfile
+
+from jobslave.generators import xen_ova
+from jobslave_test.jobslave_helper import JobSlaveHelper
+
+
+class XenOVATest(JobSlaveHelper):
+
+    def testWriteXVA(self):
+        self.mock(xen_ova, 'CHUNK_SIZE', 1000000)
+        image = os.path.join(self.workDir, 'hdimage')
+        data = os.urandom(300000)
+        with open(image, 'wb') as f:
+            f.write(data)
+            f.seek(2500000)
+            f.write(data)
+        outfile = os.path.join(self.workDir, 'out.xva')
+        messages = []
+        xen_ova.writeXVA(outfile, '<appliance/>\n', image, workers=2,
+                consume=True, status=messages.append)
+        self.failIf(os.path.exists(image))
+        self.assertEqual(messages, [
+            'Compressing disk image: chunk 1 of 3',
+            'Compressing disk image: chunk 2 of 3',
+            'Compressing disk image: chunk 3 of 3',
+            ])
+
+        tar = tarfile.open(outfile)
+        self.assertEqual(tar.getnames(), ['ova.xml', 'xvda/chunk-0000.gz',
+            'xvda/chunk-0001.gz', 'xvda/chunk-0002.gz'])
+        self.assertEqual(tar.extractfile('ova.xml').read(), '<appliance/>\n')
+        chunks = [gzip.GzipFile(fileobj=tar.extractfile(name)).read()
+                for name in tar.getnames()[1:]]
+        self.assertEqual([len(x) for x in chunks], [1000000, 1000000,
+            800000])
+        self.assertEqual(''.join(chunks), data + '\0' * 2200000 + data)